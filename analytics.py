@@ -0,0 +1,212 @@
+import io
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import numpy as np
+from matplotlib.figure import Figure
+
+import storage
+
+# =======================
+# Analytics settings
+# =======================
+ROLLING_DAYS = 7
+RECENT_DAYS = 7
+ANALYTICS_CACHE_SIZE = 256
+DETAIL_DAYS = 90  # raw readings are only scanned this far back
+DEFAULT_SPLIT_HOUR = 12  # morning/evening boundary when no reminders are set
+
+READINGS_SQL = ("SELECT ts, systolic, diastolic, pulse_bpm FROM bp_diary "
+                "WHERE chat_id=? AND systolic IS NOT NULL AND ts >= ? ORDER BY ts")
+
+# AHA categories, checked from the most severe down
+CATEGORIES = ["Normal", "Elevated", "Stage 1", "Stage 2", "Crisis"]
+
+
+def load_readings(conn, chat_id, since):
+    rows = conn.execute(READINGS_SQL, (chat_id, max(since, 1))).fetchall()
+    if not rows:
+        return None
+    data = np.array(rows, dtype=np.float64)
+    return data[:, 0].astype(np.int64), data[:, 1], data[:, 2], data[:, 3]
+
+def load_daily(conn, chat_id, tz):
+    # Per-day rollups in ROLLUP_FIELDS order; recomputed from raw readings
+    # while the user's rollups are pending or in another timezone
+    if storage.get_rollup_tz(conn, chat_id) == getattr(tz, "key", None):
+        rows = storage.get_daily_rollups(conn, chat_id)
+    else:
+        daily, _ = storage.compute_rollups(conn, chat_id, getattr(tz, "key", "UTC"))
+        rows = [(day, *agg) for day, agg in sorted(daily.items())]
+    if not rows:
+        return None
+    days = np.array([row[0] for row in rows], dtype="datetime64[D]")
+    fields = np.array([row[1:] for row in rows], dtype=np.float64)
+    return days, {name: fields[:, i] for i, name in enumerate(storage.ROLLUP_FIELDS)}
+
+def local_offsets(ts, tz):
+    # UTC offset (seconds) for each timestamp, resolved once per distinct hour
+    hours, inverse = np.unique(ts // 3600, return_inverse=True)
+    offsets = np.fromiter(
+        (datetime.fromtimestamp(int(h) * 3600, tz).utcoffset().total_seconds() for h in hours),
+        dtype=np.int64, count=len(hours))
+    return offsets[inverse]
+
+def categorize(sys_, dia):
+    return np.select(
+        [(sys_ > 180) | (dia > 120), (sys_ >= 140) | (dia >= 90), (sys_ >= 130) | (dia >= 80), sys_ >= 120],
+        [4, 3, 2, 1],
+        default=0)
+
+def morning_mask(local_minutes, reminder_times):
+    # A reading belongs to the reminder slot nearest to it on the clock; the
+    # earlier slot is "morning". Without reminders split at DEFAULT_SPLIT_HOUR.
+    if len(reminder_times) >= 2:
+        slots = sorted(t.hour * 60 + t.minute for t in reminder_times[:2])
+        dist = [np.minimum(np.abs(local_minutes - s), 1440 - np.abs(local_minutes - s)) for s in slots]
+        return dist[0] <= dist[1]
+    return local_minutes < DEFAULT_SPLIT_HOUR * 60
+
+def rolling_mean(values, window):
+    # Trailing mean over `window` points; shorter windows at the start
+    csum = np.cumsum(np.insert(values, 0, 0.0))
+    counts = np.minimum(np.arange(1, len(values) + 1), window)
+    ends = np.arange(1, len(values) + 1)
+    return (csum[ends] - csum[ends - counts]) / counts
+
+def analyze_daily(daily):
+    # Whole-history stats from per-day count / sum / sum of squares
+    days, f = daily
+    count = f["n"].sum()
+
+    def mean_sd(prefix):
+        mean = f[f"{prefix}_sum"].sum() / count
+        var = max(f[f"{prefix}_sq"].sum() / count - mean * mean, 0.0)
+        return float(mean), float(np.sqrt(var))
+
+    (sys_mean, sys_sd), (dia_mean, dia_sd) = mean_sd("sys"), mean_sd("dia")
+    pulse_n = f["pulse_n"].sum()
+    day_sys = f["sys_sum"] / f["n"]
+    day_dia = f["dia_sum"] / f["n"]
+    return {
+        "count": int(count),
+        "first": str(days[0]),
+        "last": str(days[-1]),
+        "mean": (sys_mean, dia_mean),
+        "pulse": float(f["pulse_sum"].sum() / pulse_n) if pulse_n else None,
+        "sd": (sys_sd, dia_sd),
+        "days": days,
+        "day_sys": day_sys,
+        "day_dia": day_dia,
+        "roll_sys": rolling_mean(day_sys, ROLLING_DAYS),
+        "roll_dia": rolling_mean(day_dia, ROLLING_DAYS),
+    }
+
+def analyze_detail(readings, tz, reminder_times, now):
+    # Per-reading stats over the last DETAIL_DAYS
+    ts, sys_, dia, pulse = readings
+    local_minutes = ((ts + local_offsets(ts, tz)) % 86400) // 60
+    morning = morning_mask(local_minutes, reminder_times)
+    recent = ts >= now - RECENT_DAYS * 86400
+    category_counts = np.bincount(categorize(sys_, dia), minlength=len(CATEGORIES))
+
+    def mean_pair(mask):
+        if not mask.any():
+            return None
+        return float(sys_[mask].mean()), float(dia[mask].mean()), int(mask.sum())
+
+    return {
+        "recent": mean_pair(recent),
+        "morning": mean_pair(morning),
+        "evening": mean_pair(~morning),
+        "arv": (float(np.abs(np.diff(sys_)).mean()), float(np.abs(np.diff(dia)).mean())) if len(ts) > 1 else (0.0, 0.0),
+        "categories": category_counts / len(ts),
+    }
+
+NO_DETAIL = {"recent": None, "morning": None, "evening": None, "arv": None, "categories": None}
+
+def analyze(daily, readings, tz, reminder_times, now=None):
+    now = now if now is not None else int(datetime.now(timezone.utc).timestamp())
+    stats = analyze_daily(daily)
+    stats.update(analyze_detail(readings, tz, reminder_times, now) if readings is not None else NO_DETAIL)
+    return stats
+
+def format_report(stats):
+    def pair(p):
+        return f"{p[0]:.0f}/{p[1]:.0f} (n={p[2]})" if p else "—"
+
+    lines = [
+        f"📈 Analytics: {stats['count']} readings, {stats['first']} – {stats['last']}",
+        f"Average: {stats['mean'][0]:.0f}/{stats['mean'][1]:.0f}"
+        + (f", pulse {stats['pulse']:.0f}" if stats['pulse'] is not None else ""),
+        f"Variability: SD {stats['sd'][0]:.1f}/{stats['sd'][1]:.1f}",
+        f"Last {RECENT_DAYS} days: {pair(stats['recent'])}",
+    ]
+    if stats["categories"] is not None:
+        lines += [
+            f"Last {DETAIL_DAYS} days:",
+            f"🌅 Morning: {pair(stats['morning'])}",
+            f"🌙 Evening: {pair(stats['evening'])}",
+            f"ARV {stats['arv'][0]:.1f}/{stats['arv'][1]:.1f}",
+            "Categories (AHA): " + " · ".join(
+                f"{name} {share * 100:.0f}%" for name, share in zip(CATEGORIES, stats['categories']) if share),
+        ]
+    return "\n".join(lines)
+
+def render_chart(stats):
+    dates = stats["days"]
+    # Figure without pyplot: no global state, safe off the main thread
+    fig = Figure(figsize=(8, 4), dpi=100)
+    ax = fig.subplots()
+    ax.scatter(dates, stats["day_sys"], s=8, color="tab:red", alpha=0.35)
+    ax.scatter(dates, stats["day_dia"], s=8, color="tab:blue", alpha=0.35)
+    ax.plot(dates, stats["roll_sys"], color="tab:red", label=f"Systolic ({ROLLING_DAYS}-day avg)")
+    ax.plot(dates, stats["roll_dia"], color="tab:blue", label=f"Diastolic ({ROLLING_DAYS}-day avg)")
+    ax.axhline(130, color="grey", linewidth=0.8, linestyle="--")
+    ax.axhline(80, color="grey", linewidth=0.8, linestyle="--")
+    ax.set_ylabel("mmHg")
+    ax.legend(loc="upper left", fontsize=8)
+    fig.autofmt_xdate()
+    fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+def build_report(conn, chat_id, tz, reminder_times):
+    # Returns (text, png) or None without readings. Reads one row per day
+    # plus the last DETAIL_DAYS of raw readings.
+    daily = load_daily(conn, chat_id, tz)
+    if daily is None:
+        return None
+    now = int(datetime.now(timezone.utc).timestamp())
+    readings = load_readings(conn, chat_id, now - DETAIL_DAYS * 86400)
+    stats = analyze(daily, readings, tz, reminder_times, now)
+    return format_report(stats), render_chart(stats)
+
+def render_report(conn, chat_id, tz, reminder_times):
+    # Entry point for a render worker process
+    return build_report(conn, chat_id, tz, reminder_times)
+
+
+class ReportCache:
+    # Per-user LRU of finished reports keyed by (data version, settings), so a
+    # repeated request with unchanged data costs a dict lookup.
+    def __init__(self, maxsize=ANALYTICS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, user_id, key):
+        item = self._data.get(user_id)
+        if item is None or item[0] != key:
+            return None
+        self._data.move_to_end(user_id)
+        return item[1]
+
+    def put(self, user_id, key, report):
+        self._data[user_id] = (key, report)
+        self._data.move_to_end(user_id)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._data.pop(user_id, None)
@@ -0,0 +1,175 @@
+"""Crash-safety check for saved readings: no acknowledged reading is lost.
+
+Each round starts the real bot (against the fake Bot API) in a child process
+where --users people keep adding readings, each with a unique comment. The
+child prints every "Entry saved" confirmation the moment the fake API
+receives it. After a random delay the whole child process group is killed
+with SIGKILL, mid-batch, and every confirmed reading must then be in the
+database, with bp_summary counts matching bp_diary. Readings stored without
+a confirmation (committed, then killed before the reply) are fine.
+
+Updates go through PTB's update processor, so --concurrent-updates (the
+bot's BOT_CONCURRENT_UPDATES, 1 by default) limits how many readings can
+share a commit.
+
+SIGKILL simulates an application crash, not power loss: it shows that a
+confirmation is only sent after the commit. That the commit is also on disk
+comes from the group commit's synchronous=FULL (SQLite) or
+synchronous_commit=on (PostgreSQL). Exits with status 1 if a reading is lost.
+
+Usage: python bench/crash_safety.py [--rounds 5] [--users 200] [--database-url URL]
+       [--concurrent-updates N] [--batch-rows N] [--batch-ms MS]
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import re
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import bot  # noqa: E402
+import storage  # noqa: E402
+from fakeapi import FakeBotAPI  # noqa: E402
+from loadtest import Run  # noqa: E402
+
+SAVED = re.compile(r"✅ Entry saved:\nBP: .*\nNote: (r\d+-\d+)")
+READY_TIMEOUT = 60
+
+
+# =======================
+# Child: the bot under load
+# =======================
+class AckingAPI(FakeBotAPI):
+    def _notify(self, chat_id, endpoint, parameters):
+        match = SAVED.match(str(parameters.get("text", "")))
+        if match:
+            sys.stdout.write(f"ack {chat_id} {match.group(1)}\n")
+            sys.stdout.flush()
+        super()._notify(chat_id, endpoint, parameters)
+
+
+async def add_readings(run, user_id, rng):
+    for n in itertools.count():
+        await run.send(user_id, "Add")
+        await run.send(user_id, f"{rng.randint(100, 160)}/{rng.randint(60, 100)}")
+        await run.send(user_id, str(rng.randint(55, 95)))
+        await run.send(user_id, f"r{user_id}-{n}")
+
+async def child(args):
+    run = Run(args, args.workdir)
+    run.api = AckingAPI()
+    run.setup()
+    bot.db.batch_rows = args.batch_rows
+    bot.db.batch_window = args.batch_ms / 1000
+    async with run:
+        print("ready", flush=True)
+        rng = random.Random(args.seed)
+        await asyncio.gather(*(add_readings(run, user_id, rng) for user_id in range(1, args.users + 1)))
+
+
+# =======================
+# Parent: kill and verify
+# =======================
+def run_round(args, number, rng):
+    command = [sys.executable, os.path.abspath(__file__), "--child", "--workdir", args.workdir,
+               "--seed-db", args.seed_db, "--users", str(args.users), "--seed", str(number),
+               "--batch-rows", str(args.batch_rows), "--batch-ms", str(args.batch_ms),
+               "--concurrent-updates", str(args.concurrent_updates)]
+    if args.database_url:
+        command += ["--database-url", args.database_url]
+    # A session of its own, so the render processes die with the bot
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, text=True, start_new_session=True)
+    acked = set()
+    ready = threading.Event()
+
+    def read():
+        for line in proc.stdout:
+            if line.startswith("ack "):
+                _, chat_id, comment = line.split()
+                acked.add((int(chat_id), comment))
+            elif line.strip() == "ready":
+                ready.set()
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    if not ready.wait(READY_TIMEOUT):
+        os.killpg(proc.pid, signal.SIGKILL)
+        sys.exit("the bot did not start")
+    delay = rng.uniform(args.min_delay, args.max_delay)
+    time.sleep(delay)
+    os.killpg(proc.pid, signal.SIGKILL)
+    proc.wait()
+    reader.join()
+
+    stored, mismatched = read_database(args)
+    lost = acked - stored
+    print(f"Round {number}: killed after {delay:.1f}s, {len(acked)} acknowledged, {len(stored)} stored, "
+          f"{len(stored - acked)} unacknowledged, {len(lost)} lost, {mismatched} bad summaries")
+    for chat_id, comment in sorted(lost)[:10]:
+        print(f"  lost: chat {chat_id} {comment}")
+    return len(lost) + mismatched
+
+def read_database(args):
+    if args.database_url:
+        import pgstorage
+        conn = pgstorage.connect(args.database_url)
+    else:
+        # Opening the file recovers the WAL left by the killed process
+        conn = sqlite3.connect(os.path.join(args.workdir, "bench.db"))
+    try:
+        stored = {(chat_id, comment) for chat_id, comment in conn.execute("SELECT chat_id, comment FROM bp_diary")}
+        mismatched = conn.execute(
+            "SELECT COUNT(*) FROM bp_summary s "
+            "WHERE s.entries <> (SELECT COUNT(*) FROM bp_diary d WHERE d.chat_id=s.chat_id)").fetchone()[0]
+    finally:
+        conn.close()
+    return stored, mismatched
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--min-delay", type=float, default=2.0, help="seconds of load before the kill, at least")
+    parser.add_argument("--max-delay", type=float, default=6.0)
+    parser.add_argument("--database-url", help="run on this PostgreSQL database (its tables are replaced)")
+    parser.add_argument("--concurrent-updates", type=int, default=bot.CONCURRENT_UPDATES)
+    parser.add_argument("--batch-rows", type=int, default=storage.BATCH_ROWS)
+    parser.add_argument("--batch-ms", type=float, default=storage.BATCH_WINDOW * 1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--seed-db", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.api_delay = 0.0
+
+    if args.child:
+        asyncio.run(child(args))
+        return
+
+    print(f"Concurrent updates: {args.concurrent_updates}")
+    failures = 0
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        args.workdir = workdir
+        args.seed_db = os.path.join(workdir, "seed.db")
+        conn = sqlite3.connect(args.seed_db)
+        storage.init_db(conn)
+        conn.close()
+        for number in range(1, args.rounds + 1):
+            failures += run_round(args, number, rng)
+    print("No acknowledged reading was lost" if not failures else f"FAILED: {failures} problems")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
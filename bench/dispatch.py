@@ -0,0 +1,90 @@
+"""Benchmark: per-update dispatch latency.
+
+Feeds synthetic updates through Application.process_update with the bot's own
+handlers against a temporary database. The Bot API is replaced by a fake
+transport that answers every call from memory, so the timings cover routing,
+the handlers and SQLite, not the network.
+
+Usage: python bench/dispatch.py [--updates N] [--users N]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import bot  # noqa: E402
+import storage  # noqa: E402
+from fakeapi import FakeBotAPI, make_update  # noqa: E402
+
+# (kind, text) scripts; each user loops over one of them
+SCRIPTS = [
+    [("button", "Status"), ("button", "Settings"), ("button", "Back to Main")],
+    [("button", "Add"), ("step", "120/80"), ("step", "72"), ("step", "after coffee")],
+    [("command", "/start"), ("command", "/about"), ("unknown", "hello there")],
+    [("button", "Set Timezone"), ("step", "Cancel"), ("button", "Export"), ("step", "Cancel")],
+    [("button", "Add"), ("step", "135/85"), ("button", "Status")],
+]
+
+
+def make_updates(app, count, users):
+    # Round-robin over users so flows interleave like real traffic
+    updates = []
+    positions = [0] * users
+    for n in range(count):
+        user = n % users
+        script = SCRIPTS[user % len(SCRIPTS)]
+        kind, text = script[positions[user] % len(script)]
+        positions[user] += 1
+        updates.append((kind, make_update(app.bot, n + 1, 1000 + user, text)))
+    return updates
+
+
+def summarize(label, samples):
+    samples = sorted(samples)
+    p = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]  # noqa: E731
+    print(f"{label:10} n={len(samples):6}  mean {statistics.fmean(samples) * 1e6:8.1f} us  "
+          f"p50 {p(0.5) * 1e6:8.1f} us  p99 {p(0.99) * 1e6:8.1f} us  max {samples[-1] * 1e6:8.1f} us")
+
+
+async def run(args):
+    app = bot.build_application(request=FakeBotAPI())
+    await app.initialize()
+    updates = make_updates(app, args.updates, args.users)
+    timings = {}
+    try:
+        for kind, update in updates:
+            start = time.perf_counter()
+            await app.process_update(update)
+            timings.setdefault(kind, []).append(time.perf_counter() - start)
+    finally:
+        await app.shutdown()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bot.db = storage.SqliteDatabase(os.path.join(tmp, "bench.db"))
+        storage.init_db(bot.db.connect())
+        try:
+            timings = asyncio.run(run(args))
+        finally:
+            bot.db.close()
+
+    print(f"{args.updates} updates, {args.users} users")
+    for kind in sorted(timings):
+        summarize(kind, timings[kind])
+    summarize("all", [t for samples in timings.values() for t in samples])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Stand-in for the Telegram Bot API used by the benchmarks.
+
+FakeBotAPI is a telegram.request.BaseRequest that answers every call from
+memory, so an Application built with it runs the real handlers without any
+network. It records when each chat received what, and wait_for() lets a
+benchmark await a reply that is sent from a background task (exports,
+reminders).
+"""
+import asyncio
+import json
+import time
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+
+class FakeBotAPI(BaseRequest):
+    # getMe gets a bot user, send* a message (with a document for
+    # sendDocument), anything else True. delay simulates network round trips.
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = {}  # method -> count
+        self._waiters = {}  # (chat_id, method) -> [(future, predicate)]
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def wait_for(self, chat_id, method, predicate=None):
+        # Future resolved with the time chat_id next receives `method` with
+        # parameters that predicate(parameters) accepts
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault((chat_id, method), []).append((future, predicate))
+        return future
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint.startswith("send"):
+            parameters = request_data.parameters if request_data else {}
+            chat_id = int(parameters.get("chat_id", 0))
+            result = self._message(chat_id, endpoint)
+            self._notify(chat_id, endpoint, parameters)
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def _notify(self, chat_id, endpoint, parameters):
+        waiters = self._waiters.get((chat_id, endpoint))
+        if not waiters:
+            return
+        now = time.perf_counter()
+        remaining = []
+        for future, predicate in waiters:
+            if future.done():
+                continue
+            if predicate is None or predicate(parameters):
+                future.set_result(now)
+            else:
+                remaining.append((future, predicate))
+        if remaining:
+            self._waiters[(chat_id, endpoint)] = remaining
+        else:
+            del self._waiters[(chat_id, endpoint)]
+
+    def _message(self, chat_id, endpoint):
+        self._message_id += 1
+        message = {"message_id": self._message_id, "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER, "text": "ok"}
+        if endpoint == "sendDocument":
+            file_id = f"doc{self._message_id}"
+            message["document"] = {"file_id": file_id, "file_unique_id": file_id}
+        return message
+
+
+def make_update(bot, update_id, user_id, text):
+    message = {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": update_id, "message": message}, bot)
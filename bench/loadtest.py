@@ -0,0 +1,431 @@
+"""Load test: the real Application, handlers and background tasks against a
+fake Bot API (bench/fakeapi.py) and a seeded SQLite database.
+
+Scenarios:
+  users      --users people doing Add, Show, Delete and Export concurrently,
+             --rounds times each, on users that have seeded history
+  reminders  --reminder-users people sharing one reminder slot (the next
+             minute boundary, so the run waits up to a minute for it)
+
+The seed database (--rows synthetic readings over --seed-users users) is built
+once per --seed-db path and copied for every run, so runs start from the same
+data. With --database-url postgresql://... the bot runs on PostgreSQL instead:
+the seed is COPYed into that database before every run, replacing its tables,
+so point it at a scratch database. An export counts as a failure when the bot answers with a busy or error
+message instead of the file; with more concurrent users than
+rendering.RENDER_QUEUE_SIZE some are expected. peak_total_rss_mb adds up the
+bot process and its render workers (sampled from /proc, Linux only). Results are printed and, with --json, written as JSON; --compare checks
+them against an earlier JSON file and exits with status 1 on a regression.
+
+Usage: python bench/loadtest.py [users|reminders|all] [--rows N] [--users N]
+       [--concurrent-updates N] [--database-url URL] [--json out.json] [--compare base.json] [--tolerance 0.2]
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import bot  # noqa: E402
+import pdffonts  # noqa: E402
+import rendering  # noqa: E402
+import scheduler  # noqa: E402
+import storage  # noqa: E402
+from fakeapi import FakeBotAPI, make_update  # noqa: E402
+
+SEED_BATCH = 50000
+READING_INTERVAL = 8 * 3600
+REMINDER_USER_BASE = 10_000_000
+EXPORT_TIMEOUT = 120
+RSS_SAMPLE_INTERVAL = 0.2
+COMMENTS = ["", "after coffee", "morning", "before bed", "felt dizzy", "after a walk"]
+
+FLOWS = [
+    ("add", ["Add", "{bp}", "{pulse}", "bench"]),
+    ("show", ["Show", bot.OLDER_BUTTON]),
+    ("delete", ["Delete", "1"]),
+    ("export", ["Export", "CSV", "Last 30 days"]),
+]
+
+
+# =======================
+# Seed data
+# =======================
+def seed(path, rows, users, rng_seed):
+    rng = random.Random(rng_seed)
+    db = storage.SqliteDatabase(path, readers=1)
+    conn = db.connect()
+    storage.init_db(conn)
+    per_user = max(1, rows // users)
+    now = int(time.time())
+    sql = ("INSERT INTO bp_diary (chat_id, datetime, bp, pulse, comment, ts, systolic, diastolic, pulse_bpm) "
+           "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+    batch = []
+    with conn:
+        for chat_id in range(1, users + 1):
+            start = now - per_user * READING_INTERVAL
+            for i in range(per_user):
+                ts = start + i * READING_INTERVAL + rng.randrange(3600)
+                systolic, diastolic, pulse = rng.randint(100, 160), rng.randint(60, 100), rng.randint(55, 95)
+                batch.append((chat_id, datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d %H:%M"),
+                              f"{systolic}/{diastolic}", str(pulse), rng.choice(COMMENTS),
+                              ts, systolic, diastolic, pulse))
+                if len(batch) >= SEED_BATCH:
+                    conn.executemany(sql, batch)
+                    batch.clear()
+        conn.executemany(sql, batch)
+        conn.execute("INSERT INTO bp_summary (chat_id, entries, version) "
+                     "SELECT chat_id, COUNT(*), 1 FROM bp_diary GROUP BY chat_id")
+        for chat_id in range(1, users + 1):
+            storage.rebuild_rollups(conn, chat_id, "UTC")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.close()
+    return per_user * users
+
+def prepare_seed(args):
+    if os.path.exists(args.seed_db):
+        print(f"Reusing seed database {args.seed_db}")
+        return
+    start = time.perf_counter()
+    count = seed(args.seed_db, args.rows, args.seed_users, args.seed)
+    print(f"Seeded {count} readings for {args.seed_users} users in {time.perf_counter() - start:.1f}s")
+
+
+# =======================
+# Harness
+# =======================
+class Run:
+    # One bot lifecycle on a fresh copy of the seed database
+    def __init__(self, args, workdir, queue_options=None):
+        self.args = args
+        self.workdir = workdir
+        self.queue_options = queue_options or {}
+        self.api = FakeBotAPI(delay=args.api_delay)
+        self.app = None
+        self.update_id = 0
+        self.update_times = []
+
+    def setup(self):
+        if self.args.database_url:
+            import pgstorage  # psycopg is only needed for PostgreSQL runs
+            url = self.args.database_url
+            bot.db = storage.open_database(url)
+            conn = bot.db.connect()
+            storage.init_db(conn)
+            seed_conn = sqlite3.connect(self.args.seed_db)
+            try:
+                pgstorage.copy_from_sqlite(seed_conn, conn, replace=True)
+            finally:
+                seed_conn.close()
+        else:
+            url = os.path.join(self.workdir, "bench.db")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(url + suffix):
+                    os.unlink(url + suffix)
+            shutil.copy(self.args.seed_db, url)
+            bot.db = storage.SqliteDatabase(url)
+        # Fresh per run: the scheduler's wakeup event belongs to one event loop
+        bot.reminder_scheduler = scheduler.ReminderScheduler()
+        bot.sent_cache = scheduler.SentCache()
+        bot.render_service = rendering.RenderService(url, warmup=(pdffonts.register_fonts,))
+        bot.EXPORT_CACHE_DIR = os.path.join(self.workdir, "export_cache")
+        return bot.db
+
+    async def __aenter__(self):
+        schedule_reminders = bot.schedule_reminders
+        bot.schedule_reminders = functools.partial(schedule_reminders, **self.queue_options)
+        bot.CONCURRENT_UPDATES = self.args.concurrent_updates
+        self.app = bot.build_application(request=self.api)
+        await self.app.initialize()
+        try:
+            await bot.on_startup(self.app)
+        finally:
+            bot.schedule_reminders = schedule_reminders
+        await self.app.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.app.stop()
+        await bot.on_shutdown(self.app)
+        await self.app.shutdown()
+
+    async def send(self, user_id, text):
+        self.update_id += 1
+        update = make_update(self.app.bot, self.update_id, user_id, text)
+        start = time.perf_counter()
+        # Through the update processor as the update queue would, so at most
+        # --concurrent-updates of them run at once (one by default)
+        await self.app.update_processor.process_update(update, self.app.process_update(update))
+        self.update_times.append(time.perf_counter() - start)
+
+
+def percentiles(samples, scale=1000.0, unit="ms"):
+    samples = sorted(samples)
+    if not samples:
+        return {"n": 0}
+    p = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]  # noqa: E731
+    return {"n": len(samples), f"mean_{unit}": round(statistics.fmean(samples) * scale, 3),
+            f"p50_{unit}": round(p(0.5) * scale, 3), f"p99_{unit}": round(p(0.99) * scale, 3),
+            f"max_{unit}": round(samples[-1] * scale, 3)}
+
+
+class MemorySampler:
+    # Peak RSS of this process and its children (the render workers) added
+    # together, sampled from /proc; ru_maxrss only covers one process. Reads
+    # 0 where there is no /proc.
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = 0
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self.peak = max(self.peak, self.total())
+            if self._stop.wait(self.interval):
+                return
+
+    def total(self):
+        pid = os.getpid()
+        return sum(self._rss(p) for p in [pid] + self._children(pid))
+
+    def _children(self, pid):
+        children = []
+        try:
+            names = os.listdir("/proc")
+        except OSError:
+            return children
+        for name in names:
+            if not name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    # pid (comm) state ppid ...; comm may hold spaces
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            if ppid == pid:
+                children.append(int(name))
+        return children
+
+    def _rss(self, pid):
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                return int(f.read().split()[1]) * self._page_size
+        except (OSError, IndexError, ValueError):
+            return 0
+
+
+# -----------------------
+# Scenario: concurrent users
+# -----------------------
+async def user_session(run, user_id, rng, timings, failures):
+    for _ in range(run.args.rounds):
+        for action, texts in FLOWS:
+            values = {"bp": f"{rng.randint(100, 160)}/{rng.randint(60, 100)}", "pulse": str(rng.randint(55, 95))}
+            start = time.perf_counter()
+            for text in texts[:-1]:
+                await run.send(user_id, text.format(**values))
+            if action == "export":
+                # The document, or any reply other than "Preparing…" (busy,
+                # error, nothing to export)
+                document = run.api.wait_for(user_id, "sendDocument")
+                other = run.api.wait_for(user_id, "sendMessage", not_preparing)
+            await run.send(user_id, texts[-1].format(**values))
+            if action == "export":
+                await asyncio.wait({document, other}, timeout=EXPORT_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+                other.cancel()
+                if not document.done():
+                    document.cancel()
+                    failures[action] = failures.get(action, 0) + 1
+                    continue
+            timings.setdefault(action, []).append(time.perf_counter() - start)
+
+def not_preparing(parameters):
+    return not str(parameters.get("text", "")).startswith("⏳ Preparing")
+
+async def scenario_users(args, workdir):
+    run = Run(args, workdir)
+    run.setup()
+    users = min(args.users, args.seed_users)
+    rng = random.Random(args.seed)
+    timings, failures = {}, {}
+    async with run:
+        start = time.perf_counter()
+        await asyncio.gather(*(user_session(run, user_id, random.Random(rng.random()), timings, failures)
+                               for user_id in range(1, users + 1)))
+        wall = time.perf_counter() - start
+    result = {"users": users, "rounds": args.rounds, "wall_s": round(wall, 3),
+              "updates": len(run.update_times),
+              "throughput_updates_per_s": round(len(run.update_times) / wall, 1),
+              "update": percentiles(run.update_times)}
+    for action, _ in FLOWS:
+        result[action] = percentiles(timings.get(action, []))
+        result[action]["failures"] = failures.get(action, 0)
+    return result
+
+
+# -----------------------
+# Scenario: shared reminder slot
+# -----------------------
+def next_slot(margin=10):
+    # Next minute boundary at least `margin` seconds away, as (epoch, "HH:MM" UTC)
+    fire_at = (int(time.time()) // 60 + 1) * 60
+    if fire_at - time.time() < margin:
+        fire_at += 60
+    return fire_at, datetime.fromtimestamp(fire_at, timezone.utc).strftime("%H:%M")
+
+async def scenario_reminders(args, workdir):
+    rate = args.reminder_rate or 1e9
+    run = Run(args, workdir, {"global_rate": rate, "per_chat_rate": rate})
+    conn = run.setup().connect()
+    fire_at, slot = next_slot()
+    user_ids = range(REMINDER_USER_BASE, REMINDER_USER_BASE + args.reminder_users)
+    conn.executemany("INSERT INTO user_settings (user_id, timezone, reminders) VALUES (?, 'UTC', ?) "
+                     "ON CONFLICT (user_id) DO UPDATE SET reminders=excluded.reminders",
+                     [(user_id, json.dumps([slot])) for user_id in user_ids])
+    conn.commit()
+
+    async with run:
+        clock = time.time() - time.perf_counter()
+        waiters = [run.api.wait_for(user_id, "sendMessage") for user_id in user_ids]
+        print(f"Waiting {fire_at - time.time():.0f}s for the {slot} UTC slot "
+              f"({args.reminder_users} users, rate {'unlimited' if not args.reminder_rate else rate}/s)")
+        done, pending = await asyncio.wait(waiters, timeout=fire_at - time.time() + 60 + args.reminder_users / rate)
+        for waiter in pending:
+            waiter.cancel()
+    sent = sorted(clock + waiter.result() for waiter in done)
+    lateness = [t - fire_at for t in sent]
+    spread = sent[-1] - sent[0] if len(sent) > 1 else 0
+    return {"users": args.reminder_users, "delivered": len(sent), "missed": len(pending),
+            "throughput_sent_per_s": round(len(sent) / spread, 1) if spread else 0,
+            "lateness": percentiles(lateness, scale=1.0, unit="s")}
+
+
+# =======================
+# Reporting
+# =======================
+# Suffix -> True when higher is better
+DIRECTIONS = {"_per_s": True, "_ms": False, "_s": False, "_mb": False, "failures": False, "missed": False}
+
+def flatten(data, prefix=""):
+    for key, value in data.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
+def direction(name):
+    for suffix, higher_is_better in DIRECTIONS.items():
+        if name.endswith(suffix):
+            return higher_is_better
+    return None
+
+def compare(base, current, tolerance):
+    if base.get("meta", {}).get("params") != current["meta"]["params"]:
+        print("Note: runs used different parameters")
+    old = dict(flatten(base.get("results", {})))
+    regressions = 0
+    print(f"{'metric':42} {'base':>12} {'current':>12} {'change':>8}")
+    for name, value in flatten(current["results"]):
+        higher_is_better = direction(name)
+        if higher_is_better is None or name not in old or not isinstance(value, (int, float)):
+            continue
+        before = old[name]
+        change = (value - before) / before if before else (1.0 if value else 0.0)
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:42} {before:12.3f} {value:12.3f} {change:+8.1%}{flag}")
+    print(f"{regressions} regression(s) beyond {tolerance:.0%}")
+    return regressions
+
+def print_results(results):
+    for name, value in flatten(results):
+        print(f"{name:42} {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", nargs="?", choices=["users", "reminders", "all"], default="all")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="seeded readings")
+    parser.add_argument("--seed-users", type=int, default=2000)
+    parser.add_argument("--seed-db", help="seed database to build once and reuse")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database-url", help="run on this PostgreSQL database (its tables are replaced)")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--reminder-users", type=int, default=10000)
+    parser.add_argument("--reminder-rate", type=float, default=0,
+                        help="delivery rate limit per second; 0 lifts Telegram's limits")
+    parser.add_argument("--api-delay", type=float, default=0.0, help="simulated Bot API latency in seconds")
+    parser.add_argument("--concurrent-updates", type=int, default=bot.CONCURRENT_UPDATES,
+                        help="updates processed at once, as BOT_CONCURRENT_UPDATES")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="earlier JSON results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    print(f"Concurrent updates: {args.concurrent_updates}")
+    with tempfile.TemporaryDirectory() as workdir:
+        args.seed_db = args.seed_db or os.path.join(workdir, "seed.db")
+        prepare_seed(args)
+        results = {}
+        sampler = MemorySampler().start()
+        try:
+            if args.scenario in ("users", "all"):
+                results["users"] = asyncio.run(scenario_users(args, workdir))
+            if args.scenario in ("reminders", "all"):
+                results["reminders"] = asyncio.run(scenario_reminders(args, workdir))
+        finally:
+            sampler.stop()
+    # ru_maxrss is in KiB on Linux. The render workers only show up in the
+    # sampled total: a spawned child's ru_maxrss starts at the parent's size
+    # from before its exec, so RUSAGE_CHILDREN can't tell them apart.
+    results["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    results["peak_total_rss_mb"] = round(sampler.peak / (1024 * 1024), 1)
+
+    # The URL may hold a password; the backend is enough to tell runs apart
+    params = {k: v for k, v in vars(args).items()
+              if k not in ("json", "compare", "tolerance", "seed_db", "database_url")}
+    params["backend"] = "postgresql" if args.database_url else "sqlite"
+    output = {"meta": {"params": params, "python": platform.python_version(), "platform": platform.platform(),
+                       "time": datetime.now(timezone.utc).isoformat(timespec="seconds")},
+              "results": results}
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        if compare(base, output, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Micro-benchmark: font cost of PDF exports.
+
+Compares registering the TrueType fonts once per worker process (what the
+render workers do) with parsing them again for every export, on a diary with
+comments in several scripts.
+
+Usage: python bench/pdf_fonts.py [--rows N] [--repeat N]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from reportlab.pdfbase import pdfmetrics  # noqa: E402
+from reportlab.pdfbase.ttfonts import TTFont  # noqa: E402
+
+import exporter  # noqa: E402
+import pdffonts  # noqa: E402
+
+COMMENTS = [
+    "", "after coffee", "Утром, после зарядки", "بعد الدواء", "饭后测量，有点头晕",
+    "朝食の前に測定", "운동 후 측정", "Morning — felt fine, slight headache after a long walk in the park",
+]
+
+
+def make_chunks(rows):
+    data = [(f"2024-01-{i % 28 + 1:02d} 08:{i % 60:02d}", f"{110 + i % 40}/{70 + i % 20}", str(60 + i % 30),
+             COMMENTS[i % len(COMMENTS)]) for i in range(rows)]
+    return [data[i:i + exporter.CHUNK_ROWS] for i in range(0, rows, exporter.CHUNK_ROWS)]
+
+
+def render(chunks):
+    out = io.BytesIO()
+    exporter.write_pdf(out, iter(chunks))
+    return len(out.getvalue())
+
+
+def reparse_fonts():
+    # What a renderer without a process-wide registry pays on each request
+    for name, filenames in pdffonts.TTF_FONTS.items():
+        path = pdffonts._find(filenames)
+        if path is not None:
+            pdfmetrics.registerFont(TTFont(name, path))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    chunks = make_chunks(args.rows)
+
+    start = time.perf_counter()
+    fonts = pdffonts.register_fonts()
+    register = time.perf_counter() - start
+
+    start = time.perf_counter()
+    size = render(chunks)
+    first = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        render(chunks)
+    cached = (time.perf_counter() - start) / args.repeat
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        reparse_fonts()
+        render(chunks)
+    reparsed = (time.perf_counter() - start) / args.repeat
+
+    print(f"fonts: {fonts}")
+    print(f"register_fonts:            {register * 1000:8.1f} ms (once per worker)")
+    print(f"first export:              {first * 1000:8.1f} ms ({args.rows} rows, {size} bytes)")
+    print(f"export, fonts registered:  {cached * 1000:8.1f} ms")
+    print(f"export, fonts re-parsed:   {reparsed * 1000:8.1f} ms")
+    print(f"font cost per export:      {(reparsed - cached) * 1000:8.1f} ms saved")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Micro-benchmark: timezone lookup in timezone_received.
+
+Compares the old path (available_timezones() plus difflib on every message)
+with the prebuilt TimezoneResolver.
+
+Usage: python bench/tz_resolver.py [--repeat N]
+"""
+import argparse
+import difflib
+import os
+import sys
+import time
+from zoneinfo import available_timezones
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import timezones  # noqa: E402
+
+INPUTS = [
+    "Europe/Paris", "Asia/Singapore", "America/Sao_Paulo",   # exact keys
+    "Paris", "CET", "UTC+3",                                 # aliases
+    "Europe/Pari", "Moskow", "Berln", "asdfgh",              # typos / garbage
+]
+
+
+def old_resolve(text):
+    if text in available_timezones():
+        return text, []
+    return None, difflib.get_close_matches(text, available_timezones(), n=5)
+
+
+def measure(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in INPUTS:
+            fn(text)
+    return (time.perf_counter() - start) / (repeat * len(INPUTS))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    resolver = timezones.TimezoneResolver()
+    build = time.perf_counter() - start
+
+    old = measure(old_resolve, args.repeat)
+    new = measure(resolver.resolve, args.repeat)
+    print(f"resolver build:      {build * 1000:8.2f} ms (once at startup)")
+    print(f"old per lookup:      {old * 1e6:8.1f} us")
+    print(f"resolver per lookup: {new * 1e6:8.1f} us")
+    print(f"speedup:             {old / new:8.1f}x")
+    for text in INPUTS:
+        print(f"  {text!r:22} old={old_resolve(text)} new={resolver.resolve(text)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,73 @@
-from telegram import Update, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
-from datetime import datetime, time
-from zoneinfo import ZoneInfo, available_timezones
+from telegram import Bot, Update, ReplyKeyboardMarkup
+from telegram.error import BadRequest
+from telegram.ext import Application, MessageHandler, Updater, filters, ContextTypes
+from datetime import datetime
 import asyncio
-import nest_asyncio
-import sqlite3
-import json
-import pandas as pd
-from io import BytesIO
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
-from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet
-import difflib
+import os
+import signal
+import sys
+import threading
+import time
 import random
-
-nest_asyncio.apply()
+import storage
+import exporter
+import scheduler
+import delivery
+import usersettings
+import timezones
+import ingest
+import analytics
+import rendering
+import pdffonts
+import convstate
+import router
+import metrics
+import sharding
 
 # =======================
 # States
 # =======================
 BP, PULSE, COMMENT = range(3)
-EXPORT_CHOOSE = range(1)
-SET_TIMEZONE, SET_REMINDERS = range(2, 4)
-DELETE_ENTRY = range(4, 5)
+SET_TIMEZONE, SET_REMINDERS = range(3, 5)
+DELETE_ENTRY = 5
+IMPORT_READINGS = 6
+EXPORT_CHOOSE, EXPORT_RANGE, EXPORT_CUSTOM = range(7, 10)
+END = -1  # returned by a step handler when its flow is finished
 
 DB_FILE = "bp_diary.db"
 
+# =======================
+# Configuration
+# =======================
+# REPLACE THIS WITH YOUR ACTUAL BOT TOKEN FROM BOTFATHER (or set BOT_TOKEN)
+TOKEN = os.environ.get("BOT_TOKEN", "MYAU")
+BOT_MODE = os.environ.get("BOT_MODE", "polling")  # "polling" or "webhook"
+BOT_API_URL = os.environ.get("BOT_API_URL")  # e.g. a local Bot API server
+CONCURRENT_UPDATES = int(os.environ.get("BOT_CONCURRENT_UPDATES", "1"))
+DATABASE_URL = os.environ.get("DATABASE_URL", DB_FILE)  # a SQLite path or a postgresql:// URL
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "1"))  # >1: an ingress process plus this many workers
+DB_BATCH_ROWS = int(os.environ.get("DB_BATCH_ROWS", str(storage.BATCH_ROWS)))
+DB_BATCH_MS = float(os.environ.get("DB_BATCH_MS", str(storage.BATCH_WINDOW * 1000)))
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # public URL for setWebhook; required in webhook mode against Telegram
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+EXPORT_CACHE_DIR = os.environ.get("EXPORT_CACHE_DIR", "export_cache")
+EXPORT_CACHE_MB = int(os.environ.get("EXPORT_CACHE_MB", "256"))
+CONV_PERSIST = os.environ.get("CONV_PERSIST", "1") != "0"  # keep in-flight conversations across restarts
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))  # serves /metrics; recording is off when 0
+
+NEWER_BUTTON = "⬅️ Newer"
+OLDER_BUTTON = "Older ➡️"
+COMMENT_PREVIEW = 200  # keeps a page of entries well under Telegram's 4096 chars
+
 # =======================
 # Main menu keyboard
 # =======================
 MAIN_MENU = ReplyKeyboardMarkup(
-    [["Add", "Show"], ["Export", "Delete"], ["Status", "Settings"]],
+    [["Add", "Show"], ["Export", "Delete"], ["Status", "Analytics"], ["Settings"]],
     resize_keyboard=True
 )
 
@@ -39,17 +75,38 @@ EXPORT_MENU = ReplyKeyboardMarkup([
     ["CSV", "XLSX", "PDF"], ["Cancel"]
 ], resize_keyboard=True, one_time_keyboard=True)
 
+EXPORT_RANGE_MENU = ReplyKeyboardMarkup([
+    ["Last 7 days", "Last 30 days", "Last 90 days"],
+    ["Since last export", "All time"],
+    ["Custom range", "Cancel"]
+], resize_keyboard=True, one_time_keyboard=True)
+
+EXPORT_RANGE_DAYS = {"Last 7 days": 7, "Last 30 days": 30, "Last 90 days": 90}
+
 SETTINGS_MENU = ReplyKeyboardMarkup([
     ["Set Timezone", "Set Reminders"],
-    ["Back to Main"]
+    ["Import", "Back to Main"]
 ], resize_keyboard=True)
 
+CANCEL_MENU = ReplyKeyboardMarkup([["Cancel"]], resize_keyboard=True)
+
 TIMEZONE_MENU = ReplyKeyboardMarkup([
     ["New York", "London", "Berlin", "Tokyo"],
     ["Moscow", "Sydney", "Los Angeles", "Other"],
     ["Cancel"]
 ], resize_keyboard=True)
 
+# Map common city names to timezone names
+TIMEZONE_BUTTONS = {
+    "New York": "America/New_York",
+    "London": "Europe/London",
+    "Berlin": "Europe/Berlin",
+    "Tokyo": "Asia/Tokyo",
+    "Moscow": "Europe/Moscow",
+    "Sydney": "Australia/Sydney",
+    "Los Angeles": "America/Los_Angeles"
+}
+
 REMINDER_MENU = ReplyKeyboardMarkup([
     ["07:00 19:00", "08:00 20:00", "09:00 21:00"],
     ["Custom Times", "Cancel"]
@@ -58,99 +115,202 @@ REMINDER_MENU = ReplyKeyboardMarkup([
 # =======================
 # Database functions
 # =======================
+# Thin async wrappers around storage.py so handlers never touch the database
+# on the event loop.
+db = storage.open_database(DATABASE_URL, batch_rows=DB_BATCH_ROWS, batch_window=DB_BATCH_MS / 1000)
+reminder_scheduler = scheduler.ReminderScheduler()
+sent_cache = scheduler.SentCache()
+settings_cache = usersettings.SettingsCache()
+analytics_cache = analytics.ReportCache()
+render_service = rendering.RenderService(DATABASE_URL, warmup=(pdffonts.register_fonts,))
+export_cache = None  # exporter.ExportCache, created on startup
+conversations = convstate.ConversationStore(persistent=CONV_PERSIST)
+SHARD, SHARDS = 0, 1  # this process's share of users, see configure_shard()
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS bp_diary (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER,
-            datetime TEXT,
-            bp TEXT,
-            pulse TEXT,
-            comment TEXT
-        )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS user_settings (
-            user_id INTEGER PRIMARY KEY,
-            timezone TEXT DEFAULT 'UTC',
-            reminders TEXT
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-def add_entry_to_db(chat_id, bp, pulse, comment):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("INSERT INTO bp_diary (chat_id, datetime, bp, pulse, comment) VALUES (?, ?, ?, ?, ?)",
-              (chat_id, datetime.now().strftime("%Y-%m-%d %H:%M"), bp, pulse, comment))
-    conn.commit()
-    conn.close()
-
-def get_entries_from_db(chat_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT id, datetime, bp, pulse, comment FROM bp_diary WHERE chat_id=? ORDER BY id DESC", (chat_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
-
-def delete_entry(entry_id, user_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM bp_diary WHERE id=? AND chat_id=?", (entry_id, user_id))
-    deleted = c.rowcount > 0
-    conn.commit()
-    conn.close()
+    conn = db.connect()
+    plan_before = storage.explain_entries(conn)
+    applied = storage.init_db(conn)
+    if applied:
+        print(f"Applied schema migrations: {applied}")
+        print(f"Query plan before: {plan_before}")
+        print(f"Query plan after: {storage.explain_entries(conn)}")
+
+async def backfill_entries():
+    # Fills the typed columns of rows written before schema v2, one short
+    # write transaction per batch so handler writes interleave with it.
+    before_id = await db.read(storage.backfill_start)
+    migrated = 0
+    while before_id is not None:
+        count, before_id = await db.write(storage.backfill_batch, before_id)
+        migrated += count
+        await asyncio.sleep(0)
+    if migrated:
+        # Rows that just got a ts are missing from the rollups
+        await db.write(storage.invalidate_rollups)
+        print(f"Backfill finished: {migrated} rows migrated")
+    await rebuild_pending_rollups()
+
+async def rebuild_pending_rollups():
+    # One short write transaction per user, like the backfill above
+    rebuilt = 0
+    while True:
+        pending = await db.read(storage.pending_rollups)
+        if not pending:
+            break
+        for chat_id, tz_name in pending:
+            await db.write(storage.rebuild_rollups, chat_id, tz_name)
+            entries_changed(chat_id)
+            rebuilt += 1
+            await asyncio.sleep(0)
+    if rebuilt:
+        print(f"Rollups rebuilt for {rebuilt} users")
+
+async def add_entry_to_db(chat_id, bp, pulse, comment):
+    # Group-committed with other users' readings; returns once it is durable
+    await db.write_batched(storage.add_entry, chat_id, datetime.now(), bp, pulse, comment)
+    entries_changed(chat_id)
+
+async def import_entries_to_db(chat_id, rows):
+    inserted = await db.write(storage.add_entries, chat_id, rows)
+    if inserted:
+        entries_changed(chat_id)
+    return inserted
+
+def entries_changed(chat_id):
+    # Derived per-user data is keyed by bp_summary.version; dropping it here
+    # just frees memory early
+    analytics_cache.invalidate(chat_id)
+
+async def get_entries_from_db(chat_id):
+    return await db.read(storage.get_entries, chat_id)
+
+async def get_entries_page(chat_id, state=None, direction=None):
+    # state holds the cursors of the page currently on screen
+    older_than = newer_than = None
+    if state and direction == OLDER_BUTTON:
+        older_than = state.older
+    elif state and direction == NEWER_BUTTON:
+        newer_than = state.newer
+    rows, has_newer, has_older = await db.read(storage.get_page, chat_id, older_than, newer_than)
+    return {
+        'rows': rows,
+        'newer': (rows[0][5], rows[0][0]) if rows and has_newer else None,
+        'older': (rows[-1][5], rows[-1][0]) if rows and has_older else None,
+    }
+
+def page_nav_row(page):
+    row = []
+    if page['newer']:
+        row.append(NEWER_BUTTON)
+    if page['older']:
+        row.append(OLDER_BUTTON)
+    return row
+
+async def delete_entry(entry_id, user_id):
+    deleted = await db.write(storage.delete_entry, entry_id, user_id)
+    if deleted:
+        entries_changed(user_id)
     return deleted
 
-def set_user_timezone(user_id, timezone):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO user_settings (user_id, timezone, reminders) VALUES (?, ?, COALESCE((SELECT reminders FROM user_settings WHERE user_id=?), '[]'))",
-              (user_id, timezone, user_id))
-    conn.commit()
-    conn.close()
-
-def get_user_timezone(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT timezone FROM user_settings WHERE user_id=?", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else "UTC"
-
-def set_user_reminders(user_id, reminders):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    reminders_json = json.dumps(reminders)
-    c.execute("INSERT OR REPLACE INTO user_settings (user_id, timezone, reminders) VALUES (?, COALESCE((SELECT timezone FROM user_settings WHERE user_id=?), 'UTC'), ?)",
-              (user_id, user_id, reminders_json))
-    conn.commit()
-    conn.close()
-
-def get_user_reminders(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT reminders FROM user_settings WHERE user_id=?", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    if result and result[0]:
-        try:
-            return json.loads(result[0])
-        except json.JSONDecodeError:
-            return []
-    return []
-
-def get_all_users_with_reminders():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT user_id, timezone, reminders FROM user_settings WHERE reminders IS NOT NULL AND reminders != '[]'")
-    results = c.fetchall()
-    conn.close()
-    return results
+async def get_user_settings(user_id):
+    settings = settings_cache.get(user_id)
+    if settings is None:
+        settings = usersettings.UserSettings(*await db.read(storage.get_settings, user_id))
+        settings_cache.put(user_id, settings)
+    return settings
+
+def user_settings_changed(user_id, tz, reminders):
+    # Write-through: called with the row as committed
+    settings_cache.put(user_id, usersettings.UserSettings(tz, reminders))
+    reminder_scheduler.update_user(user_id, tz, reminders)
+
+async def set_user_timezone(user_id, timezone):
+    user_settings_changed(user_id, *await db.write(storage.set_timezone, user_id, timezone))
+
+async def get_user_timezone(user_id):
+    return (await get_user_settings(user_id)).tz_name
+
+async def set_user_reminders(user_id, reminders):
+    user_settings_changed(user_id, *await db.write(storage.set_reminders, user_id, reminders))
+
+async def get_user_reminders(user_id):
+    return (await get_user_settings(user_id)).reminders
+
+async def get_all_users_with_reminders():
+    return await db.read(storage.get_all_users_with_reminders, SHARD, SHARDS)
+
+# =======================
+# Conversation state
+# =======================
+# Per-user conversation data lives in `conversations` (convstate) instead of
+# context.user_data: one small record per user, dropped when the flow ends or
+# after CONV_TTL idle, and flushed to SQLite so a restart doesn't lose it.
+# Each record also holds the named step the user is at.
+CONVERSATION_STEPS = {
+    "add": {BP: "bp", PULSE: "pulse", COMMENT: "comment"},
+    "timezone": {SET_TIMEZONE: "timezone"},
+    "reminders": {SET_REMINDERS: "reminders"},
+    "import": {IMPORT_READINGS: "import"},
+    "delete": {DELETE_ENTRY: "delete"},
+    "export": {EXPORT_CHOOSE: "export_format", EXPORT_RANGE: "export_range", EXPORT_CUSTOM: "export_custom"},
+}
+STEP_KINDS = {step: kind for kind, steps in CONVERSATION_STEPS.items() for step in steps.values()}
+
+async def get_conversation(user_id, kind=None):
+    if conversations.needs_load(user_id):
+        row = await db.read(storage.load_conversation, user_id, int(time.time()))
+        conversations.restore(user_id, convstate.Conversation.from_json(row[1], row[0]) if row else None)
+    return conversations.get(user_id, kind)
+
+async def conversation_expired(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    conversations.end(update.effective_user.id)
+    await update.message.reply_text("⌛ This step timed out. Please start again from the menu.", reply_markup=MAIN_MENU)
+    return END
+
+def track(kind, handler):
+    # Stores the state a step handler returns as the user's step and ends the
+    # record when the flow is finished
+    steps = CONVERSATION_STEPS[kind]
+
+    async def tracked(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        state = await handler(update, context)
+        if state is None:
+            return state
+        user_id = update.effective_user.id
+        if state not in steps:
+            conversations.end(user_id)
+            return state
+        conv = conversations.get(user_id)
+        if conv is None or conv.kind != kind:
+            conv = convstate.Conversation(kind)
+        conv.step = steps[state]
+        conversations.save(user_id, conv)
+        return state
+    return tracked
+
+async def load_conversations():
+    now = int(time.time())
+    await db.write(storage.purge_conversations, now)
+    rows = await db.read(storage.load_conversations, now, SHARD, SHARDS)
+    for user_id, expires, data in rows:
+        conversations.restore(user_id, convstate.Conversation.from_json(data, expires))
+    if rows:
+        print(f"Restored {len(rows)} conversations")
+
+async def flush_conversations():
+    saved, ended = conversations.drain()
+    if saved or ended:
+        await db.write(storage.save_conversations, saved, ended)
+
+async def maintain_conversations():
+    # Expires idle records and writes changed ones in batches
+    while True:
+        await asyncio.sleep(convstate.CONV_FLUSH_INTERVAL)
+        conversations.sweep()
+        if conversations.persistent:
+            await flush_conversations()
+            await db.write(storage.purge_conversations, int(time.time()))
 
 # =======================
 # Bot Handlers
@@ -172,7 +332,8 @@ async def about(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------
 async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
-        "⚙️ Settings Menu:\n• Set Timezone - Configure your timezone\n• Set Reminders - Set two daily reminders",
+        "⚙️ Settings Menu:\n• Set Timezone - Configure your timezone\n• Set Reminders - Set two daily reminders\n"
+        "• Import - Add past readings from text or a CSV/XLSX file",
         reply_markup=SETTINGS_MENU
     )
 
@@ -192,27 +353,16 @@ async def timezone_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if user_input == "Cancel":
         await update.message.reply_text("❌ Timezone setup cancelled.", reply_markup=MAIN_MENU)
-        return ConversationHandler.END
-    
-    # Map common city names to timezone names
-    timezone_map = {
-        "New York": "America/New_York",
-        "London": "Europe/London",
-        "Berlin": "Europe/Berlin",
-        "Tokyo": "Asia/Tokyo",
-        "Moscow": "Europe/Moscow",
-        "Sydney": "Australia/Sydney",
-        "Los Angeles": "America/Los_Angeles"
-    }
+        return END
     
-    if user_input in timezone_map:
-        timezone_name = timezone_map[user_input]
-        set_user_timezone(user_id, timezone_name)
+    if user_input in TIMEZONE_BUTTONS:
+        timezone_name = TIMEZONE_BUTTONS[user_input]
+        await set_user_timezone(user_id, timezone_name)
         await update.message.reply_text(
             f"✅ Timezone set to {user_input} ({timezone_name})",
             reply_markup=MAIN_MENU
         )
-        return ConversationHandler.END
+        return END
     
     elif user_input == "Other":
         await update.message.reply_text(
@@ -222,16 +372,17 @@ async def timezone_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return SET_TIMEZONE
     
     else:
-        # Check if it's a valid timezone
-        if user_input in available_timezones():
-            set_user_timezone(user_id, user_input)
+        # Exact key, city, abbreviation or UTC offset; otherwise suggestions
+        timezone_name, matches = timezones.default_resolver(TIMEZONE_BUTTONS).resolve(user_input)
+        if timezone_name:
+            await set_user_timezone(user_id, timezone_name)
+            label = timezone_name if timezone_name == user_input else f"{user_input} ({timezone_name})"
             await update.message.reply_text(
-                f"✅ Timezone set to {user_input}",
+                f"✅ Timezone set to {label}",
                 reply_markup=MAIN_MENU
             )
-            return ConversationHandler.END
+            return END
         else:
-            matches = difflib.get_close_matches(user_input, available_timezones(), n=5)
             if matches:
                 await update.message.reply_text(
                     f"⚠️ Timezone not found. Did you mean?\n- " + "\n- ".join(matches),
@@ -260,7 +411,7 @@ async def reminders_received(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     if user_input == "Cancel":
         await update.message.reply_text("❌ Reminder setup cancelled.", reply_markup=MAIN_MENU)
-        return ConversationHandler.END
+        return END
     
     if user_input == "Custom Times":
         await update.message.reply_text(
@@ -314,12 +465,12 @@ async def process_reminder_times(update: Update, context: ContextTypes.DEFAULT_T
             return SET_REMINDERS
     
     if len(valid_times) == 2:
-        set_user_reminders(user_id, valid_times)
+        await set_user_reminders(user_id, valid_times)
         await update.message.reply_text(
             f"✅ Reminders set for {valid_times[0]} and {valid_times[1]} daily!",
             reply_markup=MAIN_MENU
         )
-        return ConversationHandler.END
+        return END
     else:
         await update.message.reply_text(
             "⚠️ Please provide exactly two valid times.",
@@ -332,98 +483,105 @@ async def process_reminder_times(update: Update, context: ContextTypes.DEFAULT_T
 # -----------------------
 async def delete_entry_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    entries = get_entries_from_db(user_id)
-    
-    if not entries:
+    page = await get_entries_page(user_id)
+
+    if not page['rows']:
         await update.message.reply_text("🔭 No entries to delete.", reply_markup=MAIN_MENU)
-        return ConversationHandler.END
-    
-    # Store entries in context for later reference
-    context.user_data['delete_entries'] = entries
-    
+        return END
+
+    return await send_delete_page(update, context, page)
+
+async def send_delete_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page):
+    rows = page['rows']
+    # Only the visible page is kept; numbers map to these ids
+    user_id = update.message.from_user.id
+    conv = conversations.get(user_id, "delete") or convstate.Conversation("delete")
+    conv.ids = tuple(r[0] for r in rows)
+    conv.newer, conv.older = page['newer'], page['older']
+    conversations.save(user_id, conv)
+
     # Create a numbered list for selection
-    delete_keyboard = []
-    row = []
-    for i, (eid, dt, bp, pulse, comment) in enumerate(entries, 1):
-        row.append(str(i))
-        if i % 5 == 0:  # 5 buttons per row
-            delete_keyboard.append(row)
-            row = []
-    if row:  # Add remaining buttons
-        delete_keyboard.append(row)
-    delete_keyboard.append(["Cancel"])
-    
+    numbers = [str(i) for i in range(1, len(rows) + 1)]
+    delete_keyboard = [numbers[i:i + 5] for i in range(0, len(numbers), 5)]  # 5 buttons per row
+    delete_keyboard.append(page_nav_row(page) + ["Cancel"])
     delete_menu = ReplyKeyboardMarkup(delete_keyboard, resize_keyboard=True, one_time_keyboard=True)
-    
-    # Show entries with numbers
-    msg = "🗑️ Select entry to delete:\n\n"
-    for i, (eid, dt, bp, pulse, comment) in enumerate(entries, 1):
-        msg += f"{i}. {dt} - BP: {bp} | Pulse: {pulse}\n"
-    
-    await update.message.reply_text(msg, reply_markup=delete_menu)
+
+    lines = ["🗑️ Select entry to delete:\n"]
+    for i, (eid, dt, bp, pulse, comment, ts) in enumerate(rows, 1):
+        lines.append(f"{i}. {dt} - BP: {bp} | Pulse: {pulse}")
+
+    await update.message.reply_text("\n".join(lines), reply_markup=delete_menu)
     return DELETE_ENTRY
 
 async def delete_entry_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_input = update.message.text.strip()
     user_id = update.message.from_user.id
-    
+    state = await get_conversation(user_id, "delete")
+
     if user_input == "Cancel":
         await update.message.reply_text("❌ Delete cancelled.", reply_markup=MAIN_MENU)
-        return ConversationHandler.END
-    
+        return END
+
+    if user_input in (NEWER_BUTTON, OLDER_BUTTON):
+        page = await get_entries_page(user_id, state, user_input)
+        if page['rows']:
+            return await send_delete_page(update, context, page)
+        await update.message.reply_text("🔭 No more entries.", reply_markup=MAIN_MENU)
+        return END
+
+    ids = state.ids
+
     # Validate that input is a number
     if not user_input.isdigit():
         await update.message.reply_text("⚠️ Please select a number from the list.", reply_markup=MAIN_MENU)
-        return ConversationHandler.END
-    
+        return END
+
     entry_number = int(user_input)
-    entries = context.user_data.get('delete_entries', [])
-    
+
     # Validate entry number range
-    if entry_number < 1 or entry_number > len(entries):
-        await update.message.reply_text(f"⚠️ Please select a number between 1 and {len(entries)}.", reply_markup=MAIN_MENU)
-        return ConversationHandler.END
-    
-    # Get the actual entry ID from the stored entries
-    selected_entry = entries[entry_number - 1]
-    entry_id = selected_entry[0]  # First element is the ID
-    
+    if entry_number < 1 or entry_number > len(ids):
+        await update.message.reply_text(f"⚠️ Please select a number between 1 and {len(ids)}.", reply_markup=MAIN_MENU)
+        return END
+
     # Delete the entry
-    if delete_entry(entry_id, user_id):
-        dt, bp, pulse, comment = selected_entry[1], selected_entry[2], selected_entry[3], selected_entry[4]
+    deleted = await delete_entry(ids[entry_number - 1], user_id)
+    if deleted:
+        dt, bp, pulse, comment = deleted
         await update.message.reply_text(
             f"✅ Entry deleted:\n{dt}\nBP: {bp} | Pulse: {pulse}\nNote: {comment}",
             reply_markup=MAIN_MENU
         )
     else:
         await update.message.reply_text("❌ Error deleting entry.", reply_markup=MAIN_MENU)
-    
-    return ConversationHandler.END
+
+    return END
 
 # -----------------------
 # Add conversation
 # -----------------------
 async def add_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data.clear()
+    conversations.start(update.message.from_user.id, "add")
     await update.message.reply_text("Please enter your blood pressure (e.g., 120/80):", reply_markup=MAIN_MENU)
     return BP
 
 async def bp_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['bp'] = update.message.text
+    conv = await get_conversation(update.message.from_user.id, "add")
+    conv.bp = update.message.text
     await update.message.reply_text("Enter your pulse (e.g., 72):", reply_markup=MAIN_MENU)
     return PULSE
 
 async def pulse_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['pulse'] = update.message.text
+    conv = await get_conversation(update.message.from_user.id, "add")
+    conv.pulse = update.message.text
     await update.message.reply_text("Add a short comment:", reply_markup=MAIN_MENU)
     return COMMENT
 
 async def comment_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    bp = context.user_data['bp']
-    pulse = context.user_data['pulse']
+    conv = await get_conversation(user_id, "add")
+    bp, pulse = conv.bp, conv.pulse
     comment = update.message.text
-    add_entry_to_db(user_id, bp, pulse, comment)
+    await add_entry_to_db(user_id, bp, pulse, comment)
     
     # Random donation message (10% chance)
     donation_text = ""
@@ -435,34 +593,102 @@ async def comment_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"✅ Entry saved:\nBP: {bp} | Pulse: {pulse}\nNote: {comment}{donation_text}",
         reply_markup=MAIN_MENU
     )
-    return ConversationHandler.END
+    return END
 
 
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("❌ Action cancelled.", reply_markup=MAIN_MENU)
-    return ConversationHandler.END
+# -----------------------
+# Bulk import conversation
+# -----------------------
+async def import_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "📥 Send past readings, one per line, in your timezone:\n\n"
+        "2024-01-15 08:30 120/80 72 Morning\n"
+        "2024-01-15 20:30 118/78 68\n\n"
+        "Or upload a CSV/XLSX file with DateTime, Blood Pressure, Pulse, Comment columns "
+        "(the same layout Export produces).",
+        reply_markup=CANCEL_MENU
+    )
+    return IMPORT_READINGS
+
+async def import_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    user_id = message.from_user.id
+
+    if message.text and message.text.strip() == "Cancel":
+        await message.reply_text("❌ Import cancelled.", reply_markup=MAIN_MENU)
+        return END
+
+    settings = await get_user_settings(user_id)
+    loop = asyncio.get_running_loop()
+    try:
+        if message.document:
+            if (message.document.file_size or 0) > ingest.MAX_DOCUMENT_BYTES:
+                await message.reply_text("⚠️ File is too large (max 2 MB).", reply_markup=CANCEL_MENU)
+                return IMPORT_READINGS
+            file = await message.document.get_file()
+            data = bytes(await file.download_as_bytearray())
+            records = await loop.run_in_executor(None, ingest.parse_document, message.document.file_name, data)
+        else:
+            records = await loop.run_in_executor(None, list, ingest.parse_text(message.text or ""))
+        rows, rejected = await loop.run_in_executor(None, ingest.validate, user_id, records, settings.tz)
+    except ValueError as e:
+        await message.reply_text(f"⚠️ {e}", reply_markup=CANCEL_MENU)
+        return IMPORT_READINGS
+
+    inserted = await import_entries_to_db(user_id, rows) if rows else 0
+    await message.reply_text(ingest.summarize(inserted, len(rows) - inserted, rejected), reply_markup=MAIN_MENU)
+    return END
 
 # -----------------------
 # Show entries
 # -----------------------
 async def show_entries(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    entries = get_entries_from_db(user_id)
-    if not entries:
+    page = await get_entries_page(user_id)
+    if not page['rows']:
         await update.message.reply_text("🔭 No entries yet.", reply_markup=MAIN_MENU)
         return
-    msg = "📖 Your diary:\n\n"
-    for i, (eid, dt, bp, pulse, comment) in enumerate(entries, 1):
-        msg += f"{i}. {dt}\nBP: {bp} | Pulse: {pulse}\nNote: {comment}\n\n"
-    await update.message.reply_text(msg, reply_markup=MAIN_MENU)
+    await send_show_page(update, context, page)
+
+async def show_entries_navigate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    state = await get_conversation(user_id, "show")
+    if state is None:
+        # The paging cursors expired or were evicted: start over from the newest
+        return await show_entries(update, context)
+    page = await get_entries_page(user_id, state, update.message.text)
+    if not page['rows']:
+        conversations.end(user_id)
+        await update.message.reply_text("🔭 No more entries.", reply_markup=MAIN_MENU)
+        return
+    await send_show_page(update, context, page)
+
+async def send_show_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page):
+    nav = page_nav_row(page)
+    user_id = update.message.from_user.id
+    if nav:
+        conv = conversations.get(user_id, "show") or convstate.Conversation("show")
+        conv.newer, conv.older = page['newer'], page['older']
+        conversations.save(user_id, conv)
+        markup = ReplyKeyboardMarkup([nav, ["Back to Main"]], resize_keyboard=True)
+    else:
+        conversations.end(user_id)
+        markup = MAIN_MENU
+
+    lines = ["📖 Your diary:\n"]
+    for i, (eid, dt, bp, pulse, comment, ts) in enumerate(page['rows'], 1):
+        if comment and len(comment) > COMMENT_PREVIEW:
+            comment = comment[:COMMENT_PREVIEW] + "…"
+        lines.append(f"{i}. {dt}\nBP: {bp} | Pulse: {pulse}\nNote: {comment}\n")
+    await update.message.reply_text("\n".join(lines), reply_markup=markup)
 
 # -----------------------
 # Status
 # -----------------------
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    tz = get_user_timezone(user_id)
-    reminders = get_user_reminders(user_id)
+    settings = await get_user_settings(user_id)
+    tz, reminders = settings.tz_name, settings.reminders
     
     msg = f"🌍 Timezone: {tz}\n"
     if reminders:
@@ -470,76 +696,140 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         msg += "⏰ No reminders set. Use Settings to configure."
     
-    # Add some stats
-    entries = get_entries_from_db(user_id)
-    if entries:
-        msg += f"\n📊 Total entries: {len(entries)}"
-        # Get today's entries
-        today = datetime.now().strftime("%Y-%m-%d")
-        today_entries = [e for e in entries if e[1].startswith(today)]
-        msg += f"\n📅 Today's entries: {len(today_entries)}"
+    # Add some stats; "today" is the user's calendar day
+    day_start, day_end = storage.local_day_bounds(settings.tz, datetime.now(settings.tz).date())
+    total, today, latest = await db.read(storage.get_status, user_id, day_start, day_end)
+    if total:
+        msg += f"\n📊 Total entries: {total}"
+        msg += f"\n📅 Today's entries: {today}"
+    if latest:
+        dt, bp, pulse = latest
+        msg += f"\n\nLast measurement: {bp} P:{pulse} ({dt})"
     
     await update.message.reply_text(msg, reply_markup=MAIN_MENU)
 
 # -----------------------
-# Reminders System
+# Analytics
 # -----------------------
-async def send_reminder(user_id: int, app: Application):
+async def show_analytics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    settings = await get_user_settings(user_id)
+    version = await db.read(storage.get_data_version, user_id)
+    # "Last 7 days" moves with the calendar, so the date is part of the key
+    key = (version, settings.tz_name, tuple(settings.reminders), datetime.now(settings.tz).date())
+
+    report = analytics_cache.get(user_id, key)
+    if report is not None:
+        await send_analytics(context.bot, user_id, report)
+        return
     try:
-        await app.bot.send_message(
-            user_id, 
-            "⏰ Time to measure your blood pressure! 💓\n\nUse the 'Add' button to record your measurement."
-        )
+        job = render_service.submit(user_id, analytics.render_report, user_id, settings.tz, settings.reminder_times)
+    except rendering.RenderBusy:
+        await update.message.reply_text("⏳ Still working on your previous request.", reply_markup=MAIN_MENU)
+        return
+    except rendering.RenderQueueFull:
+        await update.message.reply_text("⏳ The bot is busy, please try again in a minute.", reply_markup=MAIN_MENU)
+        return
+
+    # Rendered in the background so other users' updates are not held up
+    await update.message.reply_text("⏳ Building your analytics…", reply_markup=MAIN_MENU)
+    context.application.create_task(deliver_analytics(context.bot, user_id, key, job))
+
+async def deliver_analytics(bot, user_id, key, job):
+    try:
+        report = await job
+    except asyncio.CancelledError:
+        return
+    except Exception as e:
+        await bot.send_message(user_id, f"❌ Error building analytics: {e}", reply_markup=MAIN_MENU)
+        print(f"Analytics error: {e}")
+        return
+    analytics_cache.put(user_id, key, report)
+    try:
+        await send_analytics(bot, user_id, report)
     except Exception as e:
-        print(f"Failed reminder to {user_id}: {e}")
+        print(f"Analytics delivery error: {e}")
 
-last_sent = {}
+async def send_analytics(bot, user_id, report):
+    if report is None:
+        await bot.send_message(user_id, "🔭 No readings with a valid blood pressure yet.", reply_markup=MAIN_MENU)
+        return
+    text, chart = report
+    await bot.send_photo(user_id, photo=chart, caption=text, reply_markup=MAIN_MENU)
 
-async def schedule_reminders(app: Application):
-    while True:
-        users = get_all_users_with_reminders()
-        current_utc = datetime.utcnow()
-        
-        for user_id, tz_str, reminders_json in users:
-            try:
-                tz = ZoneInfo(tz_str) if tz_str else ZoneInfo("UTC")
-                user_time = current_utc.replace(tzinfo=ZoneInfo("UTC")).astimezone(tz)
-                
-                if user_id not in last_sent:
-                    last_sent[user_id] = {}
-                
-                reminders = json.loads(reminders_json)
-                
-                for reminder_time in reminders:
-                    # Check if it's time to send reminder
-                    h, m = map(int, reminder_time.split(':'))
-                    target_time = user_time.replace(hour=h, minute=m, second=0, microsecond=0)
-                    
-                    # Check if current time is within 1 minute of target time
-                    time_diff = (user_time - target_time).total_seconds()
-                    if abs(time_diff) < 60:  # Within 1 minute
-                        today_str = user_time.date().isoformat()
-                        
-                        if last_sent[user_id].get(reminder_time) != today_str:
-                            await send_reminder(user_id, app)
-                            last_sent[user_id][reminder_time] = today_str
-                            print(f"Sent reminder to {user_id} at {reminder_time}")
-                
-            except Exception as e:
-                print(f"Error processing reminders for user {user_id}: {e}")
-        
-        await asyncio.sleep(30)  # Check every 30 seconds
+async def check_rollups(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Verifies the user's daily/weekly rollups against their readings and
+    # rebuilds them on any mismatch
+    user_id = update.message.from_user.id
+    settings = await get_user_settings(user_id)
+    mismatches = await db.read(storage.verify_rollups, user_id)
+    if not mismatches:
+        await update.message.reply_text("✅ Summaries are up to date.", reply_markup=MAIN_MENU)
+        return
+    days, weeks = await db.write(storage.rebuild_rollups, user_id, settings.tz_name)
+    entries_changed(user_id)
+    print(f"Rollups for {user_id}: {len(mismatches)} stale buckets, rebuilt")
+    await update.message.reply_text(
+        f"🔧 Rebuilt summaries: {days} day(s), {weeks} week(s).", reply_markup=MAIN_MENU)
+
+# -----------------------
+# Reminders System
+# -----------------------
+async def send_reminder(user_id: int, app: Application):
+    # Errors propagate to the delivery queue, which retries or records them
+    await app.bot.send_message(
+        user_id,
+        "⏰ Time to measure your blood pressure! 💓\n\nUse the 'Add' button to record your measurement."
+    )
+
+async def schedule_reminders(app: Application, **queue_options):
+    # Loads every user once; later changes arrive through update_user().
+    # queue_options go to DeliveryQueue (bench/loadtest.py lifts the rates).
+    loaded_at = time.time() - scheduler.STARTUP_GRACE
+    for user_id, tz_str, reminders_json in await get_all_users_with_reminders():
+        try:
+            reminder_scheduler.update_user(user_id, tz_str, storage.load_reminders(reminders_json), now=loaded_at)
+        except Exception as e:
+            print(f"Error processing reminders for user {user_id}: {e}")
+
+    queue = delivery.DeliveryQueue(lambda user_id: send_reminder(user_id, app), **queue_options)
+    queue.start()
+
+    async def claim(due):
+        due = [d for d in due if not sent_cache.already_sent(d[1], d[2], d[0])]
+        if not due:
+            return
+        try:
+            claimed = await db.write(storage.claim_reminders, due)
+        except Exception as e:
+            print(f"Error claiming reminders: {e}")
+            return
+        for fire_at, user_id, slot in claimed:
+            sent_cache.mark(user_id, slot, fire_at)
+            queue.submit(user_id, fire_at)
+
+    async def send(due):
+        SCHEDULER_LAG.observe(max(0.0, time.time() - min(d[0] for d in due)))
+        start = time.perf_counter()
+        try:
+            await claim(due)
+        finally:
+            SCHEDULER_TICK_SECONDS.observe(time.perf_counter() - start)
+
+    try:
+        await reminder_scheduler.run(send)
+    finally:
+        await queue.stop()
 
 # -----------------------
 # Export conversation
 # -----------------------
 async def export_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "📤 Choose format to export:\n\n"
-        "⚠️ Note: PDF export may not display non-English/Latin characters correctly "
-        "(like Cyrillic, Arabic, Chinese, etc.). For these languages, please use CSV or XLSX format instead.",
-        reply_markup=EXPORT_MENU
-    )
+    text = "📤 Choose format to export:"
+    if not pdffonts.has_unicode_font():
+        text += ("\n\n⚠️ Note: PDF export may not display non-English/Latin characters correctly "
+                 "(like Cyrillic, Arabic, etc.). For these languages, please use CSV or XLSX format instead.")
+    await update.message.reply_text(text, reply_markup=EXPORT_MENU)
     return EXPORT_CHOOSE
 
 async def export_format_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -548,203 +838,443 @@ async def export_format_chosen(update: Update, context: ContextTypes.DEFAULT_TYP
     # Handle cancel
     if fmt == "cancel":
         await update.message.reply_text("❌ Export cancelled.", reply_markup=MAIN_MENU)
-        return ConversationHandler.END
+        return END
         
     if fmt not in ["csv", "xlsx", "pdf"]:
         await update.message.reply_text("❌ Invalid option. Export cancelled.", reply_markup=MAIN_MENU)
-        return ConversationHandler.END
+        return END
 
+    conv = conversations.start(update.message.chat_id, "export")
+    conv.fmt = fmt
+    await update.message.reply_text("📅 Which period?", reply_markup=EXPORT_RANGE_MENU)
+    return EXPORT_RANGE
+
+async def export_range_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    choice = update.message.text.strip()
+    if choice.lower() == "cancel":
+        return await export_cancel(update, context)
     chat_id = update.message.chat_id
-    entries = get_entries_from_db(chat_id)
-    if not entries:
-        await update.message.reply_text("📭 No entries to export.", reply_markup=MAIN_MENU)
-        return ConversationHandler.END
+    settings = await get_user_settings(chat_id)
+    if choice in EXPORT_RANGE_DAYS:
+        span = exporter.last_days_span(settings.tz, EXPORT_RANGE_DAYS[choice])
+    elif choice == "Since last export":
+        span = (await db.read(storage.get_export_watermark, chat_id), None)
+    elif choice == "All time":
+        span = (None, None)
+    elif choice == "Custom range":
+        await update.message.reply_text(
+            "Send the first and last day, e.g. 2024-01-01 2024-02-15 (or 01.01.2024 15.02.2024):",
+            reply_markup=CANCEL_MENU)
+        return EXPORT_CUSTOM
+    else:
+        await update.message.reply_text("❌ Invalid option. Export cancelled.", reply_markup=MAIN_MENU)
+        return END
+    return await start_export(update, context, span)
+
+async def export_custom_range(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.text.strip().lower() == "cancel":
+        return await export_cancel(update, context)
+    days = exporter.parse_range(update.message.text)
+    if days is None:
+        await update.message.reply_text("❌ Couldn't read the dates. Try e.g. 2024-01-01 2024-02-15:",
+                                        reply_markup=CANCEL_MENU)
+        return EXPORT_CUSTOM
+    settings = await get_user_settings(update.message.chat_id)
+    return await start_export(update, context, exporter.day_span(settings.tz, *days))
 
+async def start_export(update, context, span):
+    chat_id = update.message.chat_id
+    conv = await get_conversation(chat_id, "export")
+    fmt = conv.fmt
+    settings = await get_user_settings(chat_id)
+    names = exporter.export_names(fmt, span, settings.tz)
+    key = (chat_id, fmt, span)
+    version = await db.read(storage.get_data_version, chat_id)
+    if await send_cached_export(context.bot, chat_id, key, version, names):
+        return END
     try:
-        # Fix: Create DataFrame with correct columns (skip the ID column)
-        df = pd.DataFrame(entries, columns=["ID", "DateTime", "Blood Pressure", "Pulse", "Comment"])
-        # Remove the ID column for export
-        df = df.drop(columns=["ID"])
-        
-        buffer = BytesIO()
-        if fmt == "xlsx":
-            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='BP Diary')
-            buffer.seek(0)
-            filename = "blood_pressure_diary.xlsx"
-            caption = "📊 Excel format"
-        elif fmt == "pdf":
-            doc = SimpleDocTemplate(buffer, pagesize=A4)
-            styles = getSampleStyleSheet()
-            elements = [Paragraph("Blood Pressure Diary", styles["Heading1"])]
-            
-            # Prepare data for PDF table
-            data = [df.columns.tolist()] + df.values.tolist()
-            table = Table(data, repeatRows=1)
-            table.setStyle(TableStyle([
-                ('BACKGROUND', (0,0), (-1,0), colors.lightblue),
-                ('TEXTCOLOR',(0,0),(-1,0),colors.black),
-                ('ALIGN',(0,0),(-1,-1),'CENTER'),
-                ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0,0), (-1,0), 12),
-                ('FONTSIZE', (0,1), (-1,-1), 10),
-                ('BOTTOMPADDING', (0,0), (-1,0), 12),
-                ('BACKGROUND', (0,1), (-1,-1), colors.beige),
-                ('GRID', (0,0), (-1,-1), 1, colors.black),
-            ]))
-            elements.append(table)
-            doc.build(elements)
-            buffer.seek(0)
-            filename = "blood_pressure_diary.pdf"
-            caption = "📄 PDF format"
-        else:  # CSV
-            df.to_csv(buffer, index=False, encoding='utf-8')
-            buffer.seek(0)
-            filename = "blood_pressure_diary.csv"
-            caption = "📊 CSV format"
-
-        await update.message.reply_document(
-            document=buffer, 
-            filename=filename, 
-            caption=caption, 
-            reply_markup=MAIN_MENU
-        )
-        
+        job = render_service.submit(chat_id, exporter.render_export, chat_id, fmt, export_cache.directory, *span)
+    except rendering.RenderBusy:
+        await update.message.reply_text("⏳ Your previous export is still being prepared.", reply_markup=MAIN_MENU)
+        return END
+    except rendering.RenderQueueFull:
+        await update.message.reply_text("⏳ The bot is busy, please try again in a minute.", reply_markup=MAIN_MENU)
+        return END
+
+    await update.message.reply_text(
+        f"⏳ Preparing your {fmt.upper()} export… Send /cancel to stop it.", reply_markup=MAIN_MENU)
+    context.application.create_task(deliver_export(context.bot, key, version, names, job))
+    return END
+
+async def send_cached_export(bot, chat_id, key, version, names):
+    # Serves an export rendered for this exact data version, by file_id when
+    # Telegram already has it. Returns False on a cache miss.
+    cached = export_cache.get(key, version)
+    if cached is None:
+        return False
+    if cached.file_id:
+        try:
+            await bot.send_document(chat_id, document=cached.file_id, caption=names[1], reply_markup=MAIN_MENU)
+            await export_delivered(chat_id, cached.last_ts)
+            return True
+        except BadRequest as e:
+            print(f"Cached file_id rejected, uploading again: {e}")
+            cached.file_id = None
+    await upload_export(bot, key, version, names, cached)
+    return True
+
+async def upload_export(bot, key, version, names, cached):
+    filename, caption = names
+    with open(cached.path, "rb") as document:
+        message = await bot.send_document(key[0], document=document, filename=filename, caption=caption,
+                                          reply_markup=MAIN_MENU)
+    export_cache.set_file_id(key, version, message.document.file_id)
+    await export_delivered(key[0], cached.last_ts)
+
+async def export_delivered(chat_id, last_ts):
+    # Moves the "since last export" watermark past the newest reading in the
+    # file; readings saved after the render are newer and stay in the next one
+    if last_ts is not None:
+        await db.write(storage.set_export_watermark, chat_id, last_ts + 1)
+
+async def deliver_export(bot, key, version, names, job):
+    chat_id = key[0]
+    try:
+        result = await job
+    except asyncio.CancelledError:
+        return
     except Exception as e:
-        await update.message.reply_text(f"❌ Error during export: {str(e)}", reply_markup=MAIN_MENU)
+        await bot.send_message(chat_id, f"❌ Error during export: {str(e)}", reply_markup=MAIN_MENU)
         print(f"Export error: {e}")
-    
-    return ConversationHandler.END
+        return
+    if result is None:
+        await bot.send_message(chat_id, "📭 No entries to export for this period.", reply_markup=MAIN_MENU)
+        return
+
+    path, last_ts = result
+    try:
+        digest = await asyncio.to_thread(exporter.file_digest, path)
+        cached = export_cache.put(key, version, path, digest, last_ts)
+        await upload_export(bot, key, version, names, cached)
+    except Exception as e:
+        print(f"Export delivery error: {e}")
 
 async def export_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    conversations.end(update.message.chat_id)
     await update.message.reply_text("❌ Export cancelled.", reply_markup=MAIN_MENU)
-    return ConversationHandler.END
+    return END
+
+async def cancel_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /cancel outside a flow stops exports still being prepared
+    if render_service.cancel_user(update.message.chat_id):
+        await update.message.reply_text("❌ Export cancelled.", reply_markup=MAIN_MENU)
+    else:
+        await update.message.reply_text("Nothing to cancel.", reply_markup=MAIN_MENU)
 
 # -----------------------
-# Main menu button handler
+# Main menu buttons
 # -----------------------
-async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text
-    if text == "Add":
-        # Start the add conversation
-        context.user_data.clear()
-        await update.message.reply_text("Please enter your blood pressure (e.g., 120/80):", reply_markup=MAIN_MENU)
-        return BP
-    elif text == "Show":
-        await show_entries(update, context)
-    elif text == "Export":
-        await export_start(update, context)
-        return EXPORT_CHOOSE
-    elif text == "Delete":
-        await delete_entry_start(update, context)
-        return DELETE_ENTRY
-    elif text == "Status":
-        await status(update, context)
-    elif text == "Settings":
-        await settings_menu(update, context)
-    elif text == "Back to Main":
-        await update.message.reply_text("↩️ Back to main menu", reply_markup=MAIN_MENU)
-    
-    return ConversationHandler.END
+async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    conversations.end(update.message.from_user.id)
+    await update.message.reply_text("↩️ Back to main menu", reply_markup=MAIN_MENU)
+
+CANCEL_MESSAGES = {
+    "add": "❌ Action cancelled.", "timezone": "❌ Timezone setup cancelled.",
+    "reminders": "❌ Reminder setup cancelled.", "import": "❌ Import cancelled.",
+    "delete": "❌ Delete cancelled.", "export": "❌ Export cancelled.",
+}
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /cancel ends the current step; outside one it stops pending exports
+    user_id = update.message.from_user.id
+    conv = await get_conversation(user_id)
+    if conv is None or conv.step is None:
+        return await cancel_jobs(update, context)
+    conversations.end(user_id)
+    await update.message.reply_text(CANCEL_MESSAGES[conv.kind], reply_markup=MAIN_MENU)
+    return END
+
+# =======================
+# Routing
+# =======================
+# Every text message and document goes through one Router: commands and menu
+# labels are dict lookups, and a user in the middle of a flow is routed by the
+# step stored in `conversations`, which is the only conversation state.
+MAIN_MENU_BUTTONS = {"Add", "Show", "Export", "Delete", "Status", "Analytics", "Settings"}
+
+STEP_HANDLERS = {
+    "bp": bp_received, "pulse": pulse_received, "comment": comment_received,
+    "timezone": timezone_received, "reminders": reminders_received, "import": import_received,
+    "delete": delete_entry_selected,
+    "export_format": export_format_chosen, "export_range": export_range_chosen, "export_custom": export_custom_range,
+}
+
+def build_router():
+    routes = router.Router(get_conversation, conversations.end, conversations.step_expired)
+    add = track("add", add_entry)
+    export = track("export", export_start)
+    delete = track("delete", delete_entry_start)
+    set_timezone = track("timezone", set_timezone_start)
+    set_reminders = track("reminders", set_reminders_start)
+    import_readings = track("import", import_start)
+
+    for name, handler in (
+        ("start", start), ("about", about), ("add", add), ("show", show_entries), ("status", status),
+        ("analytics", show_analytics), ("rollups", check_rollups), ("cancel", cancel),
+        ("timezone", set_timezone), ("remind", set_reminders), ("import", import_readings),
+        ("delete", delete), ("export", export),
+    ):
+        routes.command(name, handler)
+
+    for label, handler in (
+        ("Add", add), ("Show", show_entries), ("Export", export), ("Delete", delete), ("Status", status),
+        ("Analytics", show_analytics), ("Settings", settings_menu), ("Set Timezone", set_timezone),
+        ("Set Reminders", set_reminders), ("Import", import_readings), ("Back to Main", back_to_main),
+        (NEWER_BUTTON, show_entries_navigate), (OLDER_BUTTON, show_entries_navigate),
+    ):
+        routes.button(label, handler)
+
+    for step, handler in STEP_HANDLERS.items():
+        routes.step(step, track(STEP_KINDS[step], handler), documents=step == "import")
+    routes.on_expired(conversation_expired)
+    routes.interrupt_on(MAIN_MENU_BUTTONS)
+    return routes
+
+# =======================
+# Metrics
+# =======================
+# Handler, database, render and delivery metrics are recorded where they
+# happen; these cover the event loop and scheduler and expose a few sizes.
+LOOP_LAG_INTERVAL = 0.5
+
+EVENT_LOOP_LAG = metrics.Histogram("bp_event_loop_lag_seconds", "How late the event loop resumed a sleeping task")
+SCHEDULER_TICK_SECONDS = metrics.Histogram(
+    "bp_scheduler_tick_seconds", "Time to claim and queue the reminders due on one scheduler wakeup")
+SCHEDULER_LAG = metrics.Histogram(
+    "bp_scheduler_lag_seconds", "How long after its target time the scheduler picked up a due reminder",
+    buckets=metrics.LATENESS_BUCKETS)
+metrics.Gauge("bp_conversations", "Conversation records in memory", fn=lambda: len(conversations))
+metrics.Gauge("bp_conversations_high_water", "Most conversation records held in memory at once",
+              fn=lambda: conversations.high_water)
+metrics.Gauge("bp_conversations_high_water_bytes", "Most memory the conversation records used at once",
+              fn=lambda: conversations.high_water_bytes)
+metrics.Gauge("bp_settings_cache_entries", "User settings held in the settings cache", fn=lambda: len(settings_cache))
+metrics.Counter("bp_settings_cache_hits_total", "Settings lookups served from the cache",
+                fn=lambda: settings_cache.hits)
+metrics.Counter("bp_settings_cache_misses_total", "Settings lookups that went to the database",
+                fn=lambda: settings_cache.misses)
+metrics.Gauge("bp_render_queue", "Render jobs waiting for a worker", fn=lambda: render_service.pending())
+metrics.Gauge("bp_export_cache_bytes", "Disk used by cached exports",
+              fn=lambda: export_cache.bytes if export_cache is not None else 0)
+
+async def monitor_event_loop():
+    # Anything that blocks the loop shows up as a late wakeup here
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+# =======================
+# Lifecycle
+# =======================
+async def on_startup(app: Application):
+    global export_cache
+    export_cache = exporter.ExportCache(EXPORT_CACHE_DIR, max_bytes=EXPORT_CACHE_MB * 1024 * 1024)
+    render_service.start()
+    if not pdffonts.has_unicode_font():
+        print("No DejaVu/Noto font found (set PDF_FONT_DIR); PDF exports will show Latin text only")
+    if conversations.persistent:
+        await load_conversations()
+    app.bot_data['background_tasks'] = [
+        asyncio.create_task(schedule_reminders(app)),
+        asyncio.create_task(maintain_conversations()),
+    ]
+    if SHARD == 0:
+        # Table-wide maintenance runs in one worker only
+        app.bot_data['background_tasks'].append(asyncio.create_task(backfill_entries()))
+    if METRICS_PORT:
+        metrics.enable()
+        app.bot_data['background_tasks'].append(asyncio.create_task(monitor_event_loop()))
+        app.bot_data['metrics_server'] = metrics.serve(METRICS_LISTEN, METRICS_PORT)
+        print(f"Metrics on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+async def on_shutdown(app: Application):
+    tasks = app.bot_data.pop('background_tasks', [])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    server = app.bot_data.pop('metrics_server', None)
+    if server is not None:
+        await asyncio.to_thread(server.shutdown)
+        server.server_close()
+    await render_service.stop()
+    if conversations.persistent:
+        await flush_conversations()
+    print(f"Conversation store: {conversations.stats()}")
+    print(f"Settings cache: {settings_cache.stats()}")
+    db.close()
+
+# =======================
+# Webhook mode
+# =======================
+# PTB's webhook server (python-telegram-bot[webhooks], tornado) receives the
+# updates and checks the secret token; it registers the webhook on start.
+def webhook_options():
+    return dict(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH, webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+
+def stop_event():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+# =======================
+# Sharded mode
+# =======================
+# BOT_WORKERS > 1, see sharding.py. The ingress process only receives and
+# routes updates; each worker is a full bot for its share of the users.
+POLL_TIMEOUT = 30
+
+def configure_shard(shard, shards):
+    global SHARD, SHARDS, reminder_scheduler, render_service, EXPORT_CACHE_DIR, METRICS_PORT
+    SHARD, SHARDS = shard, shards
+    reminder_scheduler = scheduler.ReminderScheduler(shard, shards)
+    # The render processes are shared out between the workers
+    render_service = rendering.RenderService(
+        DATABASE_URL, workers=max(1, rendering.RENDER_WORKERS // shards), warmup=(pdffonts.register_fonts,))
+    # An export cache clears its directory on start, so each worker has its own
+    EXPORT_CACHE_DIR = os.path.join(EXPORT_CACHE_DIR, f"shard{shard}")
+    if METRICS_PORT:
+        METRICS_PORT += shard
+
+def run_worker(shard, shards, connection):
+    # Worker process entry point (sharding.Supervisor target)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # ingress stops the workers in order
+    configure_shard(shard, shards)
+    timezones.default_resolver(TIMEZONE_BUTTONS)
+    asyncio.run(serve_worker(connection))
+
+async def serve_worker(connection):
+    app = build_application()
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+    loop = asyncio.get_running_loop()
+    done = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, done.set)
+    # The worker only takes an update off its pipe when it has a free slot,
+    # so its backlog waits in ingress and a crash loses only what was in flight
+    slots = threading.Semaphore(CONCURRENT_UPDATES)
+    running = set()
+
+    async def process(update):
+        try:
+            await app.update_processor.process_update(update, app.process_update(update))
+        finally:
+            slots.release()
+
+    def start(update):
+        task = loop.create_task(process(update))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+    def feed():
+        # Blocking pipe reads stay off the event loop; None (or the ingress
+        # going away) means stop
+        while True:
+            slots.acquire()
+            try:
+                data = connection.recv()
+            except EOFError:
+                break
+            if data is None:
+                break
+            loop.call_soon_threadsafe(start, Update.de_json(data, app.bot))
+        loop.call_soon_threadsafe(done.set)
+
+    threading.Thread(target=feed, name="worker-feed", daemon=True).start()
+    print(f"Worker {SHARD}/{SHARDS} ready (pid {os.getpid()})")
+    try:
+        await done.wait()
+    finally:
+        await asyncio.gather(*running, return_exceptions=True)
+        await app.stop()
+        await on_shutdown(app)
+        await app.shutdown()
+
+async def run_ingress():
+    supervisor = sharding.Supervisor(run_worker, BOT_WORKERS)
+    supervisor.start()
+    bot = Bot(TOKEN, base_url=BOT_API_URL) if BOT_API_URL else Bot(TOKEN)
+    # PTB's Updater polls or runs the webhook server into a queue, drained
+    # here into the workers
+    updater = Updater(bot, asyncio.Queue())
+    await updater.initialize()
+
+    async def route():
+        while True:
+            update = await updater.update_queue.get()
+            try:
+                await supervisor.dispatch(update.to_dict(), sharding.route_key(update))
+            finally:
+                updater.update_queue.task_done()
+
+    stop = stop_event()
+    tasks = [asyncio.create_task(supervisor.monitor()), asyncio.create_task(route())]
+    if BOT_MODE == "webhook":
+        await updater.start_webhook(**webhook_options())
+    else:
+        await updater.start_polling(timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES)
+    try:
+        await stop.wait()
+    finally:
+        await updater.stop()
+        # Updates already received still go to the workers
+        try:
+            await asyncio.wait_for(updater.update_queue.join(), sharding.STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Ingress: {updater.update_queue.qsize()} updates not routed")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.to_thread(supervisor.stop)
+        print(f"Ingress: {supervisor.stats()}")
+        await updater.shutdown()
 
 # =======================
 # Main
 # =======================
-if __name__ == "__main__":
-    init_db()
-    # REPLACE THIS WITH YOUR ACTUAL BOT TOKEN FROM BOTFATHER
-    TOKEN = "MYAU"  # Replace with your actual token
-    app = Application.builder().token(TOKEN).build()
-
-    # /add conversation
-    add_conv = ConversationHandler(
-        entry_points=[
-            CommandHandler("add", add_entry),
-            MessageHandler(filters.Regex("^(Add)$"), add_entry)
-        ],
-        states={
-            BP: [MessageHandler(filters.TEXT & ~filters.COMMAND, bp_received)],
-            PULSE: [MessageHandler(filters.TEXT & ~filters.COMMAND, pulse_received)],
-            COMMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, comment_received)]
-        },
-        fallbacks=[CommandHandler("cancel", cancel)],
-        allow_reentry=True
-    )
-    app.add_handler(add_conv)
-
-    # Timezone setup conversation
-    timezone_conv = ConversationHandler(
-        entry_points=[
-            MessageHandler(filters.Regex("^(Set Timezone)$"), set_timezone_start)
-        ],
-        states={
-            SET_TIMEZONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, timezone_received)]
-        },
-        fallbacks=[CommandHandler("cancel", cancel)],
-        allow_reentry=True
-    )
-    app.add_handler(timezone_conv)
-
-    # Reminders setup conversation
-    reminders_conv = ConversationHandler(
-        entry_points=[
-            MessageHandler(filters.Regex("^(Set Reminders)$"), set_reminders_start)
-        ],
-        states={
-            SET_REMINDERS: [MessageHandler(filters.TEXT & ~filters.COMMAND, reminders_received)]
-        },
-        fallbacks=[CommandHandler("cancel", cancel)],
-        allow_reentry=True
-    )
-    app.add_handler(reminders_conv)
-
-    # Delete conversation
-    delete_conv = ConversationHandler(
-        entry_points=[
-            CommandHandler("delete", delete_entry_start),
-            MessageHandler(filters.Regex("^(Delete)$"), delete_entry_start)
-        ],
-        states={
-            DELETE_ENTRY: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_entry_selected)]
-        },
-        fallbacks=[CommandHandler("cancel", cancel)],
-        allow_reentry=True
-    )
-    app.add_handler(delete_conv)
-
-    # /export conversation
-    export_conv = ConversationHandler(
-        entry_points=[
-            CommandHandler("export", export_start),
-            MessageHandler(filters.Regex("^(Export)$"), export_start)
-        ],
-        states={
-            EXPORT_CHOOSE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, export_format_chosen)
-            ]
-        },
-        fallbacks=[
-            MessageHandler(filters.Regex("^(Cancel|cancel)$"), export_cancel),
-            CommandHandler("cancel", export_cancel)
-        ],
-        allow_reentry=True
-    )
-    app.add_handler(export_conv)
+def build_application(request=None):
+    builder = Application.builder().token(TOKEN).concurrent_updates(CONCURRENT_UPDATES)
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL)
+    if request is not None:
+        # Custom transport, e.g. the fake Bot API in bench/dispatch.py
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.post_init(on_startup).post_shutdown(on_shutdown).build()
 
-    # Command handlers
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("about", about))
-    app.add_handler(CommandHandler("show", show_entries))
-    app.add_handler(CommandHandler("status", status))
-    app.add_handler(CommandHandler("timezone", set_timezone_start))
-    app.add_handler(CommandHandler("remind", set_reminders_start))
+    # One handler for every message; the router does the dispatching
+    app.add_handler(MessageHandler(filters.TEXT | filters.Document.ALL, build_router().dispatch))
 
-    # Main menu buttons
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, main_menu_handler))
+    return app
 
-    # Start reminders
-    asyncio.get_event_loop().create_task(schedule_reminders(app))
+if __name__ == "__main__":
+    if BOT_MODE == "webhook" and not WEBHOOK_URL and not BOT_API_URL:
+        # PTB would register http://listen:port/path, which Telegram rejects
+        sys.exit("WEBHOOK_URL must be set in webhook mode, e.g. https://example.org/telegram")
+    init_db()
+    if BOT_WORKERS > 1:
+        print(f"Bot is starting with {BOT_WORKERS} workers...")
+        asyncio.run(run_ingress())
+    else:
+        timezones.default_resolver(TIMEZONE_BUTTONS)
+        app = build_application()
 
-    # Run bot
-    print("Bot is starting...")
-    app.run_polling()
+        print("Bot is starting...")
+        if BOT_MODE == "webhook":
+            app.run_webhook(**webhook_options())
+        else:
+            app.run_polling()
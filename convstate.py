@@ -0,0 +1,192 @@
+import json
+import sys
+import time
+from collections import OrderedDict
+
+CONV_MAX_USERS = 50000
+CONV_TTL = 900  # seconds a conversation may sit idle
+CONV_EXPIRED_TTL = 3600  # seconds a timed-out step is remembered, to answer the next input
+CONV_FLUSH_INTERVAL = 5  # seconds between writes of changed records to SQLite
+
+
+class Conversation:
+    # One record per user: which flow they're in, the step they're at and the
+    # few values the flow carries between messages.
+    __slots__ = ("kind", "step", "expires", "bp", "pulse", "fmt", "ids", "newer", "older", "nbytes")
+
+    FIELDS = ("kind", "step", "bp", "pulse", "fmt", "ids", "newer", "older")
+
+    def __init__(self, kind, step=None):
+        self.kind = kind
+        self.step = step
+        self.expires = 0
+        self.bp = self.pulse = self.fmt = None
+        self.ids = self.newer = self.older = None
+        self.nbytes = 0
+
+    def to_json(self):
+        return json.dumps([getattr(self, f) for f in self.FIELDS], ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, data, expires):
+        values = dict(zip(cls.FIELDS, json.loads(data)))
+        conv = cls(values.pop("kind"))
+        for name, value in values.items():
+            # JSON turns the (ts, id) cursors and id tuples into lists
+            setattr(conv, name, tuple(value) if isinstance(value, list) else value)
+        conv.expires = expires
+        return conv
+
+    def size(self):
+        total = sys.getsizeof(self)
+        for name in ("bp", "pulse", "ids", "newer", "older"):
+            value = getattr(self, name)
+            if value is not None:
+                total += sys.getsizeof(value)
+        return total
+
+
+class ConversationStore:
+    # Bounded LRU of Conversation records with idle expiry. With persistent=True
+    # changed records are queued for SQLite (see drain()) and records pushed out
+    # of memory by the size bound stay loadable from there.
+    def __init__(self, maxsize=CONV_MAX_USERS, ttl=CONV_TTL, persistent=False, expired_ttl=CONV_EXPIRED_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.expired_ttl = expired_ttl
+        self.persistent = persistent
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._dirty = set()
+        self._unflushed = {}  # dirty records evicted before drain()
+        self._spilled = set()  # user ids only in SQLite
+        self._timed_out = OrderedDict()  # user id -> until when its expired step is remembered
+        self.high_water = 0
+        self.high_water_bytes = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, user_id, kind=None):
+        conv = self._data.get(user_id)
+        if conv is None:
+            return None
+        if conv.expires < time.time():
+            self._drop(user_id)
+            self._timed_out_at(user_id, conv)
+            self.expired += 1
+            return None
+        if kind is not None and conv.kind != kind:
+            return None
+        return conv
+
+    def needs_load(self, user_id):
+        return user_id in self._spilled
+
+    def step_expired(self, user_id):
+        # True for a while after the user's record timed out in the middle of
+        # a step, until they start or end another flow
+        self.get(user_id)  # a lapsed record not swept yet counts too
+        until = self._timed_out.get(user_id)
+        return until is not None and until >= time.time()
+
+    def _timed_out_at(self, user_id, conv):
+        if conv.step is None:
+            return
+        self._timed_out.pop(user_id, None)
+        self._timed_out[user_id] = conv.expires + self.expired_ttl
+        while len(self._timed_out) > self.maxsize:
+            self._timed_out.popitem(last=False)
+
+    def start(self, user_id, kind, step=None):
+        conv = Conversation(kind, step)
+        self.save(user_id, conv)
+        return conv
+
+    def save(self, user_id, conv):
+        # Call after changing a record; also refreshes its expiry
+        self._drop(user_id)
+        self._timed_out.pop(user_id, None)
+        conv.expires = time.time() + self.ttl
+        self._put(user_id, conv)
+        if self.persistent:
+            self._dirty.add(user_id)
+            self._unflushed.pop(user_id, None)
+        self.high_water = max(self.high_water, len(self._data))
+        self.high_water_bytes = max(self.high_water_bytes, self._bytes)
+
+    def restore(self, user_id, conv):
+        # A record loaded from SQLite (None if it was gone); not dirty
+        self._spilled.discard(user_id)
+        if conv is not None and conv.expires >= time.time():
+            self._put(user_id, conv)
+
+    def _put(self, user_id, conv):
+        conv.nbytes = conv.size()
+        self._data[user_id] = conv
+        self._bytes += conv.nbytes
+        self._spilled.discard(user_id)
+        while len(self._data) > self.maxsize:
+            evicted, old = self._data.popitem(last=False)
+            self._bytes -= old.nbytes
+            if self.persistent:
+                self._spilled.add(evicted)
+                if evicted in self._dirty:
+                    self._dirty.discard(evicted)
+                    self._unflushed[evicted] = old
+
+    def end(self, user_id):
+        spilled = user_id in self._spilled or self._unflushed.pop(user_id, None) is not None
+        self._spilled.discard(user_id)
+        self._timed_out.pop(user_id, None)
+        if (self._drop(user_id) or spilled) and self.persistent:
+            self._dirty.add(user_id)
+
+    def _drop(self, user_id):
+        conv = self._data.pop(user_id, None)
+        if conv is None:
+            return False
+        self._bytes -= conv.nbytes
+        return True
+
+    def sweep(self, now=None):
+        # Records are kept in last-touched order and share one TTL, so the
+        # expired ones are at the front
+        now = now or time.time()
+        removed = 0
+        while self._data:
+            user_id, conv = next(iter(self._data.items()))
+            if conv.expires >= now:
+                break
+            self._drop(user_id)
+            self._dirty.discard(user_id)
+            self._timed_out_at(user_id, conv)
+            removed += 1
+        self.expired += removed
+        while self._timed_out:
+            user_id, until = next(iter(self._timed_out.items()))
+            if until >= now:
+                break
+            del self._timed_out[user_id]
+        return removed
+
+    def drain(self):
+        # Changes since the last call: ([(user_id, expires, json)], [ended user_id])
+        saved, ended = [], []
+        for user_id in self._dirty:
+            conv = self._data.get(user_id)
+            if conv is None:
+                ended.append(user_id)
+            else:
+                saved.append((user_id, int(conv.expires), conv.to_json()))
+        for user_id, conv in self._unflushed.items():
+            saved.append((user_id, int(conv.expires), conv.to_json()))
+        self._dirty.clear()
+        self._unflushed.clear()
+        return saved, ended
+
+    def stats(self):
+        return {"size": len(self._data), "bytes": self._bytes, "high_water": self.high_water,
+                "high_water_bytes": self.high_water_bytes, "expired": self.expired,
+                "spilled": len(self._spilled), "dirty": len(self._dirty)}
@@ -0,0 +1,175 @@
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import metrics
+
+# =======================
+# Delivery settings
+# =======================
+# Telegram allows about 30 messages per second overall and one per second to
+# the same chat; stay a little under both.
+DELIVERY_WORKERS = 16
+GLOBAL_RATE = 25
+GLOBAL_BURST = 25
+PER_CHAT_RATE = 1
+PER_CHAT_BURST = 1
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+REMINDER_LATENESS = metrics.Histogram(
+    "bp_reminder_lateness_seconds", "Delay between a reminder's target time and its delivery",
+    buckets=metrics.LATENESS_BUCKETS)
+REMINDERS = metrics.Counter("bp_reminders_total", "Reminder deliveries by result", ("result",))
+
+
+class TokenBucket:
+    # Reservation-based: each caller books the next free token and sleeps
+    # until it is available, so concurrent workers never race for a token.
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def idle(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class SlotStats:
+    __slots__ = ("pending", "sent", "failed", "latencies")
+
+    def __init__(self):
+        self.pending = 0
+        self.sent = 0
+        self.failed = 0
+        self.latencies = []
+
+    def summary(self):
+        lat = sorted(self.latencies)
+        if lat:
+            p50 = lat[len(lat) // 2]
+            p99 = lat[min(len(lat) - 1, int(len(lat) * 0.99))]
+            return f"{self.sent} sent, {self.failed} failed, latency p50 {p50:.1f}s p99 {p99:.1f}s max {lat[-1]:.1f}s"
+        return f"{self.sent} sent, {self.failed} failed"
+
+
+class DeliveryQueue:
+    # Fans reminder sends out over a pool of workers while respecting the
+    # global and per-chat rate limits. Messages are grouped by their target
+    # fire time; when a group drains its latency/failure summary is printed.
+    def __init__(self, send, workers=DELIVERY_WORKERS, global_rate=GLOBAL_RATE, per_chat_rate=PER_CHAT_RATE,
+                 max_attempts=MAX_ATTEMPTS):
+        self._send = send
+        self._workers = workers
+        self._queue = asyncio.Queue()
+        self._global = TokenBucket(global_rate, GLOBAL_BURST)
+        self._per_chat_rate = per_chat_rate
+        self._chats = {}
+        self._max_attempts = max_attempts
+        self._paused_until = 0.0
+        self._tasks = []
+        self.slots = {}
+
+    def submit(self, chat_id, fire_at):
+        stats = self.slots.get(fire_at)
+        if stats is None:
+            stats = self.slots[fire_at] = SlotStats()
+        stats.pending += 1
+        self._queue.put_nowait((chat_id, fire_at))
+
+    def start(self):
+        for _ in range(self._workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def join(self):
+        await self._queue.join()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self._per_chat_rate, PER_CHAT_BURST)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            chat_id, fire_at = await self._queue.get()
+            try:
+                ok = await self._deliver(chat_id)
+            except Exception as e:
+                print(f"Failed reminder to {chat_id}: {e}")
+                ok = False
+            finally:
+                self._queue.task_done()
+            self._record(fire_at, ok)
+
+    async def _deliver(self, chat_id):
+        last_error = None
+        for attempt in range(self._max_attempts):
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self._global.acquire()
+            await self._chat_bucket(chat_id).acquire()
+            try:
+                await self._send(chat_id)
+                return True
+            except RetryAfter as e:
+                # Flood control applies to the whole bot: pause every worker
+                retry_after = e.retry_after
+                if hasattr(retry_after, "total_seconds"):
+                    retry_after = retry_after.total_seconds()
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                last_error = e
+            except (Forbidden, BadRequest) as e:
+                # Blocked, chat not found, message too long...: retrying won't
+                # help. BadRequest is a NetworkError, so this goes first.
+                print(f"Failed reminder to {chat_id}: {e}")
+                return False
+            except NetworkError as e:
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                last_error = e
+        print(f"Failed reminder to {chat_id} after {self._max_attempts} attempts: {last_error}")
+        return False
+
+    def _record(self, fire_at, ok):
+        stats = self.slots[fire_at]
+        stats.pending -= 1
+        if ok:
+            lateness = time.time() - fire_at
+            stats.sent += 1
+            stats.latencies.append(lateness)
+            REMINDER_LATENESS.observe(lateness)
+            REMINDERS.inc("sent")
+        else:
+            stats.failed += 1
+            REMINDERS.inc("failed")
+        if stats.pending == 0:
+            del self.slots[fire_at]
+            slot = datetime.fromtimestamp(fire_at, timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+            print(f"Reminder slot {slot}: {stats.summary()}")
@@ -0,0 +1,340 @@
+import csv
+import hashlib
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from openpyxl import Workbook
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
+from reportlab.lib.pagesizes import A4
+from reportlab.lib import colors
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+
+import metrics
+import pdffonts
+import storage
+from rendering import check_deadline
+
+# =======================
+# Export settings
+# =======================
+CHUNK_ROWS = 500
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_MAX_ENTRIES = 10000  # entries that only hold a file_id cost no disk
+TEMP_PREFIX = "bp_export_"
+CACHE_PREFIX = "export_"
+
+EXPORT_BYTES = metrics.Histogram("bp_export_bytes", "Size of rendered export files", ("format",),
+                                 buckets=metrics.BYTES_BUCKETS)
+EXPORT_CACHE = metrics.Counter("bp_export_cache_total", "Export cache lookups by result", ("result",))
+
+COLUMNS = ["DateTime", "Blood Pressure", "Pulse", "Comment"]
+SUMMARY_COLUMNS = ["Week of", "Readings", "Avg BP", "Systolic range", "Avg Pulse"]
+EXPORT_SQL = "SELECT datetime, bp, pulse, comment FROM bp_diary WHERE chat_id=? ORDER BY ts DESC, id DESC"
+# Served by idx_bp_diary_chat_ts; rows without a usable ts only appear in full exports
+EXPORT_RANGE_SQL = ("SELECT datetime, bp, pulse, comment FROM bp_diary "
+                    "WHERE chat_id=? AND ts >= ? AND ts < ? ORDER BY ts DESC, id DESC")
+MAX_TS = 2 ** 62
+LAST_TS_SQL = "SELECT MAX(ts) FROM bp_diary WHERE chat_id=? AND ts >= ? AND ts < ?"
+
+FORMATS = {
+    "csv": ("blood_pressure_diary.csv", "📊 CSV format"),
+    "xlsx": ("blood_pressure_diary.xlsx", "📊 Excel format"),
+    "pdf": ("blood_pressure_diary.pdf", "📄 PDF format"),
+}
+
+PDF_COL_WIDTHS = [95, 80, 50, 226]  # fits A4 between the default margins
+
+@lru_cache(maxsize=None)
+def pdf_styles():
+    # Built on first use, after pdffonts.register_fonts() picked the faces
+    regular, bold = pdffonts.base_font(), pdffonts.base_font(bold=True)
+    table = TableStyle([
+        ('BACKGROUND', (0,0), (-1,0), colors.lightblue),
+        ('TEXTCOLOR',(0,0),(-1,0),colors.black),
+        ('ALIGN',(0,0),(-1,-1),'CENTER'),
+        ('VALIGN',(0,0),(-1,-1),'MIDDLE'),
+        ('FONTNAME', (0,0), (-1,0), bold),
+        ('FONTNAME', (0,1), (-1,-1), regular),
+        ('FONTSIZE', (0,0), (-1,0), 12),
+        ('FONTSIZE', (0,1), (-1,-1), 10),
+        ('BOTTOMPADDING', (0,0), (-1,0), 12),
+        ('BACKGROUND', (0,1), (-1,-1), colors.beige),
+        ('GRID', (0,0), (-1,-1), 1, colors.black),
+    ])
+    comment = ParagraphStyle("Comment", fontName=regular, fontSize=10, leading=12, wordWrap="CJK")
+    return getSampleStyleSheet(), table, comment
+
+# =======================
+# Writers
+# =======================
+# Each writer consumes an iterator of row chunks and writes into a binary
+# file object, so no more than one chunk of rows is held in Python at once.
+class _Utf8Writer:
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, s):
+        return self.out.write(s.encode("utf-8"))
+
+def write_csv(out, chunks):
+    writer = csv.writer(_Utf8Writer(out))
+    writer.writerow(COLUMNS)
+    for chunk in chunks:
+        writer.writerows(chunk)
+
+def write_xlsx(out, chunks):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("BP Diary")
+    ws.append(COLUMNS)
+    for chunk in chunks:
+        for row in chunk:
+            ws.append(row)
+    wb.save(out)
+
+def weekly_summary_rows(weekly):
+    # bp_weekly rows, oldest first, formatted for the PDF summary table
+    fields = storage.ROLLUP_FIELDS
+    rows = []
+    for week, *values in weekly:
+        f = dict(zip(fields, values))
+        pulse = f"{f['pulse_sum'] / f['pulse_n']:.0f}" if f["pulse_n"] else "—"
+        rows.append([week, f["n"], f"{f['sys_sum'] / f['n']:.0f}/{f['dia_sum'] / f['n']:.0f}",
+                     f"{f['sys_min']}–{f['sys_max']}", pulse])
+    return rows
+
+def pdf_cell(value, style):
+    # Non-ASCII text becomes a wrapped Paragraph with a font per script
+    value = "" if value is None else str(value)
+    return value if value.isascii() and len(value) < 40 else Paragraph(pdffonts.markup(value), style)
+
+def pdf_row(row, style):
+    return [pdf_cell(value, style) for value in row]
+
+def write_pdf(out, chunks, weekly=None):
+    doc = SimpleDocTemplate(out, pagesize=A4)
+    styles, table_style, comment_style = pdf_styles()
+    elements = [Paragraph("Blood Pressure Diary", styles["Heading1"])]
+    if weekly:
+        elements.append(Paragraph("Weekly summary", styles["Heading2"]))
+        table = Table([SUMMARY_COLUMNS] + weekly_summary_rows(weekly), repeatRows=1)
+        table.setStyle(table_style)
+        elements += [table, Paragraph("Readings", styles["Heading2"])]
+    # One table per chunk keeps reportlab's row splitting cheap
+    for chunk in chunks:
+        table = Table([COLUMNS] + [pdf_row(row, comment_style) for row in chunk],
+                      colWidths=PDF_COL_WIDTHS, repeatRows=1)
+        table.setStyle(table_style)
+        elements.append(table)
+    doc.build(elements)
+
+WRITERS = {
+    "csv": write_csv,
+    "xlsx": write_xlsx,
+    "pdf": write_pdf,
+}
+
+# =======================
+# Export jobs
+# =======================
+def iter_chunks(cursor, first):
+    yield first
+    while True:
+        check_deadline()
+        chunk = cursor.fetchmany(CHUNK_ROWS)
+        if not chunk:
+            return
+        yield chunk
+
+def _temp_file(fmt, directory):
+    return tempfile.mkstemp(prefix=TEMP_PREFIX, suffix=os.path.splitext(FORMATS[fmt][0])[1], dir=directory)
+
+def copy_csv(conn, sql, params, directory):
+    # PostgreSQL writes the CSV itself (COPY ... TO STDOUT), so no rows pass
+    # through Python. Same columns as write_csv; lines end in \n and empty
+    # comments are written as "".
+    fd, path = _temp_file("csv", directory)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write((",".join(COLUMNS) + "\n").encode("utf-8"))
+            rows = conn.copy_csv(sql, params, out, check=check_deadline)
+    except BaseException:
+        os.unlink(path)
+        raise
+    if not rows:
+        os.unlink(path)
+        return None
+    return path
+
+def render_export(conn, chat_id, fmt, directory=None, since=None, until=None):
+    # Runs in a render worker process. Exports readings in [since, until)
+    # (epoch seconds, open when None). Returns (path, last_ts): a temporary
+    # file in `directory` the caller must delete or hand to ExportCache.put,
+    # and the newest ts it covers, for the "since last export" watermark.
+    # Returns None if there is nothing to export.
+    # Read before the rows: a reading saved in between is exported again
+    # next time rather than skipped
+    last_ts = conn.execute(LAST_TS_SQL, (chat_id, since or 1, until or MAX_TS)).fetchone()[0]
+    if since is None and until is None:
+        sql, params = EXPORT_SQL, (chat_id,)
+    else:
+        sql, params = EXPORT_RANGE_SQL, (chat_id, since or 1, until or MAX_TS)
+    if fmt == "csv" and storage.dialect(conn) == "postgresql":
+        path = copy_csv(conn, sql, params, directory)
+        return (path, last_ts) if path else None
+    with storage.stream(conn, sql, params) as cursor:
+        first = cursor.fetchmany(CHUNK_ROWS)
+        if not first:
+            return None
+        extra = {}
+        # The PDF opens with a per-week summary, read from the rollups once built
+        if fmt == "pdf" and storage.get_rollup_tz(conn, chat_id) is not None:
+            extra["weekly"] = storage.get_weekly_rollups(conn, chat_id, since, until)
+        fd, path = _temp_file(fmt, directory)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                WRITERS[fmt](out, iter_chunks(cursor, first), **extra)
+        except BaseException:
+            os.unlink(path)
+            raise
+    return path, last_ts
+
+
+# =======================
+# Ranges
+# =======================
+# A span is (since, until) in epoch seconds with None for an open end; it is
+# part of the cache key, so it's computed from whole local days.
+DATE_RE = re.compile(r"\d{4}-\d{1,2}-\d{1,2}|\d{1,2}\.\d{1,2}\.\d{4}")
+DATE_FORMATS = ("%Y-%m-%d", "%d.%m.%Y")
+
+def parse_day(text):
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    return None
+
+def parse_range(text):
+    # "2024-01-01 2024-02-15", "01.01.2024 - 15.02.2024" or a single day.
+    # Returns (first_day, last_day) or None.
+    days = [parse_day(token) for token in DATE_RE.findall(text or "")]
+    if not 1 <= len(days) <= 2 or None in days:
+        return None
+    return min(days), max(days)
+
+def day_span(tz, first_day, last_day):
+    return storage.local_day_bounds(tz, first_day)[0], storage.local_day_bounds(tz, last_day)[1]
+
+def last_days_span(tz, days, now=None):
+    today = (now or datetime.now(tz)).date()
+    return storage.local_day_bounds(tz, today - timedelta(days=days - 1))[0], None
+
+def export_names(fmt, span, tz):
+    # (filename, caption) for an export of `span`
+    filename, caption = FORMATS[fmt]
+    since, until = span
+    if since is None and until is None:
+        return filename, caption
+    first = datetime.fromtimestamp(since, tz).date() if since else None
+    last = datetime.fromtimestamp(until - 1, tz).date() if until else datetime.now(tz).date()
+    stem, ext = os.path.splitext(filename)
+    label = f"{first or '…'} – {last}"
+    return f"{stem}_{first or 'start'}_{last}{ext}", f"{caption} · {label}"
+
+
+# =======================
+# Export cache
+# =======================
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class CachedExport:
+    __slots__ = ("version", "digest", "path", "size", "last_ts", "file_id")
+
+    def __init__(self, version, digest, path, size, last_ts=None):
+        self.version = version
+        self.digest = digest
+        self.path = path
+        self.size = size
+        self.last_ts = last_ts
+        self.file_id = None
+
+
+class ExportCache:
+    # LRU of rendered exports keyed by (user, format, span), each valid for one
+    # data version (bp_summary.version). Files are stored once per content hash and
+    # file_id remembers Telegram's copy after the first upload, so a repeat
+    # export is a send_document(file_id) with no rendering or upload.
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES, max_entries=CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._refs = {}  # digest -> number of entries sharing the file
+        os.makedirs(directory, exist_ok=True)
+        # The index lives in memory, so files from an earlier run are orphans
+        for name in os.listdir(directory):
+            if name.startswith((TEMP_PREFIX, CACHE_PREFIX)):
+                os.unlink(os.path.join(directory, name))
+
+    def get(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None or entry.version != version:
+            self.misses += 1
+            EXPORT_CACHE.inc("miss")
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        EXPORT_CACHE.inc("hit")
+        return entry
+
+    def put(self, key, version, tmp_path, digest, last_ts=None):
+        # Takes ownership of tmp_path (a render_export result in self.directory)
+        path = os.path.join(self.directory, CACHE_PREFIX + digest + os.path.splitext(tmp_path)[1])
+        if digest in self._refs:
+            os.unlink(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+            self.bytes += os.path.getsize(path)
+        self._refs[digest] = self._refs.get(digest, 0) + 1
+        self._drop(key)
+        entry = self._entries[key] = CachedExport(version, digest, path, os.path.getsize(path), last_ts)
+        EXPORT_BYTES.observe(entry.size, key[1])
+        self._evict()
+        return entry
+
+    def set_file_id(self, key, version, file_id):
+        entry = self._entries.get(key)
+        if entry is not None and entry.version == version:
+            entry.file_id = file_id
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._refs[entry.digest] -= 1
+        if not self._refs[entry.digest]:
+            del self._refs[entry.digest]
+            self.bytes -= entry.size
+            if os.path.exists(entry.path):
+                os.unlink(entry.path)
+
+    def _evict(self):
+        while self._entries and (self.bytes > self.max_bytes or len(self._entries) > self.max_entries):
+            self._drop(next(iter(self._entries)))
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,125 @@
+import csv
+import io
+import re
+from datetime import datetime, timedelta
+
+from openpyxl import load_workbook
+
+import storage
+
+# =======================
+# Bulk import
+# =======================
+# Accepts readings as text lines or as the CSV/XLSX files produced by Export:
+#   2024-01-15 08:30 120/80 72 Morning
+#   15.01.2024 08:30, 120/80, 72, Morning
+MAX_ROWS = 5000
+MAX_DOCUMENT_BYTES = 2 * 1024 * 1024
+MAX_REPORTED_ERRORS = 10
+
+SYSTOLIC_RANGE = (50, 300)
+DIASTOLIC_RANGE = (30, 200)
+PULSE_RANGE = (20, 250)
+
+LINE_RE = re.compile(
+    r"^\s*(?P<date>\d{4}-\d{1,2}-\d{1,2}|\d{1,2}\.\d{1,2}\.\d{4})[\sT,;]+(?P<time>\d{1,2}:\d{2})"
+    r"[\s,;]+(?P<bp>\d{2,3}\s*/\s*\d{2,3})[\s,;]+(?P<pulse>\d{2,3})(?:[\s,;]+(?P<comment>.*?))?\s*$")
+DATE_FORMATS = ("%Y-%m-%d %H:%M", "%d.%m.%Y %H:%M", "%Y-%m-%d %H:%M:%S")
+HEADER = "datetime"
+
+
+def parse_when(value):
+    if isinstance(value, datetime):
+        return value.replace(second=0, microsecond=0, tzinfo=None)
+    text = " ".join(str(value or "").replace("T", " ").split())
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    return None
+
+def parse_text(text):
+    # Yields (line_no, when, bp, pulse, comment); unparsable lines get when=None
+    for line_no, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        m = LINE_RE.match(line)
+        if m is None:
+            yield line_no, None, None, None, line.strip()
+            continue
+        when = parse_when(f"{m.group('date')} {m.group('time')}")
+        yield line_no, when, m.group("bp"), m.group("pulse"), m.group("comment") or ""
+
+def _parse_cells(rows):
+    for line_no, row in enumerate(rows, 1):
+        cells = ["" if c is None else c for c in row]
+        if not any(str(c).strip() for c in cells):
+            continue
+        if line_no == 1 and str(cells[0]).strip().lower().replace(" ", "") == HEADER:
+            continue
+        cells += [""] * (4 - len(cells))
+        when, bp, pulse, comment = cells[:4]
+        yield line_no, parse_when(when), str(bp).strip(), str(pulse).strip(), str(comment).strip()
+
+def parse_csv(data):
+    text = data.decode("utf-8-sig", errors="replace")
+    return _parse_cells(csv.reader(io.StringIO(text)))
+
+def parse_xlsx(data):
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        return list(_parse_cells(ws.iter_rows(values_only=True)))
+    finally:
+        wb.close()
+
+def validate(chat_id, records, tz, now=None):
+    # Checks all records and returns (rows, rejected). rows are ready for
+    # storage.add_entries; rejected is a list of (line_no, reason).
+    now = now or datetime.now(tz)
+    latest = now + timedelta(days=1)
+    rows, rejected = [], []
+    for line_no, when, bp, pulse, comment in records:
+        if len(rows) + len(rejected) >= MAX_ROWS:
+            rejected.append((line_no, f"more than {MAX_ROWS} lines"))
+            break
+        if when is None:
+            rejected.append((line_no, "expected: YYYY-MM-DD HH:MM 120/80 72 [comment]"))
+            continue
+        systolic, diastolic = storage.parse_bp(bp)
+        pulse_bpm = storage.parse_pulse(pulse)
+        local = when.replace(tzinfo=tz)
+        if systolic is None or not SYSTOLIC_RANGE[0] <= systolic <= SYSTOLIC_RANGE[1] \
+                or not DIASTOLIC_RANGE[0] <= diastolic <= DIASTOLIC_RANGE[1] or diastolic >= systolic:
+            rejected.append((line_no, f"implausible blood pressure {bp!r}"))
+        elif pulse_bpm is None or not PULSE_RANGE[0] <= pulse_bpm <= PULSE_RANGE[1]:
+            rejected.append((line_no, f"implausible pulse {pulse!r}"))
+        elif local > latest:
+            rejected.append((line_no, "date is in the future"))
+        else:
+            rows.append((chat_id, when.strftime("%Y-%m-%d %H:%M"), f"{systolic}/{diastolic}", str(pulse_bpm),
+                         comment, int(local.timestamp()), systolic, diastolic, pulse_bpm))
+    return rows, rejected
+
+def parse_document(filename, data):
+    name = (filename or "").lower()
+    if name.endswith(".xlsx"):
+        return parse_xlsx(data)
+    if name.endswith(".csv"):
+        return list(parse_csv(data))
+    if name.endswith(".txt"):
+        return list(parse_text(data.decode("utf-8-sig", errors="replace")))
+    raise ValueError("unsupported file type; send a .csv, .xlsx or .txt file")
+
+def summarize(inserted, duplicates, rejected):
+    lines = [f"✅ Imported {inserted} reading(s)."]
+    if duplicates:
+        lines.append(f"↩️ Skipped {duplicates} already in your diary.")
+    if rejected:
+        lines.append(f"⚠️ Rejected {len(rejected)} line(s):")
+        for line_no, reason in rejected[:MAX_REPORTED_ERRORS]:
+            lines.append(f"  line {line_no}: {reason}")
+        if len(rejected) > MAX_REPORTED_ERRORS:
+            lines.append(f"  … and {len(rejected) - MAX_REPORTED_ERRORS} more")
+    return "\n".join(lines)
@@ -0,0 +1,139 @@
+import os
+import unicodedata
+from functools import lru_cache
+from xml.sax.saxutils import escape
+
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+from reportlab.pdfbase.ttfonts import TTFont
+
+try:
+    # Optional: joins and reorders Arabic/Hebrew; without it RTL text keeps
+    # its logical order
+    import arabic_reshaper
+    from bidi.algorithm import get_display
+except ImportError:
+    arabic_reshaper = None
+
+# =======================
+# PDF fonts
+# =======================
+# TrueType fonts are parsed once per process by register_fonts() (the render
+# workers call it at start-up); reportlab keeps the parsed faces and their
+# width tables in its registry, so later exports only look them up. Text is
+# split into runs per script and each run gets a font that has its glyphs.
+FONT_DIRS = [
+    os.environ.get("PDF_FONT_DIR", ""),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts"),
+    "/usr/share/fonts/truetype/dejavu",
+    "/usr/share/fonts/truetype/noto",
+    "/usr/share/fonts/noto",
+    "/usr/share/fonts/TTF",
+]
+
+# Registered name -> candidate files, first one found wins
+TTF_FONTS = {
+    "Sans": ["DejaVuSans.ttf", "NotoSans-Regular.ttf"],
+    "Sans-Bold": ["DejaVuSans-Bold.ttf", "NotoSans-Bold.ttf"],
+    "Arabic": ["NotoSansArabic-Regular.ttf", "NotoNaskhArabic-Regular.ttf", "DejaVuSans.ttf"],
+    "Hebrew": ["NotoSansHebrew-Regular.ttf", "DejaVuSans.ttf"],
+    "Devanagari": ["NotoSansDevanagari-Regular.ttf"],
+    "Thai": ["NotoSansThai-Regular.ttf"],
+}
+
+# CJK uses reportlab's built-in CID fonts, which need no font files
+CID_FONTS = {
+    "Han": "STSong-Light",
+    "Kana": "HeiseiMin-W3",
+    "Hangul": "HYSMyeongJo-Medium",
+}
+
+FALLBACK = {"Sans": "Helvetica", "Sans-Bold": "Helvetica-Bold"}
+
+# (first, last code point, script), checked in order
+SCRIPT_RANGES = [
+    (0x0590, 0x05FF, "Hebrew"),
+    (0x0600, 0x06FF, "Arabic"), (0x0750, 0x077F, "Arabic"), (0xFB50, 0xFDFF, "Arabic"), (0xFE70, 0xFEFF, "Arabic"),
+    (0x0900, 0x097F, "Devanagari"),
+    (0x0E00, 0x0E7F, "Thai"),
+    (0x1100, 0x11FF, "Hangul"), (0x3130, 0x318F, "Hangul"), (0xAC00, 0xD7AF, "Hangul"),
+    (0x3040, 0x30FF, "Kana"),
+    (0x2E80, 0x2FDF, "Han"), (0x3000, 0x303F, "Han"), (0x3400, 0x4DBF, "Han"), (0x4E00, 0x9FFF, "Han"),
+    (0xF900, 0xFAFF, "Han"), (0xFF00, 0xFFEF, "Han"),
+]
+
+_fonts = {}  # script -> registered font name
+
+
+def _find(filenames):
+    for filename in filenames:
+        for directory in FONT_DIRS:
+            path = os.path.join(directory, filename) if directory else ""
+            if path and os.path.exists(path):
+                return path
+    return None
+
+def has_unicode_font():
+    # Without a TrueType Sans the PDFs fall back to Helvetica, which only has
+    # Latin glyphs; CJK still works through the CID fonts
+    return _find(TTF_FONTS["Sans"]) is not None
+
+def register_fonts():
+    # Idempotent; returns {script: font name}
+    if _fonts:
+        return _fonts
+    loaded = {}  # path -> registered name, so one file is parsed once
+    for name, filenames in TTF_FONTS.items():
+        path = _find(filenames)
+        if path is None:
+            continue
+        if path not in loaded:
+            pdfmetrics.registerFont(TTFont(name, path))
+            loaded[path] = name
+        _fonts[name] = loaded[path]
+    for script, cid_name in CID_FONTS.items():
+        pdfmetrics.registerFont(UnicodeCIDFont(cid_name))
+        _fonts[script] = cid_name
+    for name, builtin in FALLBACK.items():
+        _fonts.setdefault(name, builtin)
+    return _fonts
+
+def base_font(bold=False):
+    return register_fonts()["Sans-Bold" if bold else "Sans"]
+
+@lru_cache(maxsize=4096)
+def script_of(char):
+    cp = ord(char)
+    if cp < 0x0590:
+        return "Sans"
+    for first, last, script in SCRIPT_RANGES:
+        if first <= cp <= last:
+            return script
+    return "Sans"
+
+def _shape(text, script):
+    if arabic_reshaper is not None and script in ("Arabic", "Hebrew"):
+        return get_display(arabic_reshaper.reshape(text) if script == "Arabic" else text)
+    return text
+
+def markup(text):
+    # Paragraph markup for `text` with a <font> per script run
+    fonts = register_fonts()
+    text = unicodedata.normalize("NFC", text or "")
+    if text.isascii():
+        return escape(text)
+    runs = []
+    for char in text:
+        script = script_of(char)
+        # Spaces and punctuation stay in the run they're in
+        if runs and (not char.isalnum() or script == runs[-1][0]):
+            runs[-1][1].append(char)
+        else:
+            runs.append((script, [char]))
+    base = fonts["Sans"]
+    parts = []
+    for script, chars in runs:
+        run = escape(_shape("".join(chars), script))
+        font = fonts.get(script, base)
+        parts.append(run if font == base else f'<font face="{font}">{run}</font>')
+    return "".join(parts)
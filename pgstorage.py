@@ -0,0 +1,152 @@
+import itertools
+from contextlib import contextmanager
+from functools import lru_cache
+
+import psycopg
+from psycopg_pool import ConnectionPool
+
+import storage
+
+# =======================
+# PostgreSQL backend
+# =======================
+# Selected by a postgresql:// DATABASE_URL (storage.open_database); needs
+# psycopg and psycopg-pool. The helpers in storage.py are shared with SQLite:
+# PgConnection gives a psycopg connection the sqlite3 calls they use, plus
+# COPY and server-side cursors for bulk work. Helpers run on the same reader
+# and writer threads as with SQLite, each call on a connection taken from a
+# pool that replaces connections broken by a server restart.
+POOL_TIMEOUT = 30  # seconds to wait for a free connection
+STREAM_ROWS = 2000  # rows per round trip of a server-side cursor
+COPY_TABLES = ("user_settings", "bp_summary", "bp_diary", "bp_daily", "bp_weekly", "reminder_sent", "conv_state")
+
+_cursor_names = itertools.count()
+
+
+def connect(url):
+    # A standalone connection in autocommit mode, so ad-hoc reads don't
+    # leave transactions open; migrate() and COPY open their own
+    return PgConnection(psycopg.connect(url, autocommit=True))
+
+@lru_cache(maxsize=1024)
+def _translate(sql):
+    # sqlite3's ? placeholders to psycopg's %s; a literal % becomes %%
+    return sql.replace("%", "%%").replace("?", "%s")
+
+
+class PgConnection:
+    dialect = "postgresql"
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def execute(self, sql, params=()):
+        return self.raw.execute(_translate(sql), params)
+
+    def executemany(self, sql, seq):
+        cursor = self.raw.cursor()
+        cursor.executemany(_translate(sql), seq)
+        return cursor
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self.raw.close()
+
+    def copy_rows(self, table, columns, rows):
+        # COPY FROM STDIN of an iterable of tuples; returns the row count
+        cursor = self.raw.cursor()
+        with cursor.copy(f"COPY {table} ({', '.join(columns)}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+        return cursor.rowcount
+
+    def copy_csv(self, sql, params, out, check=None):
+        # Writes the result of a query as CSV rows (no header) to a binary
+        # file; check() is called between blocks. Returns the row count.
+        cursor = self.raw.cursor()
+        with cursor.copy(f"COPY ({_translate(sql)}) TO STDOUT WITH (FORMAT csv)", params) as copy:
+            for block in copy:
+                if check is not None:
+                    check()
+                out.write(block)
+        return cursor.rowcount
+
+    @contextmanager
+    def server_cursor(self, sql, params=()):
+        # Named cursors only live inside a transaction; with autocommit this
+        # opens one, inside an open transaction it is a savepoint
+        with self.raw.transaction():
+            with self.raw.cursor(name=f"stream_{next(_cursor_names)}") as cursor:
+                cursor.itersize = STREAM_ROWS
+                cursor.execute(_translate(sql), params)
+                yield cursor
+
+
+class PostgresDatabase(storage.Database):
+    # Each read or write takes a pooled connection for one transaction,
+    # committed when the helper returns. Writes stay on a single thread as
+    # with SQLite: helpers like delete_entry read before they write and rely
+    # on running one at a time. With BOT_WORKERS each worker process has its
+    # own writer for its own users.
+    dialect = "postgresql"
+
+    def __init__(self, url, readers=storage.READ_WORKERS, batch_rows=storage.BATCH_ROWS,
+                 batch_window=storage.BATCH_WINDOW):
+        super().__init__(readers, batch_rows, batch_window)
+        self.url = url
+        self._pool = ConnectionPool(url, min_size=1, max_size=readers + 1, timeout=POOL_TIMEOUT,
+                                    name="bp-db", open=True)
+
+    def _open(self):
+        # For start-up work and the render processes
+        return connect(self.url)
+
+    def _read(self, fn, args):
+        with self._pool.connection() as raw:
+            return fn(PgConnection(raw), *args)
+
+    def _write(self, fn, args, durable=False):
+        # Commits are durable with the default synchronous_commit=on
+        with self._pool.connection() as raw:
+            return fn(PgConnection(raw), *args)
+
+    def close(self):
+        super().close()
+        self._pool.close()
+
+
+# =======================
+# Copying from SQLite
+# =======================
+def copy_from_sqlite(source, target, tables=COPY_TABLES, replace=False):
+    # Copies every table from a sqlite3 connection at the latest schema into
+    # a PgConnection (autocommit) with the PostgreSQL schema, in one
+    # transaction. The target tables must be empty unless `replace`, which
+    # truncates them first. Returns {table: rows copied}.
+    counts = {}
+    target.execute("BEGIN")
+    try:
+        for table in tables:
+            columns = [column.name for column in target.execute(f"SELECT * FROM {table} LIMIT 0").description]
+            if replace:
+                target.execute(f"TRUNCATE {table}")
+            elif target.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is not None:
+                raise ValueError(f"table {table} is not empty")
+            rows = source.execute(f"SELECT {', '.join(columns)} FROM {table}")
+            counts[table] = target.copy_rows(table, columns, rows)
+        # Copied ids don't advance the identity sequence
+        target.execute("SELECT setval(pg_get_serial_sequence('bp_diary', 'id'), COALESCE(MAX(id), 0) + 1, false) "
+                       "FROM bp_diary")
+    except BaseException:
+        target.rollback()
+        raise
+    target.commit()
+    # Fresh planner statistics, or the first queries may plan for empty tables
+    for table in tables:
+        target.execute(f"ANALYZE {table}")
+    return counts
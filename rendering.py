@@ -0,0 +1,215 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+import storage
+
+# =======================
+# Render service settings
+# =======================
+# PDF/XLSX serialisation and chart drawing are CPU-bound and hold the GIL, so
+# they run in worker processes. Jobs wait in a bounded queue; a user can only
+# have PER_USER_JOBS jobs queued or running at a time.
+RENDER_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+RENDER_QUEUE_SIZE = 64
+PER_USER_JOBS = 1
+RENDER_TIMEOUT = 120  # seconds a job may run once started
+KILL_GRACE = 10  # extra seconds before a stuck worker is killed
+
+RENDER_WAIT_SECONDS = metrics.Histogram("bp_render_wait_seconds", "Time a render job waited in the queue", ("job",))
+RENDER_SECONDS = metrics.Histogram("bp_render_seconds", "Time a render job ran in a worker", ("job",))
+RENDER_JOBS = metrics.Counter("bp_render_jobs_total", "Render jobs by outcome", ("job", "result"))
+
+
+class RenderBusy(Exception):
+    pass
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+# -----------------------
+# Worker process side
+# -----------------------
+_conn = None
+_deadline = None
+
+def _init_worker(db_url, warmup):
+    global _conn
+    # Ctrl-C goes to the bot, which shuts the pool down in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Jobs run one at a time on the process's main thread: one connection
+    # does, no Database with its executors or pool
+    _conn = storage.connect(db_url)
+    # One-off per-process set-up such as font registration
+    for fn in warmup:
+        fn()
+
+def _run_job(fn, args, deadline):
+    global _deadline
+    _deadline = deadline
+    try:
+        return fn(_conn, *args)
+    finally:
+        _deadline = None
+
+def check_deadline():
+    # Called by long-running job functions between steps
+    if _deadline is not None and time.time() > _deadline:
+        raise RenderTimeout("rendering took too long")
+
+
+# -----------------------
+# Event loop side
+# -----------------------
+class Job:
+    __slots__ = ("user_id", "fn", "args", "future", "cancelled", "queued")
+
+    def __init__(self, user_id, fn, args, future):
+        self.user_id = user_id
+        self.fn = fn
+        self.args = args
+        self.future = future
+        self.cancelled = False
+        self.queued = time.perf_counter()
+
+
+class RenderService:
+    def __init__(self, db_url, workers=RENDER_WORKERS, queue_size=RENDER_QUEUE_SIZE,
+                 per_user=PER_USER_JOBS, timeout=RENDER_TIMEOUT, warmup=()):
+        self.db_url = db_url
+        self.warmup = tuple(warmup)
+        self.workers = workers
+        self.per_user = per_user
+        self.timeout = timeout
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._active = {}  # user_id -> [Job], queued or running
+        self._pool = None
+        self._tasks = []
+
+    def _new_pool(self):
+        # spawn: the bot process has threads, which fork doesn't mix well with
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker, initargs=(self.db_url, self.warmup))
+
+    def start(self):
+        self._pool = self._new_pool()
+        self._tasks = [asyncio.create_task(self._dispatch()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for jobs in self._active.values():
+            for job in jobs:
+                job.future.cancel()
+        self._active.clear()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def submit(self, user_id, fn, *args):
+        # Returns an asyncio future with fn(conn, *args)'s result. fn must be a
+        # module-level function; it runs in a worker process.
+        jobs = self._active.setdefault(user_id, [])
+        if len(jobs) >= self.per_user:
+            raise RenderBusy()
+        job = Job(user_id, fn, args, asyncio.get_running_loop().create_future())
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise RenderQueueFull()
+        jobs.append(job)
+        job.future.add_done_callback(lambda _: self._release(job))
+        return job.future
+
+    def cancel_user(self, user_id):
+        # Queued jobs are dropped; a running job finishes in its worker but its
+        # result is discarded. Returns the number of jobs cancelled.
+        jobs = self._active.pop(user_id, [])
+        for job in jobs:
+            job.cancelled = True
+            job.future.cancel()
+        return len(jobs)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _release(self, job):
+        jobs = self._active.get(job.user_id)
+        if jobs and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del self._active[job.user_id]
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            name = job.fn.__name__
+            if job.cancelled or job.future.done():
+                RENDER_JOBS.inc(name, "cancelled")
+                continue
+            deadline = time.time() + self.timeout
+            pool = self._pool
+            start = time.perf_counter()
+            RENDER_WAIT_SECONDS.observe(start - job.queued, name)
+            try:
+                result = await asyncio.wait_for(
+                    loop.run_in_executor(pool, _run_job, job.fn, job.args, deadline),
+                    self.timeout + KILL_GRACE)
+            except asyncio.TimeoutError:
+                # The worker ignored its deadline; replace the pool so the
+                # stuck process doesn't hold a slot forever
+                print(f"Render job for {job.user_id} stuck, restarting workers")
+                self._restart_pool(pool)
+                self._set_exception(job, RenderTimeout("rendering took too long"))
+                RENDER_JOBS.inc(name, "killed")
+            except BrokenProcessPool as e:
+                self._restart_pool(pool)
+                self._set_exception(job, e)
+                RENDER_JOBS.inc(name, "error")
+            except RenderTimeout as e:
+                self._set_exception(job, e)
+                RENDER_JOBS.inc(name, "timeout")
+            except Exception as e:
+                self._set_exception(job, e)
+                RENDER_JOBS.inc(name, "error")
+            else:
+                if job.future.done():
+                    _discard(result)
+                    RENDER_JOBS.inc(name, "cancelled")
+                else:
+                    job.future.set_result(result)
+                    RENDER_JOBS.inc(name, "ok")
+            finally:
+                RENDER_SECONDS.observe(time.perf_counter() - start, name)
+
+    def _set_exception(self, job, exc):
+        if not job.future.done():
+            job.future.set_exception(exc)
+
+    def _restart_pool(self, pool):
+        if pool is not self._pool:
+            return  # another dispatcher already replaced it
+        self._pool = self._new_pool()
+        for process in list(getattr(pool, "_processes", {}).values()):
+            process.kill()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _discard(result):
+    # Results of cancelled jobs: exports are temp file paths to remove
+    if isinstance(result, str) and os.path.exists(result):
+        os.unlink(result)
@@ -0,0 +1,105 @@
+import time
+
+import metrics
+
+HANDLER_SECONDS = metrics.Histogram("bp_handler_seconds", "Time to handle one update, by route", ("route",))
+UNROUTED = metrics.Counter("bp_unrouted_updates_total", "Messages that matched no command, step or button")
+
+# Single entry point for every user message. A message is resolved by dict
+# lookups in this order:
+#   1. "/command"              -> commands
+#   2. the user's current step -> steps (unless the text is an interrupt label)
+#   3. menu label              -> buttons
+#   4. anything else, from a user whose step just timed out -> the expired route
+# The step comes from the conversation store, so there's exactly one state
+# machine per user and no handler chain to walk.
+
+
+class Router:
+    def __init__(self, get_conversation, end_conversation, step_expired):
+        self.get_conversation = get_conversation
+        self.end_conversation = end_conversation
+        self.step_expired = step_expired
+        self.expired_route = None
+        self.commands = {}
+        self.buttons = {}
+        self.steps = {}
+        self.document_steps = set()
+        self.interrupts = frozenset()
+        self.dispatched = 0
+        self.unrouted = 0
+
+    # Tables map a key to (route label for metrics, handler)
+    def command(self, name, handler):
+        self.commands[name.lower()] = ("/" + name.lower(), handler)
+
+    def button(self, label, handler):
+        self.buttons[label] = (label, handler)
+
+    def step(self, name, handler, documents=False):
+        self.steps[name] = ("step:" + name, handler)
+        if documents:
+            self.document_steps.add(name)
+
+    def on_expired(self, handler):
+        # Input meant for a step that timed out, so it isn't dropped silently
+        self.expired_route = ("step:expired", handler)
+
+    def interrupt_on(self, labels):
+        # Labels that abandon the current step and run as menu buttons
+        self.interrupts = frozenset(labels)
+
+    @staticmethod
+    def command_name(text):
+        # "/export@my_bot csv" -> "export"
+        parts = text[1:].split(maxsplit=1)
+        return parts[0].split("@", 1)[0].lower() if parts else ""
+
+    async def dispatch(self, update, context):
+        start = time.perf_counter()
+        route = await self.resolve(update)
+        if route is None:
+            return
+        try:
+            return await route[1](update, context)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, route[0])
+
+    def _unrouted(self):
+        self.unrouted += 1
+        UNROUTED.inc()
+
+    async def resolve(self, update):
+        # (route label, handler) for the update, or None to ignore it
+        message = update.message
+        if message is None or update.effective_user is None:
+            return None
+        self.dispatched += 1
+        text = message.text
+        user_id = update.effective_user.id
+        if text is not None and text.startswith("/"):
+            route = self.commands.get(self.command_name(text))
+            if route is None:
+                self._unrouted()
+            elif self.step_expired(user_id):
+                self.end_conversation(user_id)
+            return route
+
+        conv = await self.get_conversation(user_id)
+        if conv is not None and conv.step is not None:
+            if text is None and conv.step not in self.document_steps:
+                self._unrouted()
+                return None
+            if text not in self.interrupts:
+                return self.steps[conv.step]
+            self.end_conversation(user_id)
+
+        route = self.buttons.get(text)
+        if conv is None and self.expired_route is not None and self.step_expired(user_id):
+            if route is None:
+                return self.expired_route
+            # A menu button moves on from the timed-out step
+            self.end_conversation(user_id)
+        if route is None:
+            self._unrouted()
+        return route
@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+from collections import OrderedDict
+import time as _time
+from datetime import datetime, timedelta, timezone, time
+
+from timezones import get_zone
+
+# Reminders that became due at most this long before startup are still sent.
+STARTUP_GRACE = 60
+SENT_CACHE_SIZE = 50000
+
+
+def parse_slot(slot):
+    h, m = map(int, slot.split(':'))
+    return time(h, m)
+
+def next_fire(tz, slot_time, after):
+    # First UTC timestamp strictly after `after` at which the wall clock in
+    # `tz` reads slot_time. Uses fold=0, so on DST transitions:
+    # - an ambiguous time (clocks go back) fires once, at its first occurrence;
+    # - a skipped time (clocks go forward) fires at the same instant it would
+    #   have had on the old offset, i.e. shifted forward by the gap.
+    local_day = datetime.fromtimestamp(after, tz).date()
+    for offset in (0, 1, 2):
+        candidate = datetime.combine(local_day + timedelta(days=offset), slot_time, tzinfo=tz)
+        ts = candidate.astimezone(timezone.utc).timestamp()
+        if ts > after:
+            return ts
+    raise ValueError("no fire time found")  # unreachable for real zones
+
+
+class SentCache:
+    # Bounded LRU of (user_id, slot) -> last claimed fire time. Only used to
+    # skip reminders already known to be sent; the reminder_sent table is the
+    # source of truth.
+    def __init__(self, maxsize=SENT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def already_sent(self, user_id, slot, fire_at):
+        last = self._data.get((user_id, slot))
+        return last is not None and last >= int(fire_at)
+
+    def mark(self, user_id, slot, fire_at):
+        key = (user_id, slot)
+        self._data[key] = int(fire_at)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+class ReminderScheduler:
+    # Keeps every (user, slot) pair in a min-heap ordered by its next UTC fire
+    # time and sleeps until the head is due. Settings changes replace a user's
+    # entries in O(log n); stale heap entries are skipped lazily using a
+    # per-user generation number.
+    #
+    # With shards > 1 only users with user_id % shards == shard are tracked,
+    # so several processes can split the user base between them.
+    def __init__(self, shard=0, shards=1):
+        self.shard = shard
+        self.shards = shards
+        self._heap = []
+        self._users = {}  # user_id -> (generation, tz, slots)
+        self._generation = 0
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._users)
+
+    def owns(self, user_id):
+        return user_id % self.shards == self.shard
+
+    def update_user(self, user_id, tz_name, reminders, now=None):
+        if not self.owns(user_id):
+            return
+        now = _time.time() if now is None else now
+        self._generation += 1
+        if not reminders:
+            self._users.pop(user_id, None)
+            self._wakeup.set()
+            return
+        try:
+            tz = get_zone(tz_name or "UTC")
+        except Exception as e:
+            print(f"Invalid timezone {tz_name!r} for user {user_id}: {e}")
+            tz = get_zone("UTC")
+        slots = {slot: parse_slot(slot) for slot in reminders}
+        self._users[user_id] = (self._generation, tz, slots)
+        for slot, slot_time in slots.items():
+            heapq.heappush(self._heap, (next_fire(tz, slot_time, now), user_id, slot, self._generation))
+        if len(self._heap) > 2 * len(self._users) * len(slots) + 64:
+            self._compact()
+        self._wakeup.set()
+
+    def _compact(self):
+        self._heap = [e for e in self._heap if e[1] in self._users and self._users[e[1]][0] == e[3]]
+        heapq.heapify(self._heap)
+
+    def remove_user(self, user_id):
+        self._users.pop(user_id, None)
+
+    def next_due(self):
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        # Pops every entry due at `now`, reschedules it for its next occurrence
+        # after `now` (so a long stall sends one late reminder, not a burst)
+        # and returns the live ones as (fire_at, user_id, slot).
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, user_id, slot, generation = heapq.heappop(self._heap)
+            user = self._users.get(user_id)
+            if user is None or user[0] != generation:
+                continue
+            _, tz, slots = user
+            heapq.heappush(self._heap, (next_fire(tz, slots[slot], max(fire_at, now)), user_id, slot, generation))
+            due.append((fire_at, user_id, slot))
+        return due
+
+    async def run(self, send):
+        # send(due) is awaited with the list of (fire_at, user_id, slot)
+        # that became due on each wakeup
+        while True:
+            due = self.pop_due(_time.time())
+            if due:
+                await send(due)
+
+            head = self.next_due()
+            timeout = max(0.0, head - _time.time()) if head is not None else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,43 @@
+"""Post a synthetic Telegram update to a locally running webhook.
+
+Usage: python scripts/post_update.py [text] [--chat-id ID] [--url URL] [--secret S]
+"""
+import argparse
+import json
+import time
+import urllib.request
+
+
+def make_update(update_id, chat_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "Test"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+            "text": text,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("text", nargs="?", default="Status")
+    parser.add_argument("--chat-id", type=int, default=1)
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret")
+    parser.add_argument("--update-id", type=int, default=int(time.time()))
+    args = parser.parse_args()
+
+    headers = {"Content-Type": "application/json"}
+    if args.secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret
+    body = json.dumps(make_update(args.update_id, args.chat_id, args.text)).encode()
+    request = urllib.request.Request(args.url, data=body, headers=headers, method="POST")
+    with urllib.request.urlopen(request) as response:
+        print(response.status, response.read().decode())
+
+
+if __name__ == "__main__":
+    main()
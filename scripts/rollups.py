@@ -0,0 +1,48 @@
+"""Verify or rebuild the daily/weekly rollup tables.
+
+Usage: python scripts/rollups.py verify|rebuild [--db FILE] [--chat-id ID]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import storage
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["verify", "rebuild"])
+    parser.add_argument("--db", default="bp_diary.db")
+    parser.add_argument("--chat-id", type=int, help="only this user (default: all)")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db, isolation_level=None)
+    storage.migrate(conn)
+    if args.chat_id is not None:
+        users = [(args.chat_id,)]
+    else:
+        users = conn.execute("SELECT chat_id FROM bp_summary ORDER BY chat_id").fetchall()
+
+    stale = 0
+    for (chat_id,) in users:
+        if args.command == "verify":
+            mismatches = storage.verify_rollups(conn, chat_id)
+            if mismatches:
+                stale += 1
+                print(f"{chat_id}: {len(mismatches)} mismatched buckets, e.g. {mismatches[:3]}")
+        else:
+            tz_name = storage.get_timezone(conn, chat_id)
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                days, weeks = storage.rebuild_rollups(conn, chat_id, tz_name)
+            print(f"{chat_id}: {days} days, {weeks} weeks ({tz_name})")
+    if args.command == "verify":
+        print(f"{len(users)} users checked, {stale} stale")
+        sys.exit(1 if stale else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Copy a SQLite database into PostgreSQL.
+
+Brings the SQLite file up to the latest schema, creates the schema in
+PostgreSQL and copies every table with COPY in a single transaction. The
+PostgreSQL tables must be empty unless --replace is given. Stop the bot
+first so nothing is written to the SQLite file during the copy.
+
+Usage: python scripts/sqlite_to_postgres.py postgresql://... [--db bp_diary.db] [--replace]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pgstorage  # noqa: E402
+import storage  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", help="postgresql:// URL of the target database")
+    parser.add_argument("--db", default="bp_diary.db")
+    parser.add_argument("--replace", action="store_true", help="truncate the PostgreSQL tables first")
+    args = parser.parse_args()
+
+    source = sqlite3.connect(args.db)
+    applied = storage.migrate(source)
+    if applied:
+        print(f"Applied SQLite migrations: {applied}")
+    target = pgstorage.connect(args.url)
+    applied = storage.migrate(target)
+    if applied:
+        print(f"Created PostgreSQL schema: {applied}")
+
+    start = time.perf_counter()
+    try:
+        counts = pgstorage.copy_from_sqlite(source, target, replace=args.replace)
+    except ValueError as e:
+        sys.exit(f"{e}; use --replace to overwrite")
+    elapsed = time.perf_counter() - start
+
+    mismatched = 0
+    for table, copied in counts.items():
+        expected = source.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        actual = target.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        flag = "" if expected == actual == copied else "  MISMATCH"
+        mismatched += bool(flag)
+        print(f"{table:14} {actual:10} rows{flag}")
+    total = sum(counts.values())
+    print(f"Copied {total} rows in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f} rows/s)")
+    source.close()
+    target.close()
+    sys.exit(1 if mismatched else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import asyncio
+import multiprocessing
+import queue
+import threading
+import time
+
+# =======================
+# Sharding settings
+# =======================
+# With BOT_WORKERS > 1 the bot runs as one ingress process plus N worker
+# processes. Ingress receives updates (polling or webhook) and hands each to
+# the worker that owns its chat, chat_id % N, over a local pipe, so a
+# chat's updates are always handled by the same process and in the order they
+# arrived. Workers run the usual Application; reminders are split with the
+# same modulo (ReminderScheduler's shard), so whichever worker handles a
+# user's settings also sends their reminders (the bot only talks in private
+# chats, where chat_id == user_id). The supervisor in the ingress
+# process restarts workers that exit unexpectedly.
+WORKER_QUEUE_SIZE = 10000  # updates buffered per worker before ingress waits
+QUEUE_FULL_WAIT = 0.05
+MONITOR_INTERVAL = 1
+RESTART_DELAY = 1
+RESTART_DELAY_MAX = 30
+STABLE_AFTER = 60  # seconds a worker must run before its restart delay resets
+STOP_TIMEOUT = 30
+
+
+def shard_of(chat_id, shards):
+    # Same split as scheduler.ReminderScheduler.owns()
+    return chat_id % shards
+
+def route_key(update):
+    # Chat for messages and callbacks; the user for updates without a chat
+    # (inline queries); 0 for the rest
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+
+class Supervisor:
+    # Owns the worker processes. target(shard, shards, connection) must be a
+    # module-level function; it runs in the worker, reads updates with
+    # connection.recv() and returns when it reads None.
+    #
+    # Each worker has its own pipe, which it is the only reader of; a shared
+    # multiprocessing.Queue would leave its reader lock held for good if a
+    # worker were killed while waiting on it. Updates wait in the ingress
+    # process in a bounded queue per worker, and a sender thread writes them
+    # to that worker's pipe. When a worker dies only what was already in its
+    # pipe or its own queue is lost; the rest goes to its replacement.
+    def __init__(self, target, shards, queue_size=WORKER_QUEUE_SIZE):
+        self.target = target
+        self.shards = shards
+        self._ctx = multiprocessing.get_context("spawn")
+        self.pending = [queue.Queue(queue_size) for _ in range(shards)]
+        self._pipes = [None] * shards  # write ends, None while a worker is down
+        self._changed = threading.Condition()
+        self._processes = [None] * shards
+        self._started = [0.0] * shards
+        self._delays = [RESTART_DELAY] * shards
+        self._restart_at = [None] * shards
+        self._stopping = False
+        self.dispatched = 0
+        self.restarts = 0
+
+    def start(self):
+        for shard in range(self.shards):
+            self._spawn(shard)
+            threading.Thread(target=self._send, args=(shard,), name=f"bot-sender-{shard}", daemon=True).start()
+
+    def _spawn(self, shard):
+        reader, writer = self._ctx.Pipe(duplex=False)
+        process = self._ctx.Process(target=self.target, args=(shard, self.shards, reader),
+                                    name=f"bot-worker-{shard}")
+        process.start()
+        # Only the worker holds the read end now, so writes fail once it exits
+        reader.close()
+        with self._changed:
+            old, self._pipes[shard] = self._pipes[shard], writer
+            self._changed.notify_all()
+        if old is not None:
+            old.close()
+        self._processes[shard] = process
+        self._started[shard] = time.monotonic()
+        self._restart_at[shard] = None
+
+    def _send(self, shard):
+        pending = self.pending[shard]
+        while True:
+            data = pending.get()
+            while True:
+                with self._changed:
+                    self._changed.wait_for(lambda: self._pipes[shard] is not None)
+                    pipe = self._pipes[shard]
+                try:
+                    pipe.send(data)
+                    break
+                except OSError:
+                    # The worker is gone; wait for check() to start another
+                    with self._changed:
+                        if self._pipes[shard] is pipe:
+                            self._pipes[shard] = None
+            if data is None:
+                return
+
+    async def dispatch(self, data, key):
+        # data must be picklable (an Update.to_dict()). Waits while the
+        # worker's queue is full instead of dropping or reordering updates.
+        pending = self.pending[shard_of(key, self.shards)]
+        while True:
+            try:
+                pending.put_nowait(data)
+                break
+            except queue.Full:
+                await asyncio.sleep(QUEUE_FULL_WAIT)
+        self.dispatched += 1
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(MONITOR_INTERVAL)
+            self.check()
+
+    def check(self):
+        now = time.monotonic()
+        for shard, process in enumerate(self._processes):
+            if self._stopping or process is None or process.is_alive():
+                continue
+            if self._restart_at[shard] is None:
+                # Back off when a worker keeps dying right after start-up
+                ran = now - self._started[shard]
+                delay = RESTART_DELAY if ran >= STABLE_AFTER else self._delays[shard]
+                self._delays[shard] = min(RESTART_DELAY_MAX, delay * 2)
+                self._restart_at[shard] = now + delay
+                print(f"Worker {shard} exited with code {process.exitcode} after {ran:.0f}s, "
+                      f"restarting in {delay}s")
+            elif now >= self._restart_at[shard]:
+                self.restarts += 1
+                self._spawn(shard)
+
+    def stop(self):
+        # Blocking: asks every worker to finish what is queued for it, then waits
+        self._stopping = True
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for shard, process in enumerate(self._processes):
+            if process is not None and process.is_alive():
+                try:
+                    self.pending[shard].put(None, timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Full:
+                    pass
+        for shard, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                print(f"Worker {shard} did not stop in time, terminating")
+                process.terminate()
+                process.join()
+
+    def stats(self):
+        return {"workers": self.shards, "alive": sum(1 for p in self._processes if p is not None and p.is_alive()),
+                "queued": sum(q.qsize() for q in self.pending),
+                "dispatched": self.dispatched, "restarts": self.restarts}
@@ -0,0 +1,898 @@
+import asyncio
+import json
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import metrics
+from timezones import get_zone
+
+# =======================
+# Connection settings
+# =======================
+# Applied once per connection. WAL lets readers run while the writer commits,
+# synchronous=NORMAL is durable across application crashes in WAL mode and
+# avoids an fsync per transaction.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+)
+
+READ_WORKERS = 4
+CACHED_STATEMENTS = 128
+# Group commit of write_batched() calls: a call to an idle writer commits
+# straight away; calls that queue up behind a commit go in the next batch,
+# which waits up to BATCH_WINDOW seconds for more unless it has BATCH_ROWS
+BATCH_ROWS = 200
+BATCH_WINDOW = 0.005
+
+DB_WAIT_SECONDS = metrics.Histogram(
+    "bp_db_wait_seconds", "Time a database call waited for a free worker thread", ("op",))
+DB_QUERY_SECONDS = metrics.Histogram(
+    "bp_db_query_seconds", "Time spent running a database helper, commit included", ("op", "fn"))
+DB_BATCH_CALLS = metrics.Histogram(
+    "bp_db_batch_calls", "Helper calls committed together by one group commit",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+
+def open_database(url, readers=READ_WORKERS, batch_rows=BATCH_ROWS, batch_window=BATCH_WINDOW):
+    # A postgres:// or postgresql:// URL selects PostgreSQL (pgstorage.py,
+    # needs psycopg); anything else is the path of a SQLite file
+    if url.startswith(("postgres://", "postgresql://")):
+        import pgstorage
+        return pgstorage.PostgresDatabase(url, readers=readers, batch_rows=batch_rows, batch_window=batch_window)
+    return SqliteDatabase(url, readers=readers, batch_rows=batch_rows, batch_window=batch_window)
+
+def connect(url):
+    # One connection for the calling thread, without a Database's threads or
+    # pool; for processes that run helpers directly, like the render workers
+    if url.startswith(("postgres://", "postgresql://")):
+        import pgstorage
+        return pgstorage.connect(url)
+    return connect_sqlite(url)
+
+def connect_sqlite(path):
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def dialect(conn):
+    # "sqlite" for sqlite3 connections, "postgresql" for pgstorage.PgConnection
+    return getattr(conn, "dialect", "sqlite")
+
+
+class Database:
+    # Runs the helpers below off the event loop. All writes go through a
+    # single writer thread, reads are spread over a small bounded pool so a
+    # slow query never blocks the event loop. Backends provide connect(), a
+    # long-lived connection of the calling thread, and _read() / _write(),
+    # which run one helper in a transaction; a durable _write() must survive
+    # power loss once it returns, not just an application crash.
+    dialect = None
+
+    def __init__(self, readers=READ_WORKERS, batch_rows=BATCH_ROWS, batch_window=BATCH_WINDOW):
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._reader = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self.batch_rows = max(1, batch_rows)
+        self.batch_window = batch_window
+        self._batch = []
+        self._batch_full = None
+        self._flusher = None
+
+    def connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._open()
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _run_read(self, fn, args, queued):
+        start = time.perf_counter()
+        DB_WAIT_SECONDS.observe(start - queued, "read")
+        try:
+            return self._read(fn, args)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, "read", fn.__name__)
+
+    def _run_write(self, fn, args, queued):
+        start = time.perf_counter()
+        DB_WAIT_SECONDS.observe(start - queued, "write")
+        try:
+            return self._write(fn, args)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, "write", fn.__name__)
+
+    async def read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader, self._run_read, fn, args, time.perf_counter())
+
+    async def write(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._run_write, fn, args, time.perf_counter())
+
+    async def write_batched(self, fn, *args):
+        # Like write(), but calls that arrive while a batch is committing are
+        # committed together in one durable transaction; returns (or raises)
+        # only after that commit. For small, frequent writes that are
+        # independent of each other, like saving a reading.
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch.append((fn, args, future, time.perf_counter()))
+        if self._flusher is None or self._flusher.done():
+            self._batch_full = asyncio.Event()
+            self._flusher = loop.create_task(self._flush_batches())
+        elif len(self._batch) >= self.batch_rows:
+            self._batch_full.set()
+        return await future
+
+    async def _flush_batches(self):
+        loop = asyncio.get_running_loop()
+        queued_behind = False
+        while self._batch:
+            # Only calls that queued up behind a commit wait for company: one
+            # at a time (e.g. concurrent_updates=1) never sleeps
+            if queued_behind and len(self._batch) < self.batch_rows and self.batch_window > 0:
+                self._batch_full.clear()
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.batch_window)
+                except asyncio.TimeoutError:
+                    pass
+            batch, self._batch = self._batch[:self.batch_rows], self._batch[self.batch_rows:]
+            try:
+                results = await loop.run_in_executor(self._writer, self._run_batch, batch)
+            except Exception as e:
+                # e.g. the writer was shut down; nothing was committed
+                results = [(False, e)] * len(batch)
+            queued_behind = True
+            for (_, _, future, _), (ok, value) in zip(batch, results):
+                if future.done():  # the caller was cancelled
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _run_batch(self, batch):
+        start = time.perf_counter()
+        for _, _, _, queued in batch:
+            DB_WAIT_SECONDS.observe(start - queued, "write")
+        try:
+            results = self._write(_apply_batch, (batch,), durable=True)
+        except Exception:
+            # One failing call rolls back the whole batch; run the calls one
+            # by one so only that caller sees the error
+            results = []
+            for fn, args, _, _ in batch:
+                try:
+                    results.append((True, self._write(fn, args, durable=True)))
+                except Exception as e:
+                    results.append((False, e))
+        DB_BATCH_CALLS.observe(len(batch))
+        DB_QUERY_SECONDS.observe(time.perf_counter() - start, "write", "batch")
+        return results
+
+    def close(self):
+        # Callers of write_batched() must be done; a batch still waiting for
+        # its window fails instead of being committed
+        self._reader.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+class SqliteDatabase(Database):
+    # One connection per worker thread, kept for the life of the process;
+    # SQLite allows one writer at a time anyway.
+    dialect = "sqlite"
+
+    def __init__(self, path, readers=READ_WORKERS, batch_rows=BATCH_ROWS, batch_window=BATCH_WINDOW):
+        super().__init__(readers, batch_rows, batch_window)
+        self.path = path
+
+    def _open(self):
+        return connect_sqlite(self.path)
+
+    def _read(self, fn, args):
+        return fn(self.connect(), *args)
+
+    def _write(self, fn, args, durable=False):
+        conn = self.connect()
+        if not durable:
+            with conn:
+                return fn(conn, *args)
+        # synchronous=FULL fsyncs the WAL on this commit only; the other
+        # writes keep NORMAL
+        conn.execute("PRAGMA synchronous=FULL")
+        try:
+            with conn:
+                return fn(conn, *args)
+        finally:
+            conn.execute("PRAGMA synchronous=NORMAL")
+
+
+def _apply_batch(conn, batch):
+    return [(True, fn(conn, *args)) for fn, args, _, _ in batch]
+
+
+# =======================
+# Schema & migrations
+# =======================
+# The schema version is kept in PRAGMA user_version (table schema_info on
+# PostgreSQL). Each migration runs once, in order, in its own transaction.
+# Migrations only do cheap DDL; rewriting existing rows is left to
+# backfill_batch() so it can run in small batches while the bot keeps
+# serving updates.
+BACKFILL_BATCH = 500
+
+LEGACY_ENTRIES_SQL = "SELECT id, datetime, bp, pulse, comment FROM bp_diary WHERE chat_id=? ORDER BY id DESC"
+ENTRIES_SQL = "SELECT id, datetime, bp, pulse, comment FROM bp_diary WHERE chat_id=? ORDER BY ts DESC, id DESC"
+
+BP_RE = re.compile(r"^\s*(\d{2,3})\s*[/\\-]\s*(\d{2,3})\s*$")
+PULSE_RE = re.compile(r"^\s*(\d{2,3})\s*$")
+
+def parse_bp(text):
+    m = BP_RE.match(text or "")
+    return (int(m.group(1)), int(m.group(2))) if m else (None, None)
+
+def parse_pulse(text):
+    m = PULSE_RE.match(text or "")
+    return int(m.group(1)) if m else None
+
+def parse_datetime_text(text):
+    # Legacy rows were written with the server's local time.
+    try:
+        return int(datetime.strptime(text, "%Y-%m-%d %H:%M").timestamp())
+    except (TypeError, ValueError):
+        return None
+
+def _migration_1(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bp_diary (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            datetime TEXT,
+            bp TEXT,
+            pulse TEXT,
+            comment TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER PRIMARY KEY,
+            timezone TEXT DEFAULT 'UTC',
+            reminders TEXT
+        )
+    """)
+
+def _migration_2(conn):
+    # Typed copies of the free-text columns. The text columns stay as the
+    # reading was entered; the typed ones are NULL when the text can't be
+    # parsed.
+    conn.execute("ALTER TABLE bp_diary ADD COLUMN ts INTEGER")
+    conn.execute("ALTER TABLE bp_diary ADD COLUMN systolic INTEGER")
+    conn.execute("ALTER TABLE bp_diary ADD COLUMN diastolic INTEGER")
+    conn.execute("ALTER TABLE bp_diary ADD COLUMN pulse_bpm INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bp_diary_chat_ts ON bp_diary (chat_id, ts)")
+
+def _migration_3(conn):
+    # Sent-reminder ledger: one row per (user, slot) holding the UTC fire
+    # time of the last reminder claimed for it.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS reminder_sent (
+            user_id INTEGER NOT NULL,
+            slot TEXT NOT NULL,
+            last_fired INTEGER NOT NULL,
+            PRIMARY KEY (user_id, slot)
+        ) WITHOUT ROWID
+    """)
+
+def _migration_4(conn):
+    # Per-user summary row kept in step with bp_diary by add_entry and
+    # delete_entry. `version` increases on every change and can be used as a
+    # cache key for anything derived from a user's readings.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bp_summary (
+            chat_id INTEGER PRIMARY KEY,
+            entries INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        INSERT OR REPLACE INTO bp_summary (chat_id, entries, version)
+        SELECT chat_id, COUNT(*), 1 FROM bp_diary GROUP BY chat_id
+    """)
+
+def _migration_5(conn):
+    # Daily and weekly rollups per user, bucketed in the timezone recorded in
+    # bp_summary.rollup_tz. A NULL rollup_tz marks a user whose rollups still
+    # have to be built by rebuild_rollups().
+    for table, key in ROLLUP_TABLES:
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                chat_id INTEGER NOT NULL,
+                {key} TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                sys_sum INTEGER NOT NULL, sys_sq INTEGER NOT NULL, sys_min INTEGER, sys_max INTEGER,
+                dia_sum INTEGER NOT NULL, dia_sq INTEGER NOT NULL, dia_min INTEGER, dia_max INTEGER,
+                pulse_n INTEGER NOT NULL,
+                pulse_sum INTEGER NOT NULL, pulse_sq INTEGER NOT NULL, pulse_min INTEGER, pulse_max INTEGER,
+                PRIMARY KEY (chat_id, {key})
+            ) WITHOUT ROWID
+        """)
+    conn.execute("ALTER TABLE bp_summary ADD COLUMN rollup_tz TEXT")
+
+def _migration_6(conn):
+    # When the user last exported, for "since last export"
+    conn.execute("ALTER TABLE bp_summary ADD COLUMN last_export_ts INTEGER")
+
+def _migration_7(conn):
+    # In-flight conversations (convstate.ConversationStore), so they survive
+    # a restart; rows past `expires` are purged
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conv_state (
+            user_id INTEGER PRIMARY KEY,
+            expires INTEGER NOT NULL,
+            data TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conv_state_expires ON conv_state (expires)")
+
+MIGRATIONS = [
+    (1, _migration_1),
+    (2, _migration_2),
+    (3, _migration_3),
+    (4, _migration_4),
+    (5, _migration_5),
+    (6, _migration_6),
+    (7, _migration_7),
+]
+
+def _pg_migration_7(conn):
+    # PostgreSQL starts at the schema SQLite reaches after migration 7. Ids
+    # are BIGINT since Telegram's don't fit in 32 bits; bp_diary.id can be
+    # given explicitly, for copying a SQLite database in.
+    conn.execute("""
+        CREATE TABLE bp_diary (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            chat_id BIGINT,
+            datetime TEXT,
+            bp TEXT,
+            pulse TEXT,
+            comment TEXT,
+            ts BIGINT,
+            systolic INTEGER,
+            diastolic INTEGER,
+            pulse_bpm INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX idx_bp_diary_chat_ts ON bp_diary (chat_id, ts)")
+    conn.execute("""
+        CREATE TABLE user_settings (
+            user_id BIGINT PRIMARY KEY,
+            timezone TEXT DEFAULT 'UTC',
+            reminders TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE reminder_sent (
+            user_id BIGINT NOT NULL,
+            slot TEXT NOT NULL,
+            last_fired BIGINT NOT NULL,
+            PRIMARY KEY (user_id, slot)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE bp_summary (
+            chat_id BIGINT PRIMARY KEY,
+            entries INTEGER NOT NULL DEFAULT 0,
+            version BIGINT NOT NULL DEFAULT 0,
+            rollup_tz TEXT,
+            last_export_ts BIGINT
+        )
+    """)
+    for table, key in ROLLUP_TABLES:
+        conn.execute(f"""
+            CREATE TABLE {table} (
+                chat_id BIGINT NOT NULL,
+                {key} TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                sys_sum BIGINT NOT NULL, sys_sq BIGINT NOT NULL, sys_min INTEGER, sys_max INTEGER,
+                dia_sum BIGINT NOT NULL, dia_sq BIGINT NOT NULL, dia_min INTEGER, dia_max INTEGER,
+                pulse_n INTEGER NOT NULL,
+                pulse_sum BIGINT NOT NULL, pulse_sq BIGINT NOT NULL, pulse_min INTEGER, pulse_max INTEGER,
+                PRIMARY KEY (chat_id, {key})
+            )
+        """)
+    conn.execute("""
+        CREATE TABLE conv_state (
+            user_id BIGINT PRIMARY KEY,
+            expires BIGINT NOT NULL,
+            data TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX idx_conv_state_expires ON conv_state (expires)")
+
+# A later schema change needs an entry in both lists
+PG_MIGRATIONS = [
+    (7, _pg_migration_7),
+]
+
+def schema_version(conn):
+    if dialect(conn) == "postgresql":
+        return conn.execute("SELECT version FROM schema_info").fetchone()[0]
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def _set_schema_version(conn, version):
+    if dialect(conn) == "postgresql":
+        conn.execute("UPDATE schema_info SET version=?", (version,))
+    else:
+        conn.execute(f"PRAGMA user_version={version}")
+
+def migrate(conn):
+    postgres = dialect(conn) == "postgresql"
+    if postgres:
+        # PostgreSQL has no user_version; a one-row table stands in for it
+        conn.execute("CREATE TABLE IF NOT EXISTS schema_info "
+                     "(id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+        conn.execute("INSERT INTO schema_info (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING")
+    applied = []
+    for version, fn in PG_MIGRATIONS if postgres else MIGRATIONS:
+        if version <= schema_version(conn):
+            continue
+        conn.execute("BEGIN" if postgres else "BEGIN IMMEDIATE")
+        try:
+            if postgres:
+                # Several hosts may start at once; the others wait here and skip
+                conn.execute("LOCK TABLE schema_info")
+                if version <= schema_version(conn):
+                    conn.rollback()
+                    continue
+            fn(conn)
+            _set_schema_version(conn, version)
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        applied.append(version)
+    return applied
+
+def init_db(conn):
+    return migrate(conn)
+
+def explain_entries(conn):
+    if dialect(conn) == "postgresql":
+        if conn.execute("SELECT to_regclass('bp_diary')").fetchone()[0] is None:
+            return []
+        return [row[0] for row in conn.execute("EXPLAIN " + ENTRIES_SQL, (0,))]
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(bp_diary)")}
+    if not columns:
+        return []
+    sql = ENTRIES_SQL if "ts" in columns else LEGACY_ENTRIES_SQL
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, (0,))]
+
+def backfill_start(conn):
+    row = conn.execute("SELECT MAX(id) FROM bp_diary WHERE ts IS NULL").fetchone()
+    return row[0] + 1 if row[0] is not None else None
+
+def backfill_batch(conn, before_id, batch_size=BACKFILL_BATCH):
+    # Walks rows newest-first so recent history gets its typed columns first.
+    # Returns (rows_updated, next_before_id); next_before_id is None when done.
+    rows = conn.execute(
+        "SELECT id, datetime, bp, pulse FROM bp_diary WHERE id < ? AND ts IS NULL ORDER BY id DESC LIMIT ?",
+        (before_id, batch_size)).fetchall()
+    if not rows:
+        return 0, None
+    updates = []
+    for eid, dt, bp, pulse in rows:
+        systolic, diastolic = parse_bp(bp)
+        ts = parse_datetime_text(dt)
+        updates.append((ts if ts is not None else 0, systolic, diastolic, parse_pulse(pulse), eid))
+    conn.executemany("UPDATE bp_diary SET ts=?, systolic=?, diastolic=?, pulse_bpm=? WHERE id=?", updates)
+    return len(rows), rows[-1][0]
+
+
+# =======================
+# Queries
+# =======================
+# Every function takes an open connection as its first argument and is meant
+# to be run through Database.read / Database.write. The SQL runs on both
+# SQLite and PostgreSQL: ? placeholders (pgstorage translates them), upserts
+# with ON CONFLICT and table-qualified columns in DO UPDATE, CASE instead of
+# the two-argument MIN/MAX; the few differences branch on dialect(conn).
+PAGE_SIZE = 10
+ENTRY_COLUMNS = ("chat_id", "datetime", "bp", "pulse", "comment", "ts", "systolic", "diastolic", "pulse_bpm")
+
+# PostgreSQL bulk import: rows are COPYed into a temporary table and the new
+# ones inserted in a single statement, keeping the first of any duplicates
+IMPORT_TABLE_SQL = ("CREATE TEMPORARY TABLE IF NOT EXISTS import_rows (n BIGSERIAL, chat_id BIGINT, datetime TEXT, "
+                    "bp TEXT, pulse TEXT, comment TEXT, ts BIGINT, systolic INTEGER, diastolic INTEGER, "
+                    "pulse_bpm INTEGER) ON COMMIT DELETE ROWS")
+IMPORT_INSERT_SQL = (
+    f"INSERT INTO bp_diary ({', '.join(ENTRY_COLUMNS)}) SELECT {', '.join(ENTRY_COLUMNS)} FROM "
+    "(SELECT DISTINCT ON (chat_id, ts, bp) * FROM import_rows ORDER BY chat_id, ts, bp, n) i "
+    "WHERE NOT EXISTS (SELECT 1 FROM bp_diary d WHERE d.chat_id = i.chat_id AND d.ts = i.ts AND d.bp = i.bp) "
+    "ORDER BY n RETURNING ts, systolic, diastolic, pulse_bpm")
+
+def add_entry(conn, chat_id, when, bp, pulse, comment):
+    systolic, diastolic = parse_bp(bp)
+    ts, pulse_bpm = int(when.timestamp()), parse_pulse(pulse)
+    conn.execute("INSERT INTO bp_diary (chat_id, datetime, bp, pulse, comment, ts, systolic, diastolic, pulse_bpm) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 (chat_id, when.strftime("%Y-%m-%d %H:%M"), bp, pulse, comment,
+                  ts, systolic, diastolic, pulse_bpm))
+    _bump_summary(conn, chat_id, 1)
+    merge_rollups(conn, chat_id, [(ts, systolic, diastolic, pulse_bpm)])
+
+def add_entries(conn, chat_id, rows):
+    # Bulk insert in the caller's transaction. rows are
+    # (chat_id, datetime, bp, pulse, comment, ts, systolic, diastolic, pulse_bpm);
+    # a row matching an existing reading's ts and bp is skipped. Returns the
+    # number of rows inserted.
+    if dialect(conn) == "postgresql":
+        conn.execute(IMPORT_TABLE_SQL)
+        conn.copy_rows("import_rows", ENTRY_COLUMNS, rows)
+        inserted = conn.execute(IMPORT_INSERT_SQL).fetchall()
+    else:
+        # New ids come after the current maximum (one writer), so the rows
+        # that were actually inserted are read back by id
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM bp_diary").fetchone()[0]
+        conn.executemany(
+            "INSERT INTO bp_diary (chat_id, datetime, bp, pulse, comment, ts, systolic, diastolic, pulse_bpm) "
+            "SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9 "
+            "WHERE NOT EXISTS (SELECT 1 FROM bp_diary WHERE chat_id=?1 AND ts=?6 AND bp=?3)",
+            rows)
+        inserted = conn.execute("SELECT ts, systolic, diastolic, pulse_bpm FROM bp_diary WHERE chat_id=? AND id > ?",
+                                (chat_id, last_id)).fetchall()
+    if inserted:
+        _bump_summary(conn, chat_id, len(inserted))
+        merge_rollups(conn, chat_id, inserted)
+    return len(inserted)
+
+def _bump_summary(conn, chat_id, delta):
+    # A new user's rollups start out built (empty) in their current timezone
+    conn.execute("INSERT INTO bp_summary (chat_id, entries, version, rollup_tz) "
+                 "VALUES (?, ?, 1, COALESCE((SELECT timezone FROM user_settings WHERE user_id=?), 'UTC')) "
+                 "ON CONFLICT (chat_id) DO UPDATE SET "
+                 "entries=CASE WHEN bp_summary.entries + ? > 0 THEN bp_summary.entries + ? ELSE 0 END, "
+                 "version=bp_summary.version + 1",
+                 (chat_id, max(delta, 0), chat_id, delta, delta))
+
+def get_data_version(conn, chat_id):
+    row = conn.execute("SELECT version FROM bp_summary WHERE chat_id=?", (chat_id,)).fetchone()
+    return row[0] if row else 0
+
+def local_day_bounds(tz, day):
+    # [start, end) of a calendar day in `tz` as epoch seconds; DST-safe
+    start = datetime.combine(day, datetime.min.time(), tzinfo=tz)
+    end = datetime.combine(day + timedelta(days=1), datetime.min.time(), tzinfo=tz)
+    return int(start.timestamp()), int(end.timestamp())
+
+def get_status(conn, chat_id, day_start, day_end):
+    # Returns (total, today, latest) where latest is (datetime, bp, pulse) or
+    # None. Everything comes from bp_summary and idx_bp_diary_chat_ts.
+    row = conn.execute("SELECT entries FROM bp_summary WHERE chat_id=?", (chat_id,)).fetchone()
+    total = row[0] if row else 0
+    if not total:
+        return 0, 0, None
+    today = conn.execute("SELECT COUNT(*) FROM bp_diary WHERE chat_id=? AND ts >= ? AND ts < ?",
+                         (chat_id, day_start, day_end)).fetchone()[0]
+    latest = conn.execute("SELECT datetime, bp, pulse FROM bp_diary WHERE chat_id=? ORDER BY ts DESC, id DESC LIMIT 1",
+                          (chat_id,)).fetchone()
+    return total, today, latest
+
+def get_entries(conn, chat_id):
+    return conn.execute(ENTRIES_SQL, (chat_id,)).fetchall()
+
+def get_page(conn, chat_id, older_than=None, newer_than=None, limit=PAGE_SIZE):
+    # Keyset pagination over idx_bp_diary_chat_ts, newest first. Cursors are
+    # (ts, id) pairs taken from the edge rows of the previous page. Returns
+    # (rows, has_newer, has_older); each row ends with its ts.
+    if newer_than is not None:
+        rows = conn.execute(
+            "SELECT id, datetime, bp, pulse, comment, ts FROM bp_diary WHERE chat_id=? AND (ts, id) > (?, ?) ORDER BY ts ASC, id ASC LIMIT ?",
+            (chat_id, newer_than[0], newer_than[1], limit + 1)).fetchall()
+        has_newer = len(rows) > limit
+        rows = rows[:limit][::-1]
+        return rows, has_newer, True
+    if older_than is not None:
+        rows = conn.execute(
+            "SELECT id, datetime, bp, pulse, comment, ts FROM bp_diary WHERE chat_id=? AND (ts, id) < (?, ?) ORDER BY ts DESC, id DESC LIMIT ?",
+            (chat_id, older_than[0], older_than[1], limit + 1)).fetchall()
+        return rows[:limit], True, len(rows) > limit
+    rows = conn.execute(
+        "SELECT id, datetime, bp, pulse, comment, ts FROM bp_diary WHERE chat_id=? ORDER BY ts DESC, id DESC LIMIT ?",
+        (chat_id, limit + 1)).fetchall()
+    return rows[:limit], False, len(rows) > limit
+
+def delete_entry(conn, entry_id, user_id):
+    # Returns the deleted row (datetime, bp, pulse, comment) or None.
+    row = conn.execute("SELECT datetime, bp, pulse, comment, ts FROM bp_diary WHERE id=? AND chat_id=?",
+                       (entry_id, user_id)).fetchone()
+    if row is None:
+        return None
+    conn.execute("DELETE FROM bp_diary WHERE id=? AND chat_id=?", (entry_id, user_id))
+    _bump_summary(conn, user_id, -1)
+    refresh_rollup_buckets(conn, user_id, row[4])
+    return row[:4]
+
+def get_settings(conn, user_id):
+    # Returns (timezone, reminders) with defaults for unknown users.
+    result = conn.execute("SELECT timezone, reminders FROM user_settings WHERE user_id=?", (user_id,)).fetchone()
+    if result is None:
+        return "UTC", []
+    return result[0] or "UTC", load_reminders(result[1])
+
+def set_timezone(conn, user_id, timezone):
+    conn.execute("INSERT INTO user_settings (user_id, timezone, reminders) VALUES (?, ?, '[]') "
+                 "ON CONFLICT (user_id) DO UPDATE SET timezone=excluded.timezone, "
+                 "reminders=COALESCE(user_settings.reminders, '[]')",
+                 (user_id, timezone))
+    # Rollup buckets are local days, so they move with the timezone
+    if get_rollup_tz(conn, user_id) not in (None, timezone):
+        rebuild_rollups(conn, user_id, timezone)
+    return get_settings(conn, user_id)
+
+def get_timezone(conn, user_id):
+    result = conn.execute("SELECT timezone FROM user_settings WHERE user_id=?", (user_id,)).fetchone()
+    return result[0] if result else "UTC"
+
+def set_reminders(conn, user_id, reminders):
+    conn.execute("INSERT INTO user_settings (user_id, timezone, reminders) VALUES (?, 'UTC', ?) "
+                 "ON CONFLICT (user_id) DO UPDATE SET timezone=COALESCE(user_settings.timezone, 'UTC'), "
+                 "reminders=excluded.reminders",
+                 (user_id, json.dumps(reminders)))
+    # Keep the ledger at one row per configured slot
+    if reminders:
+        placeholders = ",".join("?" * len(reminders))
+        conn.execute(f"DELETE FROM reminder_sent WHERE user_id=? AND slot NOT IN ({placeholders})",
+                     (user_id, *reminders))
+    else:
+        conn.execute("DELETE FROM reminder_sent WHERE user_id=?", (user_id,))
+    return get_settings(conn, user_id)
+
+def load_reminders(reminders_json):
+    if reminders_json:
+        try:
+            return json.loads(reminders_json)
+        except json.JSONDecodeError:
+            return []
+    return []
+
+def get_reminders(conn, user_id):
+    result = conn.execute("SELECT reminders FROM user_settings WHERE user_id=?", (user_id,)).fetchone()
+    return load_reminders(result[0]) if result else []
+
+def claim_reminders(conn, due):
+    # Atomically claims each (fire_at, user_id, slot) in `due` and returns the
+    # ones this process won. A reminder already claimed for the same or a
+    # later fire time, by this or another process, is dropped.
+    claimed = []
+    for fire_at, user_id, slot in due:
+        cur = conn.execute(
+            "INSERT INTO reminder_sent (user_id, slot, last_fired) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id, slot) DO UPDATE SET last_fired=excluded.last_fired "
+            "WHERE reminder_sent.last_fired < excluded.last_fired",
+            (user_id, slot, int(fire_at)))
+        if cur.rowcount > 0:
+            claimed.append((fire_at, user_id, slot))
+    return claimed
+
+def get_export_watermark(conn, chat_id):
+    row = conn.execute("SELECT last_export_ts FROM bp_summary WHERE chat_id=?", (chat_id,)).fetchone()
+    return row[0] if row else None
+
+def set_export_watermark(conn, chat_id, ts):
+    # Only moves forward, so exporting an old range doesn't rewind it
+    conn.execute("UPDATE bp_summary SET last_export_ts=CASE WHEN last_export_ts IS NULL OR last_export_ts < ? "
+                 "THEN ? ELSE last_export_ts END WHERE chat_id=?",
+                 (ts, ts, chat_id))
+
+def save_conversations(conn, saved, ended):
+    # saved: [(user_id, expires, data)], ended: [user_id]
+    conn.executemany("INSERT INTO conv_state (user_id, expires, data) VALUES (?, ?, ?) "
+                     "ON CONFLICT (user_id) DO UPDATE SET expires=excluded.expires, data=excluded.data", saved)
+    conn.executemany("DELETE FROM conv_state WHERE user_id=?", [(user_id,) for user_id in ended])
+
+def purge_conversations(conn, now):
+    return conn.execute("DELETE FROM conv_state WHERE expires < ?", (now,)).rowcount
+
+def load_conversations(conn, now, shard=0, shards=1):
+    # Live rows of one shard's users (user_id % shards), least recently
+    # touched first
+    return conn.execute("SELECT user_id, expires, data FROM conv_state "
+                        "WHERE expires >= ? AND user_id % ? = ? ORDER BY expires",
+                        (now, shards, shard)).fetchall()
+
+def load_conversation(conn, user_id, now):
+    return conn.execute("SELECT expires, data FROM conv_state WHERE user_id=? AND expires >= ?",
+                        (user_id, now)).fetchone()
+
+@contextmanager
+def stream(conn, sql, params=()):
+    # Cursor for reading a large result in fetchmany() batches without
+    # holding all of it: sqlite3 steps through rows as they are fetched,
+    # PostgreSQL needs a server-side cursor
+    if dialect(conn) == "postgresql":
+        with conn.server_cursor(sql, params) as cursor:
+            yield cursor
+        return
+    cursor = conn.execute(sql, params)
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+
+def get_all_users_with_reminders(conn, shard=0, shards=1):
+    return conn.execute("SELECT user_id, timezone, reminders FROM user_settings "
+                        "WHERE reminders IS NOT NULL AND reminders != '[]' AND user_id % ? = ?",
+                        (shards, shard)).fetchall()
+
+
+# =======================
+# Rollups
+# =======================
+# bp_daily / bp_weekly hold count, sum, sum of squares, min and max of
+# systolic, diastolic and pulse per user per local day / ISO week (keyed by
+# the week's Monday). Inserts merge into them; deletes recompute the two
+# affected buckets from bp_diary, so long-range stats read O(days) rows.
+ROLLUP_TABLES = (("bp_daily", "day"), ("bp_weekly", "week"))
+ROLLUP_FIELDS = ("n", "sys_sum", "sys_sq", "sys_min", "sys_max", "dia_sum", "dia_sq", "dia_min", "dia_max",
+                 "pulse_n", "pulse_sum", "pulse_sq", "pulse_min", "pulse_max")
+ROLLUP_SOURCE_SQL = ("SELECT ts, systolic, diastolic, pulse_bpm FROM bp_diary "
+                     "WHERE chat_id=? AND systolic IS NOT NULL AND ts > 0")
+REBUILD_BATCH = 50
+
+def _merge_sql(table, key):
+    def merged(field):
+        if field.endswith("_min") or field.endswith("_max"):
+            op = "<" if field.endswith("_min") else ">"
+            return (f"{field}=CASE WHEN {table}.{field} IS NULL OR excluded.{field} {op} {table}.{field} "
+                    f"THEN excluded.{field} ELSE {table}.{field} END")
+        return f"{field}={table}.{field} + excluded.{field}"
+    columns = ", ".join(ROLLUP_FIELDS)
+    placeholders = ", ".join("?" * (len(ROLLUP_FIELDS) + 2))
+    updates = ", ".join(merged(f) for f in ROLLUP_FIELDS)
+    return (f"INSERT INTO {table} (chat_id, {key}, {columns}) VALUES ({placeholders}) "
+            f"ON CONFLICT (chat_id, {key}) DO UPDATE SET {updates}")
+
+ROLLUP_MERGE_SQL = {table: _merge_sql(table, key) for table, key in ROLLUP_TABLES}
+
+def rollup_keys(ts, tz):
+    day = datetime.fromtimestamp(ts, tz).date()
+    return day.isoformat(), (day - timedelta(days=day.weekday())).isoformat()
+
+def aggregate_readings(readings, tz):
+    # readings: iterable of (ts, systolic, diastolic, pulse_bpm).
+    # Returns ({day: fields}, {week: fields}) with fields in ROLLUP_FIELDS order.
+    daily, weekly = {}, {}
+    for ts, systolic, diastolic, pulse_bpm in readings:
+        if systolic is None or diastolic is None or not ts:
+            continue
+        for buckets, key in zip((daily, weekly), rollup_keys(ts, tz)):
+            agg = buckets.get(key)
+            if agg is None:
+                agg = buckets[key] = [0, 0, 0, systolic, systolic, 0, 0, diastolic, diastolic, 0, 0, 0, None, None]
+            agg[0] += 1
+            agg[1] += systolic
+            agg[2] += systolic * systolic
+            agg[3] = min(agg[3], systolic)
+            agg[4] = max(agg[4], systolic)
+            agg[5] += diastolic
+            agg[6] += diastolic * diastolic
+            agg[7] = min(agg[7], diastolic)
+            agg[8] = max(agg[8], diastolic)
+            if pulse_bpm is not None:
+                agg[9] += 1
+                agg[10] += pulse_bpm
+                agg[11] += pulse_bpm * pulse_bpm
+                agg[12] = pulse_bpm if agg[12] is None else min(agg[12], pulse_bpm)
+                agg[13] = pulse_bpm if agg[13] is None else max(agg[13], pulse_bpm)
+    return daily, weekly
+
+def get_rollup_tz(conn, chat_id):
+    row = conn.execute("SELECT rollup_tz FROM bp_summary WHERE chat_id=?", (chat_id,)).fetchone()
+    return row[0] if row else None
+
+def merge_rollups(conn, chat_id, readings):
+    tz_name = get_rollup_tz(conn, chat_id)
+    if tz_name is None:
+        return  # pending rebuild
+    daily, weekly = aggregate_readings(readings, _zone(tz_name))
+    for (table, _), buckets in zip(ROLLUP_TABLES, (daily, weekly)):
+        conn.executemany(ROLLUP_MERGE_SQL[table], [(chat_id, key, *agg) for key, agg in buckets.items()])
+
+def _write_bucket(conn, table, key_column, chat_id, key, start, end, tz):
+    conn.execute(f"DELETE FROM {table} WHERE chat_id=? AND {key_column}=?", (chat_id, key))
+    rows = conn.execute(ROLLUP_SOURCE_SQL + " AND ts >= ? AND ts < ?", (chat_id, start, end)).fetchall()
+    daily, weekly = aggregate_readings(rows, tz)
+    agg = (daily if table == "bp_daily" else weekly).get(key)
+    if agg is not None:
+        conn.execute(ROLLUP_MERGE_SQL[table], (chat_id, key, *agg))
+
+def refresh_rollup_buckets(conn, chat_id, ts):
+    # Recomputes the day and week containing `ts` from bp_diary
+    tz_name = get_rollup_tz(conn, chat_id)
+    if tz_name is None or not ts:
+        return
+    tz = _zone(tz_name)
+    day_key, week_key = rollup_keys(ts, tz)
+    day = datetime.fromisoformat(day_key).date()
+    monday = datetime.fromisoformat(week_key).date()
+    start, end = local_day_bounds(tz, day)
+    _write_bucket(conn, "bp_daily", "day", chat_id, day_key, start, end, tz)
+    week_start = local_day_bounds(tz, monday)[0]
+    week_end = local_day_bounds(tz, monday + timedelta(days=7))[0]
+    _write_bucket(conn, "bp_weekly", "week", chat_id, week_key, week_start, week_end, tz)
+
+def compute_rollups(conn, chat_id, tz_name):
+    return aggregate_readings(conn.execute(ROLLUP_SOURCE_SQL, (chat_id,)), _zone(tz_name))
+
+def rebuild_rollups(conn, chat_id, tz_name):
+    # Recomputes every bucket for one user in `tz_name` and records it. The
+    # data version moves too: cached exports and reports built from the old
+    # buckets are stale.
+    daily, weekly = compute_rollups(conn, chat_id, tz_name)
+    for (table, _), buckets in zip(ROLLUP_TABLES, (daily, weekly)):
+        conn.execute(f"DELETE FROM {table} WHERE chat_id=?", (chat_id,))
+        conn.executemany(ROLLUP_MERGE_SQL[table], [(chat_id, key, *agg) for key, agg in buckets.items()])
+    conn.execute("UPDATE bp_summary SET rollup_tz=?, version=version + 1 WHERE chat_id=?", (tz_name, chat_id))
+    return len(daily), len(weekly)
+
+def verify_rollups(conn, chat_id):
+    # Returns a list of (table, key) whose stored rollup differs from bp_diary
+    tz_name = get_rollup_tz(conn, chat_id)
+    if tz_name is None:
+        return [("bp_summary", "rollups not built")]
+    mismatches = []
+    for (table, key_column), expected in zip(ROLLUP_TABLES, compute_rollups(conn, chat_id, tz_name)):
+        stored = {row[0]: list(row[1:]) for row in conn.execute(
+            f"SELECT {key_column}, {', '.join(ROLLUP_FIELDS)} FROM {table} WHERE chat_id=?", (chat_id,))}
+        for key in set(stored) | set(expected):
+            if stored.get(key) != expected.get(key):
+                mismatches.append((table, key))
+    return sorted(mismatches)
+
+def pending_rollups(conn, limit=REBUILD_BATCH):
+    # Users whose rollups were never built, with their current timezone
+    return conn.execute(
+        "SELECT s.chat_id, COALESCE(u.timezone, 'UTC') FROM bp_summary s "
+        "LEFT JOIN user_settings u ON u.user_id = s.chat_id WHERE s.rollup_tz IS NULL LIMIT ?",
+        (limit,)).fetchall()
+
+def invalidate_rollups(conn):
+    conn.execute("UPDATE bp_summary SET rollup_tz=NULL")
+
+def get_daily_rollups(conn, chat_id, since=None):
+    sql = f"SELECT day, {', '.join(ROLLUP_FIELDS)} FROM bp_daily WHERE chat_id=?"
+    if since is not None:
+        return conn.execute(sql + " AND day >= ? ORDER BY day", (chat_id, since)).fetchall()
+    return conn.execute(sql + " ORDER BY day", (chat_id,)).fetchall()
+
+def get_weekly_rollups(conn, chat_id, since=None, until=None):
+    # Weeks overlapping [since, until) (epoch seconds, open when None)
+    tz = _zone(get_rollup_tz(conn, chat_id) or "UTC")
+    first = rollup_keys(since, tz)[1] if since else ""
+    last = rollup_keys(until - 1, tz)[1] if until else "9999"
+    return conn.execute(f"SELECT week, {', '.join(ROLLUP_FIELDS)} FROM bp_weekly "
+                        "WHERE chat_id=? AND week >= ? AND week <= ? ORDER BY week",
+                        (chat_id, first, last)).fetchall()
+
+def _zone(tz_name):
+    try:
+        return get_zone(tz_name)
+    except Exception:
+        return get_zone("UTC")
@@ -0,0 +1,37 @@
+import asyncio
+import os
+import sys
+
+from telegram.error import BadRequest, Forbidden, NetworkError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import delivery  # noqa: E402
+
+
+def deliver(error, max_attempts=3):
+    # (result, number of send attempts) for a send that always raises `error`
+    attempts = []
+
+    async def send(chat_id):
+        attempts.append(chat_id)
+        raise error
+
+    async def run():
+        queue = delivery.DeliveryQueue(send, per_chat_rate=1000, max_attempts=max_attempts)
+        return await queue._deliver(1)
+
+    return asyncio.run(run()), len(attempts)
+
+
+def test_bad_request_is_not_retried():
+    assert deliver(BadRequest("Chat not found")) == (False, 1)
+
+
+def test_forbidden_is_not_retried():
+    assert deliver(Forbidden("Forbidden: bot was blocked by the user")) == (False, 1)
+
+
+def test_network_error_is_retried(monkeypatch):
+    monkeypatch.setattr(delivery, "BACKOFF_BASE", 0)
+    assert deliver(NetworkError("Connection reset")) == (False, 3)
@@ -0,0 +1,139 @@
+import re
+from collections import defaultdict
+from functools import lru_cache
+from zoneinfo import ZoneInfo, available_timezones
+
+# =======================
+# Aliases
+# =======================
+# Common abbreviations; only those whose target exists in the local tzdata
+# are indexed. Ambiguous ones map to their most populous zone.
+ABBREVIATIONS = {
+    "UTC": "UTC", "GMT": "UTC", "Z": "UTC",
+    "EST": "America/New_York", "EDT": "America/New_York", "ET": "America/New_York",
+    "CST": "America/Chicago", "CDT": "America/Chicago", "CT": "America/Chicago",
+    "MST": "America/Denver", "MDT": "America/Denver", "MT": "America/Denver",
+    "PST": "America/Los_Angeles", "PDT": "America/Los_Angeles", "PT": "America/Los_Angeles",
+    "AKST": "America/Anchorage", "HST": "Pacific/Honolulu",
+    "BST": "Europe/London", "WET": "Europe/Lisbon", "CET": "Europe/Berlin", "CEST": "Europe/Berlin",
+    "EET": "Europe/Athens", "EEST": "Europe/Athens", "MSK": "Europe/Moscow",
+    "IST": "Asia/Kolkata", "PKT": "Asia/Karachi", "ICT": "Asia/Bangkok", "WIB": "Asia/Jakarta",
+    "SGT": "Asia/Singapore", "HKT": "Asia/Hong_Kong", "JST": "Asia/Tokyo", "KST": "Asia/Seoul",
+    "AWST": "Australia/Perth", "ACST": "Australia/Adelaide", "AEST": "Australia/Sydney",
+    "AEDT": "Australia/Sydney", "NZST": "Pacific/Auckland", "NZDT": "Pacific/Auckland",
+}
+
+# Offsets without an Etc/GMT zone, mapped to a zone that uses them
+FRACTIONAL_OFFSETS = {
+    (-9, 30): "Pacific/Marquesas", (-3, 30): "America/St_Johns", (3, 30): "Asia/Tehran",
+    (4, 30): "Asia/Kabul", (5, 30): "Asia/Kolkata", (5, 45): "Asia/Kathmandu",
+    (6, 30): "Asia/Yangon", (8, 45): "Australia/Eucla", (9, 30): "Australia/Darwin",
+    (10, 30): "Australia/Lord_Howe", (12, 45): "Pacific/Chatham",
+}
+
+OFFSET_RE = re.compile(r"^(?:utc|gmt)?\s*([+-])\s*(\d{1,2})(?::?(\d{2}))?$")
+
+FUZZY_THRESHOLD = 0.35
+
+
+@lru_cache(maxsize=None)
+def get_zone(name):
+    # Shared ZoneInfo instances; raises for unknown names like ZoneInfo does
+    return ZoneInfo(name)
+
+
+def _normalize(text):
+    return re.sub(r"[\s_\-]+", " ", text.strip().lower())
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TimezoneResolver:
+    # Built once: an exact-match set of IANA keys, a dict of normalised
+    # aliases (keys, city names, abbreviations, extra button labels) and a
+    # trigram inverted index over the aliases for typo suggestions.
+    def __init__(self, extra_aliases=None):
+        self.zones = frozenset(available_timezones())
+        self.aliases = {}
+        for zone in self.zones:
+            self.aliases.setdefault(_normalize(zone), zone)
+            city = zone.rsplit("/", 1)[-1]
+            # Region-level keys ("Etc/GMT+3", "US/Eastern") shouldn't shadow cities
+            if not zone.startswith("Etc/"):
+                self.aliases.setdefault(_normalize(city), zone)
+        for abbr, zone in ABBREVIATIONS.items():
+            if zone in self.zones:
+                self.aliases[abbr.lower()] = zone
+        for alias, zone in (extra_aliases or {}).items():
+            self.aliases[_normalize(alias)] = zone
+
+        self._names = list(self.aliases)
+        self._grams = [_trigrams(name) for name in self._names]
+        self._index = defaultdict(list)
+        for i, grams in enumerate(self._grams):
+            for gram in grams:
+                self._index[gram].append(i)
+
+    def _offset_zone(self, text):
+        m = OFFSET_RE.match(text.replace(" ", ""))
+        if not m:
+            return None
+        sign = 1 if m.group(1) == "+" else -1
+        hours, minutes = int(m.group(2)), int(m.group(3) or 0)
+        if minutes:
+            return FRACTIONAL_OFFSETS.get((sign * hours, minutes))
+        if hours == 0:
+            return "UTC"
+        # POSIX-style Etc names have the sign inverted
+        zone = f"Etc/GMT{'-' if sign > 0 else '+'}{hours}"
+        return zone if zone in self.zones else None
+
+    def exact(self, text):
+        text = text.strip()
+        if text in self.zones:
+            return text
+        zone = self.aliases.get(_normalize(text))
+        if zone is not None:
+            return zone
+        return self._offset_zone(text.lower())
+
+    def suggest(self, text, n=5):
+        grams = _trigrams(_normalize(text))
+        if not grams:
+            return []
+        shared = defaultdict(int)
+        for gram in grams:
+            for i in self._index.get(gram, ()):
+                shared[i] += 1
+        scored = []
+        for i, count in shared.items():
+            score = 2 * count / (len(grams) + len(self._grams[i]))
+            if score >= FUZZY_THRESHOLD:
+                scored.append((score, self._names[i]))
+        scored.sort(reverse=True)
+        suggestions = []
+        for score, name in scored:
+            zone = self.aliases[name]
+            if zone not in suggestions:
+                suggestions.append(zone)
+            if len(suggestions) == n:
+                break
+        return suggestions
+
+    def resolve(self, text):
+        # Returns (zone, suggestions); zone is None when there's no exact hit
+        zone = self.exact(text)
+        if zone is not None:
+            return zone, []
+        return None, self.suggest(text)
+
+
+_resolver = None
+
+def default_resolver(extra_aliases=None):
+    global _resolver
+    if _resolver is None:
+        _resolver = TimezoneResolver(extra_aliases)
+    return _resolver
@@ -0,0 +1,63 @@
+import time
+from collections import OrderedDict
+
+from scheduler import parse_slot
+from timezones import get_zone
+
+SETTINGS_CACHE_SIZE = 10000
+SETTINGS_TTL = 600  # seconds; only bounds staleness if another process writes
+
+
+class UserSettings:
+    __slots__ = ("tz_name", "tz", "reminders", "reminder_times")
+
+    def __init__(self, tz_name, reminders):
+        self.tz_name = tz_name
+        try:
+            self.tz = get_zone(tz_name)
+        except Exception:
+            self.tz = get_zone("UTC")
+        self.reminders = list(reminders)
+        try:
+            self.reminder_times = [parse_slot(r) for r in self.reminders]
+        except ValueError:
+            self.reminder_times = []
+
+
+class SettingsCache:
+    # LRU with a per-entry TTL. Writers update it through put() after the
+    # database commit, so reads in this process never see stale settings.
+    def __init__(self, maxsize=SETTINGS_CACHE_SIZE, ttl=SETTINGS_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, user_id):
+        item = self._data.get(user_id)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[user_id]
+            self.misses += 1
+            return None
+        self._data.move_to_end(user_id)
+        self.hits += 1
+        return item[1]
+
+    def put(self, user_id, settings):
+        self._data[user_id] = (time.monotonic() + self.ttl, settings)
+        self._data.move_to_end(user_id)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._data.pop(user_id, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses, "hit_ratio": ratio}